@@ -2,29 +2,251 @@
 
 import sys
 import os
+import io
+import gzip
+import json
+import hashlib
+import time
+from re import match
+from urllib.parse import quote
 from datetime import datetime, timedelta, date
 from pytz import timezone
 
 
 from dotenv import dotenv_values
-from psycopg2 import connect
+from psycopg2 import connect, sql, Error
+from psycopg2.errors import LockNotAvailable
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from boto3 import client
+from botocore.exceptions import ClientError
 
-CSV_COLUMNS = ["entry_id", "species", "temperature", "soil_moisture",
-               "humidity", "last_watered", "recording_taken", "sunlight",
+CSV_COLUMNS = ["entry_id", "plant_id", "species", "temperature", "soil_moisture",
+               "last_watered", "recording_taken", "sunlight",
                "botanist_name", "cycle"]
+ARCHIVE_QUERY = """
+    SELECT p.plant_entry_id AS entry_id,
+        p.plant_id,
+        s.s_name AS species,
+        p.temperature,
+        p.soil_moisture,
+        p.last_watered AS last_watered,
+        p.recording_taken AS recording_taken,
+        sun.s_description AS sunlight,
+        b.b_name AS botanist_name,
+        c.cycle_name AS cycle
+    FROM plant p
+    LEFT JOIN species s ON p.species_id = s.species_id
+    LEFT JOIN sunlight sun ON p.sunlight_id = sun.sunlight_id
+    LEFT JOIN botanist b ON p.botanist_id = b.botanist_id
+    LEFT JOIN cycle c ON p.cycle_id = c.cycle_id
+    WHERE recording_taken < %s;"""
+ARCHIVE_AND_DELETE_QUERY = """
+    CREATE TEMPORARY TABLE archived_rows ON COMMIT DROP AS
+    WITH deleted AS (
+        DELETE FROM plant
+        WHERE recording_taken < %s
+        RETURNING *)
+    SELECT d.plant_entry_id AS entry_id,
+        d.plant_id,
+        s.s_name AS species,
+        d.temperature,
+        d.soil_moisture,
+        d.last_watered AS last_watered,
+        d.recording_taken AS recording_taken,
+        sun.s_description AS sunlight,
+        b.b_name AS botanist_name,
+        c.cycle_name AS cycle
+    FROM deleted d
+    LEFT JOIN species s ON d.species_id = s.species_id
+    LEFT JOIN sunlight sun ON d.sunlight_id = sun.sunlight_id
+    LEFT JOIN botanist b ON d.botanist_id = b.botanist_id
+    LEFT JOIN cycle c ON d.cycle_id = c.cycle_id;"""
+ROLLUP_COLUMNS = ["granularity", "period_start", "plant_id", "species", "readings",
+                  "dropped_readings", "temperature_min", "temperature_max",
+                  "temperature_mean", "temperature_p95", "soil_moisture_min",
+                  "soil_moisture_max", "soil_moisture_mean", "soil_moisture_p95"]
+STAGE_ROLLUP_READINGS_QUERY = sql.SQL("""
+    INSERT INTO plant_rollup_reading(entry_id, plant_id, species, temperature,
+                                     soil_moisture, recording_taken)
+    SELECT a.entry_id, COALESCE(a.plant_id, 0), COALESCE(a.species, '-'), a.temperature,
+        a.soil_moisture, a.recording_taken
+    FROM (SELECT * FROM {source}) AS a
+    WHERE a.recording_taken >= DATE_TRUNC('day', %(archived_until)s::TIMESTAMP)
+            - %(retention)s::INTERVAL
+        OR NOT EXISTS (
+            SELECT 1 FROM plant_rollup r
+            WHERE r.granularity = 'day'
+                AND r.period_start = DATE_TRUNC('day', a.recording_taken)
+                AND r.plant_id = COALESCE(a.plant_id, 0)
+                AND r.species = COALESCE(a.species, '-'))
+    ON CONFLICT (entry_id) DO NOTHING;""")
+ROLLUP_QUERY = """
+    WITH readings AS (
+        SELECT *,
+            GREATEST((EXTRACT(EPOCH FROM DATE_TRUNC('minute', recording_taken)
+                - DATE_TRUNC('minute', LAG(recording_taken) OVER plant_readings)) / 60)::INT
+                - 1, 0) AS minutes_missed,
+            COALESCE(LAG(hour_rolled_up) OVER plant_readings, TRUE) AS previous_hour_rolled_up,
+            COALESCE(LAG(day_rolled_up) OVER plant_readings, TRUE) AS previous_day_rolled_up
+        FROM plant_rollup_reading
+        WINDOW plant_readings AS (PARTITION BY plant_id, species ORDER BY recording_taken)),
+    rollup AS (
+        SELECT g.granularity,
+            DATE_TRUNC(g.granularity, recording_taken) AS period_start,
+            plant_id,
+            species,
+            COUNT(*) AS readings,
+            SUM(minutes_missed) AS dropped_readings,
+            MIN(temperature) AS temperature_min,
+            MAX(temperature) AS temperature_max,
+            AVG(temperature) AS temperature_mean,
+            PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY temperature) AS temperature_p95,
+            MIN(soil_moisture) AS soil_moisture_min,
+            MAX(soil_moisture) AS soil_moisture_max,
+            AVG(soil_moisture) AS soil_moisture_mean,
+            PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY soil_moisture) AS soil_moisture_p95
+        FROM readings, (VALUES ('hour'), ('day')) AS g(granularity)
+        WHERE recording_taken < DATE_TRUNC(g.granularity, %(archived_until)s::TIMESTAMP)
+        GROUP BY 1, 2, 3, 4
+        HAVING NOT BOOL_AND(CASE g.granularity
+            WHEN 'hour' THEN hour_rolled_up AND previous_hour_rolled_up
+            ELSE day_rolled_up AND previous_day_rolled_up END)),
+    saved AS (
+        INSERT INTO plant_rollup SELECT * FROM rollup
+        ON CONFLICT (granularity, period_start, plant_id, species) DO UPDATE SET
+            readings = EXCLUDED.readings,
+            dropped_readings = EXCLUDED.dropped_readings,
+            temperature_min = EXCLUDED.temperature_min,
+            temperature_max = EXCLUDED.temperature_max,
+            temperature_mean = EXCLUDED.temperature_mean,
+            temperature_p95 = EXCLUDED.temperature_p95,
+            soil_moisture_min = EXCLUDED.soil_moisture_min,
+            soil_moisture_max = EXCLUDED.soil_moisture_max,
+            soil_moisture_mean = EXCLUDED.soil_moisture_mean,
+            soil_moisture_p95 = EXCLUDED.soil_moisture_p95)
+    SELECT * FROM rollup ORDER BY 1, 2, 3, 4;"""
+MARK_ROLLED_UP_QUERY = """
+    UPDATE plant_rollup_reading SET
+        hour_rolled_up = hour_rolled_up
+            OR recording_taken < DATE_TRUNC('hour', %(archived_until)s::TIMESTAMP),
+        day_rolled_up = recording_taken < DATE_TRUNC('day', %(archived_until)s::TIMESTAMP)
+    WHERE NOT day_rolled_up;
+    DELETE FROM plant_rollup_reading
+    WHERE day_rolled_up AND recording_taken < DATE_TRUNC(
+        'day', %(archived_until)s::TIMESTAMP) - %(retention)s::INTERVAL;"""
+ROLLUP_RETENTION = "1 day"
+ARCHIVED_ROWS_SOURCE = sql.SQL("archived_rows")
+OLD_ROWS_SOURCE = sql.SQL("""(
+        SELECT p.plant_entry_id AS entry_id, p.plant_id, s.s_name AS species,
+            p.temperature, p.soil_moisture, p.recording_taken
+        FROM plant p
+        LEFT JOIN species s ON p.species_id = s.species_id
+        WHERE p.recording_taken < %(archived_until)s) AS old_rows""")
+ARCHIVE_FETCH_SIZE = 5000
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+ARCHIVE_WINDOW_HOURS = 1
+INCREMENTAL_MAX_WINDOWS = 48
+INCREMENTAL_PREFIX = "incremental/"
+WATERMARK_NAME = "plant"
+PARQUET_PREFIX = "parquet/"
+PARQUET_COMPRESSION = "zstd"
+PARQUET_PARTITIONS = ["date", "species"]
+PARQUET_SCHEMA = pa.schema([
+    ("entry_id", pa.int64()),
+    ("plant_id", pa.int64()),
+    ("temperature", pa.float64()),
+    ("soil_moisture", pa.float64()),
+    ("last_watered", pa.timestamp("us")),
+    ("recording_taken", pa.timestamp("us")),
+    ("sunlight", pa.string()),
+    ("botanist_name", pa.string()),
+    ("cycle", pa.string())])
+MISSING_SPECIES = "-"
+ARCHIVE_SCHEMA_VERSION = 1
+MANIFEST_PREFIX = "manifest/"
+MANIFEST_WRITE_ATTEMPTS = 5
+MANIFEST_CONFLICT_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+MANIFEST_METRICS = ["temperature", "soil_moisture"]
+CONNECT_TIMEOUT = 5
+STATEMENT_TIMEOUT_MS = 300000
+KEEPALIVE_OPTIONS = {"keepalives": 1, "keepalives_idle": 30,
+                     "keepalives_interval": 10, "keepalives_count": 3}
+LOCK_TIMEOUT_MS = 2000
+LOCK_RETRY_ATTEMPTS = 5
+LOCK_RETRY_DELAY = 0.5
+PARTITION_DAYS_AHEAD = 3
+PARTITION_NAME_PATTERN = r"plant_(\d{8})$"
+
+
+class ConnectionManager:
+    """Keeps one database connection open between warm Lambda invocations.
+
+    The same class is copied into each deployable, and live_pipeline/test_pipeline.py
+    checks the copies match, so change them together.
+    """
+
+    def __init__(self):
+        """Creates a manager with no open connection."""
+        self.connection = None
+
+    def is_healthy(self) -> bool:
+        """Checks the open connection still works with a single cheap query.
+
+        Called at the start of each invocation, so any transaction still open was
+        left behind by an earlier invocation that was aborted. It is rolled back
+        rather than carried into this one.
+        """
+        if self.connection is None or self.connection.closed:
+            return False
+        try:
+            if self.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                self.connection.rollback()
+            autocommit = self.connection.autocommit
+            self.connection.autocommit = True
+            with self.connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+            self.connection.autocommit = autocommit
+            return True
+        except Error:
+            return False
+
+    def get(self, config: dict):
+        """Returns the open connection, reconnecting if it is missing or broken."""
+        if not self.is_healthy():
+            self.close()
+            self.connection = connect(
+                user=config['DATABASE_USERNAME'],
+                password=config['DATABASE_PASSWORD'],
+                host=config['DATABASE_IP'],
+                port=config['DATABASE_PORT'],
+                database=config['DATABASE_NAME'],
+                connect_timeout=CONNECT_TIMEOUT,
+                options=f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",
+                **KEEPALIVE_OPTIONS)
+        return self.connection
+
+    def close(self) -> None:
+        """Closes the connection if one is open."""
+        if self.connection is not None and not self.connection.closed:
+            try:
+                self.connection.close()
+            except Error:
+                pass
+        self.connection = None
+
+CONNECTION_MANAGER = ConnectionManager()
 
 
 def get_database_connection(config: dict):  # pragma: no cover
-    """Establishes a connection with the PostgreSQL database."""
+    """Establishes a connection with the PostgreSQL database.
+
+    A healthy connection left open by a previous warm invocation is reused.
+    """
     try:
-        return connect(
-            user=config['DATABASE_USERNAME'],
-            password=config['DATABASE_PASSWORD'],
-            host=config['DATABASE_IP'],
-            port=config['DATABASE_PORT'],
-            database=config['DATABASE_NAME'])
+        return CONNECTION_MANAGER.get(config)
     except ValueError as err:
         print("Error connecting to database: ", err)
         sys.exit()
@@ -55,49 +277,803 @@ def delete_old_rows(conn, delete_timestamp: str) -> list[tuple]:  # pragma: no c
         return deleted_rows
 
 
+def get_entry_id_range(conn, delete_timestamp: str) -> tuple[int | None, int | None]:
+    """Returns the lowest and highest plant_entry_id of the rows older than the timestamp."""
+    with conn.cursor() as cur:
+        cur.execute("""SELECT MIN(plant_entry_id), MAX(plant_entry_id) FROM plant
+                    WHERE recording_taken < %s;""", (delete_timestamp,))
+        return cur.fetchone()
+
+
+def get_partitions_with_rows_before(conn, delete_timestamp: str) -> list[str]:
+    """Returns the names of the plant partitions holding rows older than the timestamp."""
+    with conn.cursor() as cur:
+        cur.execute("""SELECT DISTINCT c.relname FROM plant p
+                    JOIN pg_class c ON c.oid = p.tableoid
+                    WHERE p.recording_taken < %s ORDER BY 1;""", (delete_timestamp,))
+        return [row[0] for row in cur.fetchall()]
+
+
+def get_id_batches(first_id: int, last_id: int, batch_size: int) -> list[tuple[int, int]]:
+    """Returns consecutive half-open id ranges of batch_size covering first_id to last_id."""
+    return [(low, min(low + batch_size, last_id + 1))
+            for low in range(first_id, last_id + 1, batch_size)]
+
+
+def delete_old_rows_in_batches(conn, delete_timestamp: str, batch_size: int,
+                               pause_seconds: float = 0) -> int:
+    """Removes the rows older than the timestamp in small batches of plant_entry_id.
+
+    Each batch is its own short transaction with a lock timeout, so inserts from the
+    live pipeline are never held up for long, and the job can sleep between batches.
+    A batch that times out waiting for a lock is retried with backoff rather than
+    failing the job after its archive has been uploaded.
+    Returns the number of rows deleted.
+    """
+    first_id, last_id = get_entry_id_range(conn, delete_timestamp)
+    conn.commit()
+    if first_id is None:
+        return 0
+    deleted_count = 0
+    batches = get_id_batches(first_id, last_id, batch_size)
+    print(f"Deleting rows from RDS in {len(batches)} batches.")
+    for low, high in batches:
+        start = time.perf_counter()
+        batch_count = run_with_lock_timeout(conn, [(
+            """DELETE FROM plant
+            WHERE plant_entry_id >= %s AND plant_entry_id < %s
+            AND recording_taken < %s;""", (low, high, delete_timestamp))])
+        deleted_count += batch_count
+        print(f"Deleted {batch_count} rows with ids {low}-{high - 1} "
+              f"in {time.perf_counter() - start:.3f}s.")
+        if pause_seconds:
+            time.sleep(pause_seconds)
+    print(f"{deleted_count} rows deleted from RDS.")
+    return deleted_count
+
+
+def vacuum_partitions(conn, partition_names: list[str]) -> None:
+    """Vacuums and analyzes the partitions rows were deleted from, then analyzes plant.
+
+    VACUUM cannot run inside a transaction, so autocommit is switched on while it runs.
+    """
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for partition_name in partition_names:
+                start = time.perf_counter()
+                cur.execute(sql.SQL("VACUUM (ANALYZE) {};").format(
+                    sql.Identifier(partition_name)))
+                print(f"Vacuumed {partition_name} in {time.perf_counter() - start:.3f}s.")
+            start = time.perf_counter()
+            cur.execute("ANALYZE plant;")
+            print(f"Analyzed plant in {time.perf_counter() - start:.3f}s.")
+    finally:
+        conn.autocommit = False
+
+
+def delete_old_rows_with_maintenance(conn, delete_timestamp: str, configuration: dict) -> int:
+    """Deletes the old rows in batches of ARCHIVE_DELETE_BATCH_SIZE ids, then vacuums.
+
+    Returns the number of rows deleted.
+    """
+    partition_names = get_partitions_with_rows_before(conn, delete_timestamp)
+    deleted_count = delete_old_rows_in_batches(
+        conn, delete_timestamp, int(configuration["ARCHIVE_DELETE_BATCH_SIZE"]),
+        float(configuration.get("ARCHIVE_DELETE_PAUSE_SECONDS", 0)))
+    if deleted_count:
+        vacuum_partitions(conn, partition_names)
+    return deleted_count
+
+
+def run_with_lock_timeout(conn, statements: list[tuple],
+                          attempts: int = LOCK_RETRY_ATTEMPTS,
+                          retry_delay: float = LOCK_RETRY_DELAY) -> int:
+    """Runs the (query, params) statements in one transaction that waits at most
+    LOCK_TIMEOUT_MS for locks.
+
+    A transaction that times out waiting is rolled back and retried, doubling the delay
+    each time, and the error is raised once the attempts run out. Returns the row
+    count of the last statement.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SET LOCAL lock_timeout = {LOCK_TIMEOUT_MS};")
+                for query, params in statements:
+                    cur.execute(query, params)
+                rowcount = cur.rowcount
+            conn.commit()
+            return rowcount
+        except LockNotAvailable:
+            conn.rollback()
+            if attempt == attempts:
+                raise
+            delay = retry_delay * 2 ** (attempt - 1)
+            print(f"Lock not granted, retrying in {delay:g}s.")
+            time.sleep(delay)
+        except Error:
+            conn.rollback()
+            raise
+
+
+def create_upcoming_partitions(conn, days_ahead: int = PARTITION_DAYS_AHEAD) -> None:
+    """Creates the daily plant partitions for today and the next few days.
+
+    Each day is created in its own transaction under a lock timeout, so a day that
+    fails is reported and left for the next run without stopping the archive.
+    """
+    for offset_days in range(days_ahead + 1):
+        try:
+            run_with_lock_timeout(conn, [(
+                "SELECT create_plant_partition(CURRENT_DATE + %s);", (offset_days,))])
+        except Error as err:
+            print(f"Could not create the partition {offset_days} days ahead: {err}")
+
+
+def get_partitions_before(partition_names: list[str], delete_timestamp: str) -> list[str]:
+    """Returns the daily partitions whose whole day is older than the timestamp."""
+    cutoff = datetime.strptime(delete_timestamp, "%Y-%m-%d %H:%M:%S")
+    old_partitions = []
+    for name in partition_names:
+        day = match(PARTITION_NAME_PATTERN, name)
+        if day and datetime.strptime(day.group(1), "%Y%m%d") + timedelta(days=1) <= cutoff:
+            old_partitions.append(name)
+    return sorted(old_partitions)
+
+
+def drop_old_partitions(conn, delete_timestamp: str) -> int:  # pragma: no cover
+    """Detaches and drops the daily partitions entirely older than the timestamp.
+
+    Dropping a partition avoids a large row delete. Each partition is dropped in its own
+    short transaction under a lock timeout, so the live pipeline's inserts never queue
+    behind it for long. DETACH PARTITION CONCURRENTLY is not allowed while plant has a
+    default partition. A partition that stays locked is left for the next run, and its
+    rows are deleted with the rest. Returns the rows dropped.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'plant'::regclass;""")
+        partitions = get_partitions_before(
+            [row[0] for row in cur.fetchall()], delete_timestamp)
+    conn.commit()
+    dropped_rows = 0
+    for partition in partitions:
+        print(f"Dropping partition {partition}.")
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("SELECT COUNT(*) FROM {};").format(
+                sql.Identifier(partition)))
+            partition_rows = cur.fetchone()[0]
+        try:
+            run_with_lock_timeout(conn, [
+                (sql.SQL("ALTER TABLE plant DETACH PARTITION {};").format(
+                    sql.Identifier(partition)), None),
+                (sql.SQL("DROP TABLE {};").format(sql.Identifier(partition)), None)])
+        except LockNotAvailable:
+            print(f"Partition {partition} is locked, leaving it for the next run.")
+            continue
+        dropped_rows += partition_rows
+    return dropped_rows
+
+
 def get_rows_to_be_deleted(conn, delete_timestamp: str) -> list[tuple]:  # pragma: no cover
     """Returns the rows that were recorded more than a day ago."""
     with conn.cursor() as cur:
         print("Fetching data to archive from RDS.")
-        cur.execute("""
-            SELECT p.plant_entry_id AS entry_id,
-                s.scientific_name AS species,
-                p.temperature,
-                p.soil_moisture,
-                p.humidity,
-                p.last_watered AS last_watered,
-                p.recording_taken AS recording_taken,
-                sun.s_description AS sunlight,
-                b.b_name AS botanist_name,
-                c.cycle_name AS cycle
-            FROM plant p
-            LEFT JOIN species s ON p.species_id = s.species_id
-            LEFT JOIN sunlight sun ON p.sunlight_id = sun.sunlight_id
-            LEFT JOIN botanist b ON p.botanist_id = b.botanist_id
-            LEFT JOIN cycle c ON p.cycle_id = c.cycle_id
-            WHERE recording_taken < %s;""", (delete_timestamp,))
+        cur.execute(ARCHIVE_QUERY, (delete_timestamp,))
         deleted_rows = cur.fetchall()
         conn.commit()
         print("Archive data fetched from RDS.")
         return deleted_rows
 
 
+def stream_rows(conn, query: str, params: tuple, fetch_size: int = ARCHIVE_FETCH_SIZE):
+    """Yields the rows of a query as DataFrames of up to fetch_size rows.
+
+    A named cursor keeps the result set on the server, so only one chunk is held in memory.
+    """
+    with conn.cursor(name="archive_cursor") as cur:
+        cur.itersize = fetch_size
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield pd.DataFrame(rows, columns=CSV_COLUMNS)
+
+
+def stream_rows_to_be_deleted(conn, delete_timestamp: str,
+                              fetch_size: int = ARCHIVE_FETCH_SIZE):
+    """Yields the rows recorded more than a day ago as DataFrames of up to fetch_size rows."""
+    print("Streaming data to archive from RDS.")
+    yield from stream_rows(conn, ARCHIVE_QUERY, (delete_timestamp,), fetch_size)
+    conn.commit()
+    print("Archive data streamed from RDS.")
+
+
+def write_archive_chunks(chunks, csv_filename: str) -> int:
+    """Appends each chunk to the .csv file as it arrives.
+
+    Returns the number of rows written.
+    """
+    rows_written = 0
+    with open("/tmp/" + csv_filename, "w", encoding="utf-8", newline="") as csv_file:
+        for chunk in chunks:
+            chunk.to_csv(csv_file, index=False, header=rows_written == 0)
+            rows_written += len(chunk)
+    if not rows_written:
+        raise ValueError("Empty DataFrame.")
+    return rows_written
+
+
+class ArchiveStats:
+    """Tracks the row count, time range and metric ranges of the rows written to an archive."""
+
+    def __init__(self):
+        self.rows = 0
+        self.start = None
+        self.end = None
+        self.metrics = {}
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        """Adds a chunk of archived rows to the statistics."""
+        if chunk.empty:
+            return
+        self.rows += len(chunk)
+        recorded = pd.to_datetime(chunk["recording_taken"])
+        self.start = min(filter(pd.notna, [self.start, recorded.min()]), default=None)
+        self.end = max(filter(pd.notna, [self.end, recorded.max()]), default=None)
+        for metric in MANIFEST_METRICS:
+            if metric not in chunk or chunk[metric].isna().all():
+                continue
+            low, high = float(chunk[metric].min()), float(chunk[metric].max())
+            if metric in self.metrics:
+                low = min(low, self.metrics[metric]["min"])
+                high = max(high, self.metrics[metric]["max"])
+            self.metrics[metric] = {"min": low, "max": high}
+
+    def track(self, chunks):
+        """Yields the chunks unchanged, adding each one to the statistics on the way past."""
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    def to_entry(self, key: str, size: int, checksum: str) -> dict:
+        """Returns the manifest entry for the archive file stored under key."""
+        return {"key": key,
+                "schema_version": ARCHIVE_SCHEMA_VERSION,
+                "rows": self.rows,
+                "bytes": size,
+                "sha256": checksum,
+                "start": None if self.start is None else self.start.isoformat(),
+                "end": None if self.end is None else self.end.isoformat(),
+                "metrics": self.metrics}
+
+
+def get_partition_path(day: str, species: str | None) -> str:
+    """Returns the date= / species= directory a group of archived rows belongs in."""
+    species = MISSING_SPECIES if pd.isna(species) else quote(species, safe="")
+    return f"date={day}/species={species}"
+
+
+def write_parquet_partitions(chunks, archive_dir: str, filename: str,
+                             stats: dict = None) -> tuple[int, list[str]]:
+    """Writes the chunks as compressed Parquet files partitioned by date and species.
+
+    Each partition gets one file, with every chunk added as a row group carrying
+    its own statistics. If a stats dict is given, each file's ArchiveStats are
+    kept in it. Returns the rows written and each file's path relative to archive_dir.
+    """
+    writers = {}
+    rows_written = 0
+    try:
+        for chunk in chunks:
+            chunk = chunk.assign(date=pd.to_datetime(
+                chunk["recording_taken"]).dt.strftime("%Y-%m-%d"))
+            for (day, species), group in chunk.groupby(PARQUET_PARTITIONS, dropna=False):
+                file_path = f"{get_partition_path(day, species)}/{filename}"
+                if file_path not in writers:
+                    os.makedirs(os.path.join(archive_dir, os.path.dirname(file_path)),
+                                exist_ok=True)
+                    writers[file_path] = pq.ParquetWriter(
+                        os.path.join(archive_dir, file_path), PARQUET_SCHEMA,
+                        compression=PARQUET_COMPRESSION, write_statistics=True)
+                writers[file_path].write_table(pa.Table.from_pandas(
+                    group.drop(columns=PARQUET_PARTITIONS), schema=PARQUET_SCHEMA,
+                    preserve_index=False))
+                if stats is not None:
+                    stats.setdefault(file_path, ArchiveStats()).update(group)
+            rows_written += len(chunk)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if not rows_written:
+        raise ValueError("Empty DataFrame.")
+    return rows_written, sorted(writers)
+
+
+def get_s3_client(config: dict):  # pragma: no cover
+    """Returns an S3 client using the configured credentials.
+
+    S3_ENDPOINT_URL can point the client at a local S3 stand-in.
+    """
+    print("Establishing connection to AWS.")
+    return client("s3", aws_access_key_id=config["ACCESS_KEY_ID"],
+                  aws_secret_access_key=config["SECRET_ACCESS_KEY"],
+                  endpoint_url=config.get("S3_ENDPOINT_URL"))
+
+
+class S3MultipartWriter:
+    """A writable stream that uploads to S3 in parts, holding at most one part in memory."""
+
+    def __init__(self, s3_client, bucket: str, key: str, part_size: int = MULTIPART_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.size = 0
+        self.checksum = hashlib.sha256()
+        self.upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket, Key=key)["UploadId"]
+
+    def write(self, data: bytes) -> int:
+        """Buffers the data, uploading a part each time the buffer is full."""
+        self.size += len(data)
+        self.checksum.update(data)
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self) -> None:
+        """Parts are only uploaded once full, so there is nothing to flush."""
+
+    def upload_part(self, body: bytes) -> None:
+        """Uploads the next part of the object."""
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=body)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self) -> None:
+        """Uploads whatever is left as the last part and completes the upload."""
+        if self.buffer or not self.parts:
+            self.upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts})
+        print(f"Uploaded {self.key} in {len(self.parts)} parts.")
+
+    def abort(self) -> None:
+        """Abandons the upload so no partial object is left in the bucket."""
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class LocalArchiveWriter:
+    """Writes an archive to a local directory, standing in for S3 when testing offline."""
+
+    def __init__(self, directory: str, key: str):
+        self.path = os.path.join(directory, key)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path + ".part", "wb")
+        self.size = 0
+        self.checksum = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        """Writes the data to the partial file."""
+        self.size += len(data)
+        self.checksum.update(data)
+        return self.file.write(data)
+
+    def flush(self) -> None:
+        """Flushes the partial file."""
+        self.file.flush()
+
+    def close(self) -> None:
+        """Moves the finished file into place."""
+        self.file.close()
+        os.replace(self.path + ".part", self.path)
+
+    def abort(self) -> None:
+        """Removes the partial file."""
+        self.file.close()
+        os.remove(self.path + ".part")
+
+
+def get_archive_writer(config: dict, key: str, s3_client=None):
+    """Returns a local writer if ARCHIVE_LOCAL_DIR is set, otherwise a multipart S3 upload."""
+    if config.get("ARCHIVE_LOCAL_DIR"):
+        return LocalArchiveWriter(config["ARCHIVE_LOCAL_DIR"], key)
+    return S3MultipartWriter(s3_client or get_s3_client(config),
+                             config["ARCHIVE_BUCKET_NAME"], key)
+
+
+def stream_csv_archive(chunks, writer) -> int:
+    """Writes the chunks as a gzipped .csv straight into the writer, compressing as it goes.
+
+    The upload is aborted if anything fails. Returns the number of rows written.
+    """
+    rows_written = 0
+    try:
+        with gzip.GzipFile(fileobj=writer, mode="wb") as gzip_file, \
+                io.TextIOWrapper(gzip_file, encoding="utf-8", newline="") as text_file:
+            for chunk in chunks:
+                chunk.to_csv(text_file, index=False, header=rows_written == 0)
+                rows_written += len(chunk)
+        if not rows_written:
+            raise ValueError("Empty DataFrame.")
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return rows_written
+
+
+def upload_parquet_partitions(archive_dir: str, file_paths: list[str],
+                              config: dict) -> None:  # pragma: no cover
+    """Uploads each Parquet partition file under the Parquet prefix of the bucket."""
+    s3_client = get_s3_client(config)
+    print("Uploading .parquet files.")
+    for file_path in file_paths:
+        s3_client.upload_file(os.path.join(archive_dir, file_path),
+                              config["ARCHIVE_BUCKET_NAME"], PARQUET_PREFIX + file_path)
+    print(f"{len(file_paths)} .parquet files uploaded.")
+
+
+def get_file_checksum(file_path: str) -> tuple[int, str]:
+    """Returns the size in bytes and the SHA-256 checksum of a local file."""
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            checksum.update(block)
+    return os.path.getsize(file_path), checksum.hexdigest()
+
+
+def get_manifest_key(day: str) -> str:
+    """Returns the key of the manifest shard for archive files starting on the day."""
+    return f"{MANIFEST_PREFIX}date={day}.json"
+
+
+def load_manifest(configuration: dict, key: str, s3_client=None) -> tuple[dict, str | None]:
+    """Returns a manifest shard and its S3 ETag, or an empty shard if it has not been created yet."""
+    empty_manifest = {"schema_version": ARCHIVE_SCHEMA_VERSION, "files": []}
+    if configuration.get("ARCHIVE_LOCAL_DIR"):
+        manifest_path = os.path.join(configuration["ARCHIVE_LOCAL_DIR"], key)
+        if not os.path.exists(manifest_path):
+            return empty_manifest, None
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            return json.load(manifest_file), None
+    try:
+        response = s3_client.get_object(Bucket=configuration["ARCHIVE_BUCKET_NAME"], Key=key)
+    except ClientError as err:
+        if err.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
+        return empty_manifest, None
+    return json.loads(response["Body"].read()), response["ETag"]
+
+
+def write_manifest(manifest: dict, configuration: dict, key: str, etag: str | None,
+                   s3_client=None) -> None:
+    """Writes a manifest shard.
+
+    On S3 the write is conditional on the ETag read, so it fails rather than
+    overwrite a shard another run changed in the meantime.
+    """
+    body = json.dumps(manifest, indent=1).encode("utf-8")
+    if configuration.get("ARCHIVE_LOCAL_DIR"):
+        manifest_path = os.path.join(configuration["ARCHIVE_LOCAL_DIR"], key)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path, "wb") as file:
+            file.write(body)
+        return
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    s3_client.put_object(Bucket=configuration["ARCHIVE_BUCKET_NAME"], Key=key,
+                         Body=body, ContentType="application/json", **condition)
+
+
+def update_manifest(entries: list[dict], configuration: dict, s3_client=None) -> None:
+    """Adds the entries to the archive manifest, replacing any with the same key.
+
+    The manifest is sharded by the date of each file's first reading, so its size
+    is bounded and a day's shard stops changing once the day is archived. Each
+    shard lists its files in time order so readers can choose which files to fetch
+    without listing the bucket. A shard another run changed since it was read is
+    read and merged again.
+    """
+    if not configuration.get("ARCHIVE_LOCAL_DIR"):
+        s3_client = s3_client or get_s3_client(configuration)
+    shards = {}
+    for entry in entries:
+        day = (entry["start"] or datetime.now().isoformat())[:10]
+        shards.setdefault(day, []).append(entry)
+    for day, day_entries in sorted(shards.items()):
+        key = get_manifest_key(day)
+        keys = {entry["key"] for entry in day_entries}
+        for attempt in range(1, MANIFEST_WRITE_ATTEMPTS + 1):
+            manifest, etag = load_manifest(configuration, key, s3_client)
+            files = [entry for entry in manifest["files"] if entry["key"] not in keys]
+            manifest["files"] = sorted(files + day_entries,
+                                       key=lambda entry: (entry["start"] or "", entry["key"]))
+            manifest["updated_at"] = datetime.now().isoformat(timespec="seconds")
+            try:
+                write_manifest(manifest, configuration, key, etag, s3_client)
+                break
+            except ClientError as err:
+                if (err.response["Error"]["Code"] not in MANIFEST_CONFLICT_CODES
+                        or attempt == MANIFEST_WRITE_ATTEMPTS):
+                    raise
+    print(f"Manifest updated with {len(entries)} files.")
+
+
+def save_rollups(conn, source: sql.Composable, archived_until: str | datetime) -> pd.DataFrame:
+    """Computes the hourly and daily rollups that the rows in source complete.
+
+    The rows are kept in plant_rollup_reading until every reading of their hour and
+    day has been archived, i.e. the period ends by archived_until. Only then is the
+    period's rollup computed from all of its readings and written to plant_rollup,
+    replacing any earlier row, so a retried run gives the same result. Gaps are
+    counted from each plant's previous reading, even when it was archived by an
+    earlier window. A late reading causes its period, and the period of the
+    reading after it, to be recomputed.
+    Returns the rollups written.
+    """
+    params = {"archived_until": archived_until, "retention": ROLLUP_RETENTION}
+    with conn.cursor() as cur:
+        cur.execute(STAGE_ROLLUP_READINGS_QUERY.format(source=source), params)
+        cur.execute(ROLLUP_QUERY, params)
+        rollups = pd.DataFrame(cur.fetchall(), columns=ROLLUP_COLUMNS)
+        cur.execute(MARK_ROLLED_UP_QUERY, params)
+    return rollups
+
+
+def get_rollup_key(archive_key: str) -> str:
+    """Returns the key of the rollup summary stored next to an archive file."""
+    return archive_key.split(".")[0] + "_rollup.csv.gz"
+
+
+def upload_rollups(rollups: pd.DataFrame, configuration: dict, key: str,
+                   s3_client=None) -> None:
+    """Uploads the rollups as a small gzipped .csv next to the raw archive."""
+    if not rollups.empty:
+        stream_csv_archive(iter([rollups]), get_archive_writer(configuration, key, s3_client))
+
+
+def archive_old_rows(conn, delete_timestamp: str, configuration: dict) -> int:
+    """Writes the rows older than the timestamp to an archive and uploads it to S3.
+
+    With ARCHIVE_MODE set to "stream" the rows are read and written in chunks
+    of ARCHIVE_FETCH_SIZE rather than all being held in memory at once.
+    Hourly and daily rollups of the rows are saved and uploaded alongside. They are
+    committed before the rows are deleted, which is safe as saving them again for
+    the same rows gives the same result.
+    Returns the number of rows archived.
+    """
+    rollups = save_rollups(conn, OLD_ROWS_SOURCE, delete_timestamp)
+    conn.commit()
+    archived_csv_filename = create_csv_filename()
+    if configuration.get("ARCHIVE_MODE") == "stream":
+        fetch_size = int(configuration.get("ARCHIVE_FETCH_SIZE", ARCHIVE_FETCH_SIZE))
+        archived_count = write_and_upload_archive(
+            stream_rows_to_be_deleted(conn, delete_timestamp, fetch_size),
+            configuration, True, archived_csv_filename)
+    else:
+        archived_count = write_and_upload_archive(
+            [create_deleted_rows_dataframe(get_rows_to_be_deleted(conn, delete_timestamp))],
+            configuration, False, archived_csv_filename)
+    upload_rollups(rollups, configuration, get_rollup_key(archived_csv_filename))
+    return archived_count
+
+
+def write_and_upload_archive(chunks, configuration: dict, streaming: bool,
+                             archived_csv_filename: str) -> int:
+    """Writes the chunks of archived rows to a file and uploads it to S3.
+
+    With ARCHIVE_FORMAT set to "parquet" the archive is written as Parquet
+    partitioned by date and species instead of a single .csv. With ARCHIVE_UPLOAD
+    set to "multipart" the .csv is gzipped and streamed straight to S3 instead of
+    being written to /tmp first.
+    Every file uploaded is then recorded in the archive manifest.
+    Returns the number of rows archived.
+    """
+    stats = ArchiveStats()
+    if configuration.get("ARCHIVE_FORMAT") == "parquet":
+        archive_dir = "/tmp/" + archived_csv_filename.removesuffix(".csv")
+        partition_stats = {}
+        archived_count, file_paths = write_parquet_partitions(
+            chunks, archive_dir, archived_csv_filename.replace(".csv", ".parquet"),
+            partition_stats)
+        upload_parquet_partitions(archive_dir, file_paths, configuration)
+        entries = [partition_stats[file_path].to_entry(
+            PARQUET_PREFIX + file_path,
+            *get_file_checksum(os.path.join(archive_dir, file_path)))
+            for file_path in file_paths]
+    elif configuration.get("ARCHIVE_UPLOAD") == "multipart":
+        writer = get_archive_writer(configuration, archived_csv_filename + ".gz")
+        archived_count = stream_csv_archive(stats.track(chunks), writer)
+        entries = [stats.to_entry(archived_csv_filename + ".gz", writer.size,
+                                  writer.checksum.hexdigest())]
+    else:
+        if streaming:
+            archived_count = write_archive_chunks(stats.track(chunks), archived_csv_filename)
+        else:
+            create_archived_csv_file(chunks[0], archived_csv_filename)
+            stats.update(chunks[0])
+            archived_count = len(chunks[0])
+        upload_csv_to_s3(archived_csv_filename, configuration)
+        entries = [stats.to_entry(archived_csv_filename,
+                                  *get_file_checksum("/tmp/" + archived_csv_filename))]
+    update_manifest(entries, configuration)
+    return archived_count
+
+
+def delete_into_archive_table(conn, delete_timestamp: str) -> int:
+    """Deletes the rows older than the timestamp into the archived_rows temporary table.
+
+    Returns the number of rows deleted.
+    """
+    with conn.cursor() as cur:
+        cur.execute(ARCHIVE_AND_DELETE_QUERY, (delete_timestamp,))
+        return cur.rowcount
+
+
+def archive_and_delete_rows(conn, delete_timestamp: str, configuration: dict) -> int:
+    """Deletes the rows older than the timestamp and archives exactly those rows.
+
+    The delete and the dimension joins run as one statement, and the delete is
+    only committed once the archive and its rollups have been uploaded, so any
+    failure leaves every row in place. Returns the number of rows archived.
+    """
+    fetch_size = int(configuration.get("ARCHIVE_FETCH_SIZE", ARCHIVE_FETCH_SIZE))
+    try:
+        print("Deleting rows to archive from RDS.")
+        deleted_count = delete_into_archive_table(conn, delete_timestamp)
+        print(f"{deleted_count} rows deleted, uploading archive.")
+        rollups = save_rollups(conn, ARCHIVED_ROWS_SOURCE, delete_timestamp)
+        archived_csv_filename = create_csv_filename()
+        archived_count = write_and_upload_archive(
+            stream_rows(conn, "SELECT * FROM archived_rows;", (), fetch_size),
+            configuration, True, archived_csv_filename)
+        upload_rollups(rollups, configuration, get_rollup_key(archived_csv_filename))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print("Archive uploaded and deletion committed.")
+    return archived_count
+
+
+def get_watermark(conn) -> datetime | None:
+    """Returns where incremental archiving should start from.
+
+    This is the saved watermark, moved forward to the hour of the oldest reading
+    so empty gaps are skipped. Returns None if there is nothing to archive.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT GREATEST(
+                (SELECT archived_until FROM archive_watermark WHERE name = %s),
+                (SELECT DATE_TRUNC('hour', MIN(recording_taken)) FROM plant));""",
+                    (WATERMARK_NAME,))
+        return cur.fetchone()[0]
+
+
+def set_watermark(conn, archived_until: datetime) -> None:
+    """Saves the time up to which rows have been archived."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO archive_watermark(name, archived_until) VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET archived_until = EXCLUDED.archived_until;""",
+                    (WATERMARK_NAME, archived_until))
+
+
+def get_archive_windows(watermark: datetime, cutoff: datetime, window: timedelta,
+                        max_windows: int = INCREMENTAL_MAX_WINDOWS) -> list[tuple]:
+    """Returns the consecutive windows from the watermark that end at or before the cutoff."""
+    windows = []
+    while watermark + window <= cutoff and len(windows) < max_windows:
+        windows.append((watermark, watermark + window))
+        watermark += window
+    return windows
+
+
+def get_incremental_key(window_start: datetime) -> str:
+    """Returns the key of the small archive file for the window starting at the given time."""
+    return (f"{INCREMENTAL_PREFIX}date={window_start:%Y-%m-%d}/"
+            f"archived_{window_start:%Y_%m_%d_%H%M}.csv.gz")
+
+
+def archive_incrementally(conn, delete_timestamp: str,
+                          configuration: dict) -> tuple[int, datetime | None]:
+    """Archives and deletes the rows past the cutoff one window at a time, from the watermark.
+
+    Each window deletes every row before its end, so late readings are picked up too.
+    The rows and their rollups are uploaded as their own small files and the
+    watermark is moved on in the same transaction, so a failed run resumes where it
+    stopped. The files of every committed window are added to the manifest once at
+    the end of the run, even if a later window fails.
+    Returns the rows archived and the time they were archived up to.
+    """
+    watermark = get_watermark(conn)
+    conn.commit()
+    if watermark is None:
+        print("No rows to archive.")
+        return 0, None
+    cutoff = datetime.strptime(delete_timestamp, "%Y-%m-%d %H:%M:%S")
+    window = timedelta(hours=float(
+        configuration.get("ARCHIVE_WINDOW_HOURS", ARCHIVE_WINDOW_HOURS)))
+    fetch_size = int(configuration.get("ARCHIVE_FETCH_SIZE", ARCHIVE_FETCH_SIZE))
+    s3_client = None if configuration.get("ARCHIVE_LOCAL_DIR") else get_s3_client(configuration)
+    archived_count = 0
+    archived_until = None
+    manifest_entries = []
+    try:
+        for window_start, window_end in get_archive_windows(watermark, cutoff, window):
+            window_entries = []
+            try:
+                archive_key = get_incremental_key(window_start)
+                deleted_count = delete_into_archive_table(conn, window_end)
+                rollups = save_rollups(conn, ARCHIVED_ROWS_SOURCE, window_end)
+                upload_rollups(rollups, configuration, get_rollup_key(archive_key), s3_client)
+                if deleted_count:
+                    stats = ArchiveStats()
+                    writer = get_archive_writer(configuration, archive_key, s3_client)
+                    archived_count += stream_csv_archive(stats.track(stream_rows(
+                        conn, "SELECT * FROM archived_rows;", (), fetch_size)), writer)
+                    window_entries.append(stats.to_entry(
+                        archive_key, writer.size, writer.checksum.hexdigest()))
+                set_watermark(conn, window_end)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            manifest_entries += window_entries
+            archived_until = window_end
+    finally:
+        if manifest_entries:
+            update_manifest(manifest_entries, configuration, s3_client)
+    print(f"{archived_count} rows archived up to {archived_until}.")
+    return archived_count, archived_until
+
+
 def select_and_delete_from_db(conn, delete_timestamp: str, configuration: dict) -> None:
     """Removes rows from the plant table that are older than a day.
 
     SELECT is performed to maintain consistency with live database interactions in the dashboard.
-    Function creates the .csv and uploads it to S3 before deleting any rows.
+    Function creates the archive and uploads it to S3 before deleting any rows.
+    Whole days are removed by dropping their partition, the remainder by a row delete.
+    With ARCHIVE_MODE set to "single_pass" the rows are deleted and archived in one
+    transaction instead, and only the emptied partitions are dropped afterwards.
+    With ARCHIVE_MODE set to "incremental" this is done in small windows from a watermark.
+    With ARCHIVE_DELETE_BATCH_SIZE set, the row delete is done in short batches followed
+    by a VACUUM of the partitions it touched.
     """
-    rows_to_delete = get_rows_to_be_deleted(conn, delete_timestamp)
+    if configuration.get("ARCHIVE_MODE") == "single_pass":
+        archive_and_delete_rows(conn, delete_timestamp, configuration)
+        drop_old_partitions(conn, delete_timestamp)
+        return
+    if configuration.get("ARCHIVE_MODE") == "incremental":
+        _, archived_until = archive_incrementally(conn, delete_timestamp, configuration)
+        if archived_until:
+            drop_old_partitions(conn, archived_until.strftime("%Y-%m-%d %H:%M:%S"))
+        return
 
-    deleted_rows_df = create_deleted_rows_dataframe(rows_to_delete)
-    archived_csv_filename = create_csv_filename()
-    create_archived_csv_file(deleted_rows_df, archived_csv_filename)
-    upload_csv_to_s3(archived_csv_filename, configuration)
+    archived_count = archive_old_rows(conn, delete_timestamp, configuration)
 
-    deleted_rows = delete_old_rows(conn, delete_timestamp)
+    deleted_count = drop_old_partitions(conn, delete_timestamp)
+    if configuration.get("ARCHIVE_DELETE_BATCH_SIZE"):
+        deleted_count += delete_old_rows_with_maintenance(conn, delete_timestamp, configuration)
+    else:
+        deleted_count += len(delete_old_rows(conn, delete_timestamp))
 
-    if len(rows_to_delete) != len(deleted_rows):
+    if archived_count != deleted_count:
         print("Inconsistency between rows being deleted and rows being archived.")
 
 
@@ -127,9 +1103,7 @@ def create_archived_csv_file(archived_df: pd.DataFrame, csv_filename: str) -> No
 
 def upload_csv_to_s3(csv_filename: str, config: dict) -> None:  # pragma: no cover
     """Uploads the created .csv file to an S3 bucket."""
-    print("Establishing connection to AWS.")
-    s3_client = client("s3", aws_access_key_id=config["ACCESS_KEY_ID"],
-                       aws_secret_access_key=config["SECRET_ACCESS_KEY"])
+    s3_client = get_s3_client(config)
     print("Connection established.")
     print("Uploading .csv file.")
     s3_client.upload_file(
@@ -142,6 +1116,7 @@ def lambda_handler(event: dict = None, context=None) -> dict:
     configuration = os.environ
     connection = get_database_connection(configuration)
 
+    create_upcoming_partitions(connection)
     timestamp = get_previous_day_timestamp()
     select_and_delete_from_db(connection, timestamp, configuration)
     return {"archive_status": "success"}
@@ -151,5 +1126,6 @@ if __name__ == "__main__":  # pragma: no cover
     configuration = dotenv_values()
     connection = get_database_connection(configuration)
 
+    create_upcoming_partitions(connection)
     timestamp = get_previous_day_timestamp()
     select_and_delete_from_db(connection, timestamp, configuration)
@@ -5,12 +5,29 @@ Unit tests for the functions relating to the archiving of data older than 24 hou
 from re import match
 from unittest.mock import patch, MagicMock
 import os
+import gzip
+import json
+import hashlib
+from datetime import datetime, timedelta
+import io
 
 import pytest
 import pandas as pd
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+from psycopg2 import OperationalError
+from psycopg2.errors import LockNotAvailable
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 
 from archive import (get_previous_day_timestamp, create_deleted_rows_dataframe,
-                     create_csv_filename, create_archived_csv_file, select_and_delete_from_db)
+                     create_csv_filename, create_archived_csv_file, select_and_delete_from_db,
+                     ConnectionManager, get_partitions_before, stream_rows_to_be_deleted,
+                     write_archive_chunks, CSV_COLUMNS, write_parquet_partitions,
+                     archive_and_delete_rows, S3MultipartWriter, LocalArchiveWriter,
+                     stream_csv_archive, get_archive_windows, archive_incrementally,
+                     ArchiveStats, update_manifest, write_and_upload_archive,
+                     get_id_batches, delete_old_rows_in_batches, create_upcoming_partitions,
+                     run_with_lock_timeout, ARCHIVED_ROWS_SOURCE, save_rollups)
 
 
 def test_timestamp_returns_string():
@@ -62,23 +79,31 @@ def test_csv_file_created():
     os.remove("/tmp/unit_test_csv.csv")
 
 
+@patch("archive.update_manifest")
+@patch("archive.get_file_checksum", return_value=(10, "fake-checksum"))
+@patch("archive.upload_rollups")
+@patch("archive.save_rollups")
 @patch("archive.get_rows_to_be_deleted")
 @patch("archive.create_deleted_rows_dataframe")
 @patch("archive.create_csv_filename")
 @patch("archive.create_archived_csv_file")
 @patch("archive.upload_csv_to_s3")
+@patch("archive.drop_old_partitions", return_value=0)
 @patch("archive.delete_old_rows")
-def test_correct_call_counts_select_and_delete(fake_delete_rows, fake_upload_csv, fake_archive_csv,
-                                               fake_csv_filename, fake_create_df, fake_get_delete_rows):
+def test_correct_call_counts_select_and_delete(fake_delete_rows, fake_drop_partitions,
+                                               fake_upload_csv, fake_archive_csv,
+                                               fake_csv_filename, fake_create_df, fake_get_delete_rows,
+                                               fake_save_rollups, fake_upload_rollups,
+                                               fake_checksum, fake_update_manifest):
     """Tests the correct functions are called by the select and delete function."""
     fake_get_delete_rows.return_value = [(1, 2), (3, 4)]
-    fake_create_df.return_value = []
+    fake_create_df.return_value = pd.DataFrame(columns=CSV_COLUMNS)
     fake_csv_filename.return_value = ""
     fake_delete_rows.return_value = [(5, 6, 7), (8, 9, 10)]
 
     conn = MagicMock()
     delete_timestamp = MagicMock()
-    configuration = MagicMock()
+    configuration = {}
 
     select_and_delete_from_db(conn, delete_timestamp, configuration)
 
@@ -88,3 +113,360 @@ def test_correct_call_counts_select_and_delete(fake_delete_rows, fake_upload_csv
     assert fake_archive_csv.call_count == 1
     assert fake_upload_csv.call_count == 1
     assert fake_delete_rows.call_count == 1
+    assert fake_drop_partitions.call_count == 1
+    assert fake_save_rollups.call_count == 1
+    assert fake_upload_rollups.call_count == 1
+    assert fake_update_manifest.call_count == 1
+
+
+@patch("archive.connect")
+def test_connection_manager_reuses_healthy_connection(fake_connect):
+    """Tests a healthy connection is reused and a closed one is replaced."""
+    fake_connect.return_value.closed = 0
+    fake_connect.return_value.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+    configuration = MagicMock()
+    manager = ConnectionManager()
+
+    first = manager.get(configuration)
+    second = manager.get(configuration)
+    assert first is second
+    assert fake_connect.call_count == 1
+
+    first.closed = 1
+    manager.get(configuration)
+    assert fake_connect.call_count == 2
+
+
+def test_only_whole_days_before_cutoff_are_dropped():
+    """Tests a partition is only dropped once its whole day is older than the cutoff."""
+    partitions = ["plant_20230830", "plant_default", "plant_20230828",
+                  "plant_20230829", "plant_20230831"]
+
+    res = get_partitions_before(partitions, "2023-08-30 00:05:00")
+
+    assert res == ["plant_20230828", "plant_20230829"]
+
+
+def test_rows_streamed_in_chunks_from_named_cursor():
+    """Tests rows are fetched from a server-side cursor one chunk at a time."""
+    conn = MagicMock()
+    row = tuple(range(len(CSV_COLUMNS)))
+    fake_cursor = conn.cursor().__enter__()
+    fake_cursor.fetchmany.side_effect = [[row, row], [row], []]
+
+    chunks = list(stream_rows_to_be_deleted(conn, "2023-08-30 00:05:00", fetch_size=2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert conn.cursor.call_args[1] == {"name": "archive_cursor"}
+    assert fake_cursor.fetchmany.call_args[0] == (2,)
+    assert conn.commit.call_count == 1
+
+
+def test_archive_chunks_written_with_one_header():
+    """Tests chunks are appended to the .csv with the header written once."""
+    chunks = [pd.DataFrame({"a": [1, 2]}), pd.DataFrame({"a": [3]})]
+
+    res = write_archive_chunks(iter(chunks), "unit_test_chunks.csv")
+
+    assert res == 3
+    assert pd.read_csv("/tmp/unit_test_chunks.csv")["a"].tolist() == [1, 2, 3]
+    os.remove("/tmp/unit_test_chunks.csv")
+
+
+def test_parquet_archive_partitioned_by_date_and_species(tmp_path):
+    """Tests each date and species gets one file, with a row group per chunk."""
+    rows = [(1, 8, "Ficus", 13.1, 94.2, "2023-08-29 13:44:00", "2023-08-29 23:59:59",
+             "full sun", "Carl Linnaeus", "Perennial"),
+            (2, 9, "Venus flytrap", 12.5, 50.0, "2023-08-30 13:50:00", "2023-08-30 00:00:01",
+             "full sun", "Gertrude Jekyll", "Perennial"),
+            (3, 10, None, 20.1, 80.0, "2023-08-30 13:50:00", "2023-08-30 00:00:02",
+             "-", "Gertrude Jekyll", None)]
+    chunks = [pd.DataFrame(rows[:2], columns=CSV_COLUMNS),
+              pd.DataFrame(rows[:1] + rows[2:], columns=CSV_COLUMNS)]
+
+    count, file_paths = write_parquet_partitions(iter(chunks), str(tmp_path), "a.parquet")
+
+    assert count == 4
+    assert file_paths == ["date=2023-08-29/species=Ficus/a.parquet",
+                          "date=2023-08-30/species=-/a.parquet",
+                          "date=2023-08-30/species=Venus%20flytrap/a.parquet"]
+    metadata = pq.ParquetFile(tmp_path / file_paths[0]).metadata
+    assert metadata.num_row_groups == 2
+    assert metadata.row_group(0).column(2).statistics.max == 13.1
+    archive = pd.read_parquet(tmp_path, columns=["plant_id", "species", "recording_taken"])
+    assert sorted(archive["species"].unique()) == ["-", "Ficus", "Venus flytrap"]
+    assert str(archive["recording_taken"].dtype) == "datetime64[us]"
+
+
+@patch("archive.write_and_upload_archive", side_effect=ConnectionError("upload failed"))
+def test_single_pass_delete_rolled_back_if_upload_fails(fake_upload):
+    """Tests the delete is rolled back rather than committed when the upload fails."""
+    conn = MagicMock()
+
+    with pytest.raises(ConnectionError):
+        archive_and_delete_rows(conn, "2023-08-30 00:05:00", {})
+
+    assert conn.commit.call_count == 0
+    assert conn.rollback.call_count == 1
+
+
+@patch("archive.upload_rollups")
+@patch("archive.save_rollups")
+@patch("archive.write_and_upload_archive", return_value=2)
+def test_single_pass_delete_committed_after_upload(fake_upload, fake_save_rollups,
+                                                   fake_upload_rollups):
+    """Tests the delete and archive share one statement and one commit."""
+    conn = MagicMock()
+
+    res = archive_and_delete_rows(conn, "2023-08-30 00:05:00", {})
+
+    assert res == 2
+    query = conn.cursor().__enter__().execute.call_args[0][0]
+    assert "WITH deleted AS (" in query and "RETURNING *" in query
+    assert fake_save_rollups.call_args[0][1:] == (
+        ARCHIVED_ROWS_SOURCE, "2023-08-30 00:05:00")
+    assert fake_upload_rollups.call_count == 1
+    assert conn.commit.call_count == 1
+
+
+def test_archive_streamed_to_s3_in_compressed_parts():
+    """Tests the gzipped .csv is uploaded in parts that join back into the full archive."""
+    fake_s3 = MagicMock()
+    fake_s3.create_multipart_upload.return_value = {"UploadId": "fake-id"}
+    fake_s3.upload_part.side_effect = lambda **kwargs: {"ETag": str(kwargs["PartNumber"])}
+    chunks = [pd.DataFrame({"entry_id": range(start, start + 2000),
+                            "temperature": [i / 7 for i in range(2000)]})
+              for start in (0, 2000)]
+    writer = S3MultipartWriter(fake_s3, "fake-bucket", "archived.csv.gz", part_size=1024)
+
+    res = stream_csv_archive(iter(chunks), writer)
+
+    assert res == 4000
+    bodies = [call[1]["Body"] for call in fake_s3.upload_part.call_args_list]
+    assert len(bodies) > 1
+    assert all(len(body) == 1024 for body in bodies[:-1])
+    archive = pd.read_csv(io.BytesIO(gzip.decompress(b"".join(bodies))))
+    assert archive["entry_id"].tolist() == list(range(4000))
+    parts = fake_s3.complete_multipart_upload.call_args[1]["MultipartUpload"]["Parts"]
+    assert [part["PartNumber"] for part in parts] == list(range(1, len(bodies) + 1))
+
+
+def test_archive_upload_aborted_on_failure(tmp_path):
+    """Tests a failed archive leaves no partial file behind."""
+    writer = LocalArchiveWriter(str(tmp_path), "archived.csv.gz")
+
+    def failing_chunks():
+        yield pd.DataFrame({"a": [1]})
+        raise ConnectionError("database went away")
+
+    with pytest.raises(ConnectionError):
+        stream_csv_archive(failing_chunks(), writer)
+
+    assert not os.listdir(tmp_path)
+
+
+def test_archive_windows_end_before_cutoff():
+    """Tests only whole windows ending by the cutoff are archived, up to the limit."""
+    watermark = datetime(2023, 8, 30, 9)
+
+    res = get_archive_windows(watermark, datetime(2023, 8, 30, 12, 20), timedelta(hours=1))
+
+    assert res == [(datetime(2023, 8, 30, 9), datetime(2023, 8, 30, 10)),
+                   (datetime(2023, 8, 30, 10), datetime(2023, 8, 30, 11)),
+                   (datetime(2023, 8, 30, 11), datetime(2023, 8, 30, 12))]
+    assert len(get_archive_windows(watermark, datetime(2023, 9, 30), timedelta(hours=1),
+                                   max_windows=5)) == 5
+
+
+@patch("archive.upload_rollups")
+@patch("archive.save_rollups")
+@patch("archive.set_watermark")
+@patch("archive.stream_csv_archive", return_value=4)
+@patch("archive.delete_into_archive_table", side_effect=[4, 0])
+@patch("archive.get_watermark", return_value=datetime(2023, 8, 30, 9))
+def test_incremental_archive_commits_each_window(fake_watermark, fake_delete, fake_stream,
+                                                 fake_set_watermark, fake_save_rollups,
+                                                 fake_upload_rollups, tmp_path):
+    """Tests each window is archived and has the watermark moved on in its own commit."""
+    conn = MagicMock()
+    configuration = {"ARCHIVE_LOCAL_DIR": str(tmp_path)}
+
+    res = archive_incrementally(conn, "2023-08-30 11:30:00", configuration)
+
+    assert res == (4, datetime(2023, 8, 30, 11))
+    assert fake_stream.call_count == 1
+    assert [call[0][2] for call in fake_save_rollups.call_args_list] == [
+        datetime(2023, 8, 30, 10), datetime(2023, 8, 30, 11)]
+    assert fake_upload_rollups.call_args_list[0][0][2] == \
+        "incremental/date=2023-08-30/archived_2023_08_30_0900_rollup.csv.gz"
+    assert [call[0][1] for call in fake_set_watermark.call_args_list] == [
+        datetime(2023, 8, 30, 10), datetime(2023, 8, 30, 11)]
+    assert conn.commit.call_count == 3
+    shard, = os.listdir(tmp_path / "manifest")
+    with open(tmp_path / "manifest" / shard, encoding="utf-8") as manifest_file:
+        assert len(json.load(manifest_file)["files"]) == 1
+
+
+
+def test_archive_stats_combine_chunks():
+    """Tests the time range and metric ranges cover every chunk, ignoring missing values."""
+    stats = ArchiveStats()
+    for chunk in stats.track(iter([
+            pd.DataFrame({"recording_taken": ["2023-08-30 10:00:00", "2023-08-30 10:01:00"],
+                          "temperature": [12.5, 14.0], "soil_moisture": [None, None]}),
+            pd.DataFrame({"recording_taken": ["2023-08-30 09:59:00"],
+                          "temperature": [11.0], "soil_moisture": [30.0]})])):
+        pass
+
+    res = stats.to_entry("archived.csv.gz", 100, "fake-checksum")
+
+    assert res["rows"] == 3
+    assert res["start"] == "2023-08-30T09:59:00"
+    assert res["end"] == "2023-08-30T10:01:00"
+    assert res["metrics"] == {"temperature": {"min": 11.0, "max": 14.0},
+                              "soil_moisture": {"min": 30.0, "max": 30.0}}
+
+
+def test_manifest_lists_archive_with_checksum(tmp_path):
+    """Tests an archive is added to the manifest with its size and checksum, replacing reruns."""
+    configuration = {"ARCHIVE_LOCAL_DIR": str(tmp_path), "ARCHIVE_UPLOAD": "multipart"}
+    chunk = pd.DataFrame({"entry_id": [1, 2], "temperature": [12.5, 14.0],
+                          "recording_taken": [datetime(2023, 8, 30, 10),
+                                              datetime(2023, 8, 30, 11)]})
+    update_manifest([{"key": "older.csv", "start": "2023-08-30T09:00:00"},
+                     {"key": "oldest.csv", "start": "2023-08-28T00:00:00"}], configuration)
+
+    write_and_upload_archive(iter([chunk]), configuration, True, "archived.csv")
+    write_and_upload_archive(iter([chunk]), configuration, True, "archived.csv")
+
+    with open(tmp_path / "manifest" / "date=2023-08-30.json", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert [entry["key"] for entry in manifest["files"]] == ["older.csv", "archived.csv.gz"]
+    assert sorted(os.listdir(tmp_path / "manifest")) == ["date=2023-08-28.json",
+                                                         "date=2023-08-30.json"]
+    entry = manifest["files"][1]
+    archive_bytes = (tmp_path / "archived.csv.gz").read_bytes()
+    assert entry["bytes"] == len(archive_bytes)
+    assert entry["sha256"] == hashlib.sha256(archive_bytes).hexdigest()
+    assert entry["rows"] == 2
+    assert entry["start"] == "2023-08-30T10:00:00"
+
+
+def test_id_batches_cover_range_once():
+    """Tests the id ranges are bounded by the batch size and cover every id once."""
+    res = get_id_batches(3, 12, 4)
+
+    assert res == [(3, 7), (7, 11), (11, 13)]
+
+
+@patch("archive.time.sleep")
+@patch("archive.get_entry_id_range", return_value=(1, 10))
+def test_batched_delete_commits_each_batch(fake_id_range, fake_sleep):
+    """Tests each batch is deleted in its own transaction with a pause in between."""
+    conn = MagicMock()
+    conn.cursor().__enter__().rowcount = 4
+
+    res = delete_old_rows_in_batches(conn, "2023-08-30 00:05:00", 4, pause_seconds=0.5)
+
+    assert res == 12
+    deletes = [call[0][1] for call in conn.cursor().__enter__().execute.call_args_list
+               if "DELETE" in call[0][0]]
+    assert [params[:2] for params in deletes] == [(1, 5), (5, 9), (9, 11)]
+    assert conn.commit.call_count == 4
+    assert fake_sleep.call_count == 3
+
+
+def test_failed_partition_day_does_not_stop_the_others():
+    """Tests a partition that cannot be created is rolled back and the next day still created."""
+    conn = MagicMock()
+    cursor = conn.cursor().__enter__()
+    cursor.execute.side_effect = [None, OperationalError("default partition"), None, None]
+
+    create_upcoming_partitions(conn, days_ahead=1)
+
+    assert conn.rollback.call_count == 1
+    assert conn.commit.call_count == 1
+
+
+@patch("archive.time.sleep")
+def test_lock_timeout_retried_with_backoff(fake_sleep):
+    """Tests a statement that times out waiting for a lock is retried after a growing delay."""
+    conn = MagicMock()
+    cursor = conn.cursor().__enter__()
+    cursor.rowcount = 7
+    cursor.execute.side_effect = [None, LockNotAvailable(), None, LockNotAvailable(),
+                                  None, None]
+
+    res = run_with_lock_timeout(conn, [("DELETE FROM plant;", None)], retry_delay=0.5)
+
+    assert res == 7
+    assert conn.rollback.call_count == 2
+    assert conn.commit.call_count == 1
+    assert [call[0][0] for call in fake_sleep.call_args_list] == [0.5, 1.0]
+
+
+@patch("archive.time.sleep")
+def test_lock_timeout_raised_once_attempts_run_out(fake_sleep):
+    """Tests the lock error is raised after the last attempt."""
+    conn = MagicMock()
+    conn.cursor().__enter__().execute.side_effect = [None, LockNotAvailable()] * 2
+
+    with pytest.raises(LockNotAvailable):
+        run_with_lock_timeout(conn, [("DELETE FROM plant;", None)], attempts=2)
+
+    assert fake_sleep.call_count == 1
+
+
+def test_rollups_staged_then_computed_for_complete_periods():
+    """Tests the archived rows are kept, the completed periods rolled up and the rows marked."""
+    conn = MagicMock()
+    cursor = conn.cursor().__enter__()
+    cursor.fetchall.return_value = []
+
+    res = save_rollups(conn, ARCHIVED_ROWS_SOURCE, "2023-08-30 00:05:00")
+
+    assert res.empty
+    queries = [call[0][0] for call in cursor.execute.call_args_list]
+    assert "INSERT INTO plant_rollup_reading" in repr(queries[0])
+    assert "INSERT INTO plant_rollup SELECT" in queries[1]
+    assert "UPDATE plant_rollup_reading" in queries[2]
+    assert all(call[0][1]["archived_until"] == "2023-08-30 00:05:00"
+               for call in cursor.execute.call_args_list)
+
+
+def test_manifest_shard_merged_again_after_conflicting_write():
+    """Tests a shard changed by another run since it was read is re-read and merged."""
+    fake_s3 = MagicMock()
+    fake_s3.get_object.side_effect = [
+        {"Body": io.BytesIO(b'{"files": []}'), "ETag": "first"},
+        {"Body": io.BytesIO(b'{"files": [{"key": "other.csv", "start": "2023-08-30T08:00:00"}]}'),
+         "ETag": "second"}]
+    fake_s3.put_object.side_effect = [
+        ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject"), None]
+    configuration = {"ARCHIVE_BUCKET_NAME": "fake-bucket"}
+
+    update_manifest([{"key": "archived.csv.gz", "start": "2023-08-30T10:00:00"}],
+                    configuration, fake_s3)
+
+    first_put, second_put = fake_s3.put_object.call_args_list
+    assert first_put[1]["IfMatch"] == "first"
+    assert second_put[1]["Key"] == "manifest/date=2023-08-30.json"
+    assert second_put[1]["IfMatch"] == "second"
+    assert [entry["key"] for entry in json.loads(second_put[1]["Body"])["files"]] == [
+        "other.csv", "archived.csv.gz"]
+
+
+@patch("archive.time.sleep")
+@patch("archive.get_entry_id_range", return_value=(1, 8))
+def test_batched_delete_retries_locked_batch(fake_id_range, fake_sleep):
+    """Tests a batch that times out on a lock is retried and its rows counted once."""
+    conn = MagicMock()
+    cursor = conn.cursor().__enter__()
+    cursor.rowcount = 4
+    cursor.execute.side_effect = [None, None, None, LockNotAvailable(), None, None]
+
+    res = delete_old_rows_in_batches(conn, "2023-08-30 00:05:00", 4)
+
+    assert res == 8
+    assert conn.rollback.call_count == 1
+    assert fake_sleep.call_count == 1
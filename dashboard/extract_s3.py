@@ -1,10 +1,18 @@
 """Extracts the archived csv files from bucket 
 into the archived_data folder.
 """
+import json
+from datetime import datetime, timedelta
 from os import environ, path, makedirs
 from dotenv import load_dotenv
 from boto3 import client
 from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+
+MANIFEST_PREFIX = "manifest/"
+MANIFEST_LOOKBACK_DAYS = 1
+ARCHIVE_EXTENSIONS = (".csv", ".csv.gz", ".parquet")
+ARCHIVE_DAYS = 7
 
 
 def get_all_items_in_bucket(s3_client: BaseClient, bucket_name: str) -> list[str]:
@@ -19,8 +27,16 @@ def download_file_from_bucket(s3_client: BaseClient, bucket_name,
     s3_client.download_file(bucket_name, object_key, destination_path)
 
 
+def get_destination_path(dst_folder: str, object_key: str) -> str:
+    """Returns where to download an object, keeping its folders so Parquet
+    files of different partitions don't overwrite each other."""
+    destination_path = path.join(dst_folder, object_key)
+    makedirs(path.dirname(destination_path), exist_ok=True)
+    return destination_path
+
+
 def download_csv_files_(s3_client: BaseClient, bucket_name: str,
-                        filter_by: str, extension: str, dst_folder: str) -> str:
+                        filter_by: str, extension: str | tuple, dst_folder: str) -> str:
     """Downloads relevant files from S3 to a data/ folder."""
     files = get_all_items_in_bucket(s3_client, bucket_name)
 
@@ -28,14 +44,97 @@ def download_csv_files_(s3_client: BaseClient, bucket_name: str,
     makedirs(dst_folder, exist_ok=True)
 
     for file in files:
-        if filter_by in file and file.endswith(extension):
-            destination_path = f"{dst_folder}/{path.basename(file)}"
+        if filter_by in file and file.endswith(extension) and "_rollup" not in file:
+            destination_path = get_destination_path(dst_folder, file)
             download_file_from_bucket(
                 s3_client, bucket_name, file, destination_path)
             downloaded_file_paths.append(destination_path)
     print("Downloaded files:", downloaded_file_paths)
 
 
+def get_manifest_keys(manifest_keys: list[str], start: str = None, end: str = None) -> list[str]:
+    """Returns the manifest shards, one per day, that can list files covering start to end.
+
+    A file is listed under the day of its first reading, so shards from
+    MANIFEST_LOOKBACK_DAYS before start are kept for files that run into it.
+    """
+    first_day = None
+    if start is not None:
+        first_day = (datetime.fromisoformat(start)
+                     - timedelta(days=MANIFEST_LOOKBACK_DAYS)).date().isoformat()
+    last_day = None if end is None else end[:10]
+    selected = []
+    for key in sorted(manifest_keys):
+        day = key.removeprefix(f"{MANIFEST_PREFIX}date=").removesuffix(".json")
+        if (first_day is None or day >= first_day) and (last_day is None or day <= last_day):
+            selected.append(key)
+    return selected
+
+
+def get_manifest(s3_client: BaseClient, bucket_name: str,
+                 start: str = None, end: str = None) -> dict | None:
+    """Returns the archive manifest entries from the shards covering start to end,
+    or None if the bucket does not have a manifest."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    manifest_keys = [obj["Key"]
+                     for page in paginator.paginate(Bucket=bucket_name, Prefix=MANIFEST_PREFIX)
+                     for obj in page.get("Contents", [])]
+    if not manifest_keys:
+        return None
+    files = []
+    for key in get_manifest_keys(manifest_keys, start, end):
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=key)
+        except ClientError as err:
+            if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                continue
+            raise
+        files += json.loads(response["Body"].read())["files"]
+    return {"files": files}
+
+
+def get_archive_start(days: int = ARCHIVE_DAYS) -> str:
+    """Returns the ISO timestamp the given number of days ago."""
+    return (datetime.now() - timedelta(days=days)).isoformat(timespec="seconds")
+
+
+def get_files_to_download(manifest: dict, extension: str | tuple,
+                          start: str = None, end: str = None) -> list[dict]:
+    """Returns the manifest entries with the extension whose readings overlap start to end.
+
+    start and end are ISO format timestamps and either can be left out.
+    """
+    return [entry for entry in manifest["files"]
+            if entry["key"].endswith(extension)
+            and (start is None or entry["end"] is None or entry["end"] >= start)
+            and (end is None or entry["start"] is None or entry["start"] <= end)]
+
+
+def download_archived_files(s3_client: BaseClient, bucket_name: str, extension: str | tuple,
+                            dst_folder: str, start: str = None, end: str = None) -> None:
+    """Downloads the archive files listed in the manifest that cover the time range.
+
+    Files already downloaded with the same size are skipped. Falls back to
+    listing the bucket if there is no manifest.
+    """
+    manifest = get_manifest(s3_client, bucket_name, start, end)
+    if manifest is None:
+        download_csv_files_(s3_client, bucket_name, "archived", extension, dst_folder)
+        return
+
+    downloaded_file_paths = []
+    makedirs(dst_folder, exist_ok=True)
+
+    for entry in get_files_to_download(manifest, extension, start, end):
+        destination_path = get_destination_path(dst_folder, entry["key"])
+        if path.exists(destination_path) and path.getsize(destination_path) == entry["bytes"]:
+            continue
+        download_file_from_bucket(
+            s3_client, bucket_name, entry["key"], destination_path)
+        downloaded_file_paths.append(destination_path)
+    print("Downloaded files:", downloaded_file_paths)
+
+
 if __name__ == "__main__":
 
     load_dotenv()
@@ -45,5 +144,6 @@ if __name__ == "__main__":
                 aws_secret_access_key=environ.get("SECRET_ACCESS_KEY")
                 )
 
-    download_csv_files_(
-        s3, environ.get("BUCKET_NAME"), "archived", ".csv", "archived_data")
+    download_archived_files(
+        s3, environ.get("BUCKET_NAME"), ARCHIVE_EXTENSIONS, "archived_data",
+        start=get_archive_start(int(environ.get("ARCHIVE_DAYS", ARCHIVE_DAYS))))
@@ -6,7 +6,7 @@ from dotenv import load_dotenv
 from boto3 import client
 import streamlit as st
 
-from extract_s3 import download_csv_files_
+from extract_s3 import download_archived_files, get_archive_start, ARCHIVE_EXTENSIONS, ARCHIVE_DAYS
 from streamlit_app import get_db_connection, switch_data, dashboard_header, handle_sidebar_options
 
 
@@ -18,8 +18,9 @@ if __name__ == "__main__":
                 aws_secret_access_key=environ.get("SECRET_ACCESS_KEY")
                 )
 
-    download_csv_files_(
-        s3, environ.get("BUCKET_NAME"), "archived", ".csv", "archived_data")
+    download_archived_files(
+        s3, environ.get("BUCKET_NAME"), ARCHIVE_EXTENSIONS, "archived_data",
+        start=get_archive_start(int(environ.get("ARCHIVE_DAYS", ARCHIVE_DAYS))))
 
     connection = get_db_connection()
     plant_data = switch_data(connection)
@@ -4,33 +4,97 @@ Module contains code for connecting to postgres database (RDS)
 and using that data to create charts for data analysis.
 """
 import sys
-from os import environ, path, listdir
+from os import environ, path, walk
+from urllib.parse import unquote
 import pandas as pd
 import streamlit as st
 import matplotlib.pyplot as plt
 import seaborn as sns
 from psycopg2 import connect, Error
-from psycopg2.extensions import connection
+from psycopg2.extensions import connection, TRANSACTION_STATUS_IDLE
 from dotenv import load_dotenv
 
+from extract_s3 import ARCHIVE_EXTENSIONS
+
 CSV_COLUMNS = [
     "entry_id", "species", "temperature", "soil_moisture",
     "last_watered", "recording_taken", "sunlight", "botanist_name", "cycle"
 ]
+CONNECT_TIMEOUT = 5
+STATEMENT_TIMEOUT_MS = 30000
+KEEPALIVE_OPTIONS = {"keepalives": 1, "keepalives_idle": 30,
+                     "keepalives_interval": 10, "keepalives_count": 3}
+
+
+class ConnectionManager:
+    """Keeps one database connection open between Streamlit reruns.
+
+    The same class is copied into each deployable, and live_pipeline/test_pipeline.py
+    checks the copies match, so change them together.
+    """
+
+    def __init__(self):
+        """Creates a manager with no open connection."""
+        self.connection = None
+
+    def is_healthy(self) -> bool:
+        """Checks the open connection still works with a single cheap query.
+
+        Called at the start of each invocation, so any transaction still open was
+        left behind by an earlier invocation that was aborted. It is rolled back
+        rather than carried into this one.
+        """
+        if self.connection is None or self.connection.closed:
+            return False
+        try:
+            if self.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                self.connection.rollback()
+            autocommit = self.connection.autocommit
+            self.connection.autocommit = True
+            with self.connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+            self.connection.autocommit = autocommit
+            return True
+        except Error:
+            return False
+
+    def get(self, config: dict):
+        """Returns the open connection, reconnecting if it is missing or broken."""
+        if not self.is_healthy():
+            self.close()
+            self.connection = connect(
+                user=config['DATABASE_USERNAME'],
+                password=config['DATABASE_PASSWORD'],
+                host=config['DATABASE_IP'],
+                port=config['DATABASE_PORT'],
+                database=config['DATABASE_NAME'],
+                connect_timeout=CONNECT_TIMEOUT,
+                options=f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",
+                **KEEPALIVE_OPTIONS)
+        return self.connection
+
+    def close(self) -> None:
+        """Closes the connection if one is open."""
+        if self.connection is not None and not self.connection.closed:
+            try:
+                self.connection.close()
+            except Error:
+                pass
+        self.connection = None
+
+
+@st.cache_resource
+def get_connection_manager() -> ConnectionManager:
+    """Returns the connection manager shared between reruns."""
+    return ConnectionManager()
 
 
 def get_db_connection():
-    """Establishes a connection with the PostgreSQL database."""
+    """Returns the shared connection with the PostgreSQL database,
+    reconnecting if it has been dropped."""
     try:
-        conn = connect(
-            user=environ.get("DATABASE_USERNAME"),
-            password=environ.get("DATABASE_PASSWORD"),
-            host=environ.get("DATABASE_IP"),
-            port=environ.get("DATABASE_PORT"),
-            database=environ.get("DATABASE_NAME"),)
-        print("Database connection established successfully.")
-        return conn
-    except Error as err:
+        return get_connection_manager().get(environ)
+    except (KeyError, Error) as err:
         print("Error connecting to database: ", err)
         sys.exit()
 
@@ -59,6 +123,7 @@ def get_live_database(conn: connection) -> pd.DataFrame:
     with conn.cursor() as cur:
         cur.execute(query)
         data = cur.fetchall()
+    conn.commit()
 
     data_df = pd.DataFrame(data, columns=CSV_COLUMNS)
     data_df["last_watered"] = pd.to_datetime(data_df["last_watered"])
@@ -67,19 +132,40 @@ def get_live_database(conn: connection) -> pd.DataFrame:
     return data_df
 
 
+def get_archive_files(folder: str = "archived_data") -> list[str]:
+    """Returns the archived files in the folder and its subfolders,
+    relative to the folder."""
+    return sorted(path.relpath(path.join(root, name), folder)
+                  for root, _, names in walk(folder) for name in names
+                  if name.endswith(ARCHIVE_EXTENSIONS) and "_rollup" not in name)
+
+
+def read_archive(file_path: str) -> pd.DataFrame:
+    """Reads an archived .csv, .csv.gz or .parquet file.
+
+    Parquet archives keep the species in their species= folder name,
+    so it is added back as a column."""
+    if not file_path.endswith(".parquet"):
+        return pd.read_csv(file_path)
+    data = pd.read_parquet(file_path)
+    for folder in path.dirname(file_path).split(path.sep):
+        if folder.startswith("species="):
+            data["species"] = unquote(folder.removeprefix("species="))
+    return data
+
+
 def get_selected_archive() -> pd.DataFrame:
     """Creates the dropdown and which archived file 
     to select and return for display."""
     with st.sidebar:
         st.sidebar.title("Dropdown")
 
-        csv_files = [f for f in listdir(
-            "archived_data") if f.endswith('.csv')]
+        archive_files = get_archive_files()
 
-        # Dropdown to select a csv file.
-        selected_csv = st.selectbox(
-            "Select an archived file.", csv_files, on_change=on_toggle_or_archive_change)
-        data = pd.read_csv(path.join("archived_data", selected_csv))
+        # Dropdown to select an archived file.
+        selected_file = st.selectbox(
+            "Select an archived file.", archive_files, on_change=on_toggle_or_archive_change)
+        data = read_archive(path.join("archived_data", selected_file))
     return data
 
 
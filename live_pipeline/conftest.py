@@ -0,0 +1,59 @@
+"""Libraries required for testing the pipeline"""
+import time
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def alert_state_path(tmp_path_factory, monkeypatch):
+    """Keeps the alert state saved by transform() out of the real /tmp"""
+    state_path = str(tmp_path_factory.mktemp("state") / "alert_state.json")
+    monkeypatch.setenv("ALERT_STATE", state_path)
+    return state_path
+
+
+@pytest.fixture
+def utc_timezone(monkeypatch):
+    """Runs a test with the process timezone set to UTC, restoring it afterwards"""
+    with monkeypatch.context() as patch:
+        patch.setenv("TZ", "UTC")
+        time.tzset()
+        yield
+    time.tzset()
+
+
+@pytest.fixture
+def fake_api_data():
+    return {
+        8: {
+            "botanist": {
+                "email": "carl.linnaeus@lnhm.co.uk",
+                "name": "carl linnaeus",
+                "phone": "(146)994-1635x35992"
+            },
+            "cycle": "Perennial",
+            "last_watered": "Thu, 31 Aug 2023 13:44:00 GMT",
+            "name": "Ficus",
+            "plant_id": 8,
+            "recording_taken": "2023-08-31 15:20:15",
+            "scientific_name": ["Ficus carica"],
+            "soil_moisture": 94.25274582786069,
+            "sunlight": ["part sun/part shade", "full sun"],
+            "temperature": 13.055716804469082
+        },
+        9: {
+            "botanist": {
+                "email": "gertrude.jekyll@lnhm.co.uk",
+                "name": "gertrude jekyll",
+                "phone": "001-481-273-3691x127"
+            },
+            "cycle": "Perennial",
+            "last_watered": "Thu, 31 Aug 2023 13:50:00 GMT",
+            "name": "Venus flytrap",
+            "plant_id": 9,
+            "recording_taken": "2023-08-31 15:20:16",
+            "scientific_name": ["Dionaea muscipula"],
+            "soil_moisture": 2.5,
+            "sunlight": ["full sun"],
+            "temperature": 12.5
+        }
+    }
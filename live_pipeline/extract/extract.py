@@ -1,12 +1,20 @@
 """
 Extract the plant data from the api into a dictionary.
 Exports found data to Json is there to make it easy to view but can be removed.
-Exports missing data to json for logging purposes. (Useful to keep)
+Prints missing data as json lines once per run for logging purposes. (Useful to keep)
 """
 from datetime import datetime
 import json
 import time
+import random
+import hashlib
+from operator import itemgetter
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from boto3 import client
+from botocore.exceptions import BotoCoreError, ClientError
 
 """
 I'd log the error if a single endpoint returns 500. 
@@ -17,25 +25,99 @@ this should stop the pipeline script from running (and alert/log something)
 START_ID = 1
 END_ID = 51
 URL = f"https://data-eng-plants-api.herokuapp.com/plants/"
+MAX_WORKERS = 10
+REQUEST_TIMEOUT = 10
+RETRY_ATTEMPTS = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 4
+DEFAULT_DEADLINE = 90
+DEADLINE_MARGIN = 30
+BREAKER_MIN_CALLS = 10
+BREAKER_FAILURE_RATIO = 0.8
+DISCOVERY_WINDOW = 10
+DISCOVERY_TTL = 3600
+DISCOVERY_MAX_WINDOWS = 20
+FAILURE_COUNTERS = "plant_failures.json"
+FAILURE_COUNTERS_KEY = "plant_failures_{shard_index}_of_{shard_count}.json"
+CHRONIC_MISSING = 5
+CHRONIC_POLL_INTERVAL = 900
+LAST_SEEN_INDEX = "last_seen_readings.json"
+DISCOVERY_CACHE = "plant_id_range.json"
 
 
-def logs(plant_id: int, missing_plants: dict, code: int) -> None:
-    """Logs the missing plant id and the current datetime to a json file."""
+class FailureLog:
+    """Buffers failed plant requests in memory so they can be logged once per run.
 
-    current_datetime = datetime.now()
+    Also keeps per-plant failure counters so chronically missing plants are
+    polled less often."""
 
-    if code == 404:
-        missing_plants[str(current_datetime)
-                       ] = f"Data not found for plant_id {plant_id}, 404"
-    elif code == 500:
-        missing_plants[str(current_datetime)
-                       ] = f"Server error for plant_id {plant_id}, 500"
+    def __init__(self, counters: dict = None, bucket: str = None, key: str = None):
+        """Creates a new FailureLog with the counters from previous runs.
 
+        The counters are saved to key in the bucket if one is given."""
+        self.events = []
+        self.counters = counters or {}
+        self.bucket = bucket
+        self.key = key
+
+    def record(self, plant_id: int, code: int | None, latency: float) -> None:
+        """Records a failed request for a plant."""
+        self.events.append({"plant_id": plant_id, "code": code,
+                            "latency": round(latency, 3),
+                            "timestamp": str(datetime.now())})
+        counter = self.counters.setdefault(
+            str(plant_id), {"missing": 0, "failures": 0, "last_attempt": 0})
+        counter["failures"] += 1
+        counter["last_attempt"] = time.time()
+        if code == 404:
+            counter["missing"] += 1
+
+    def record_success(self, plant_id: int) -> None:
+        """Resets the consecutive missing count for a plant that responded."""
+        if str(plant_id) in self.counters:
+            self.counters[str(plant_id)]["missing"] = 0
+
+    def should_poll(self, plant_id: int) -> bool:
+        """Returns False for chronically missing plants polled within CHRONIC_POLL_INTERVAL."""
+        counter = self.counters.get(str(plant_id))
+        if counter is None or counter["missing"] < CHRONIC_MISSING:
+            return True
+        return time.time() - counter["last_attempt"] >= CHRONIC_POLL_INTERVAL
+
+    def flush(self, counters_path: str = FAILURE_COUNTERS) -> None:
+        """Prints the buffered events as JSON lines and saves the counters.
+
+        Lambda sends stdout to CloudWatch Logs, so the events outlive /tmp. The
+        counters go to the bucket if one is set, otherwise to counters_path."""
+        for event in self.events:
+            print(json.dumps({"event": "plant_request_failed", **event}))
+        self.events = []
+        try:
+            if self.bucket:
+                client("s3").put_object(Bucket=self.bucket, Key=self.key,
+                                        Body=json.dumps(self.counters).encode("utf-8"))
+            else:
+                with open(counters_path, 'w', encoding="utf-8") as file:
+                    json.dump(self.counters, file)
+        except (OSError, BotoCoreError, ClientError) as err:
+            print(f"An error occurred while saving the failure counters: {err}")
+
+
+def load_failure_log(counters_path: str = FAILURE_COUNTERS, bucket: str = None,
+                     shard_index: int = 0, shard_count: int = 1) -> FailureLog:
+    """Returns a FailureLog holding the failure counters saved by earlier runs.
+
+    The counters are read from the bucket if one is given, otherwise from counters_path.
+    Each shard keeps its own object, so concurrent shards don't overwrite each other."""
+    key = FAILURE_COUNTERS_KEY.format(shard_index=shard_index, shard_count=shard_count)
     try:
-        with open("missing_plants.json", 'w') as file:
-            json.dump(missing_plants, file, indent=4)
-    except Exception as e:
-        print(f"An error occurred while writing to the file: {e}")
+        if bucket:
+            body = client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+            return FailureLog(json.loads(body.read()), bucket, key)
+        with open(counters_path, 'r', encoding="utf-8") as file:
+            return FailureLog(json.load(file))
+    except (OSError, ValueError, BotoCoreError, ClientError):
+        return FailureLog(bucket=bucket, key=key)
 
 
 class APIError(Exception):
@@ -47,32 +129,279 @@ class APIError(Exception):
         self.code = code
 
 
-def get_plants() -> dict:
-    """ Hit's each endpoint and fetches all the available plant data"""
-    plants = {}
-    missing_plants = {}
+def create_session(max_workers: int = MAX_WORKERS) -> requests.Session:
+    """Returns a keep-alive session with a connection pool sized to the worker count."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_plant(session: requests.Session, plant_id: int,
+                timeout: float = REQUEST_TIMEOUT) -> requests.Response:
+    """Fetches the data for a single plant over the shared session."""
+    return session.get(f"{URL}{plant_id}", timeout=timeout)
+
+
+class CircuitBreaker:
+    """Stops calls to the API once most of the calls made have failed."""
+
+    def __init__(self, min_calls: int = BREAKER_MIN_CALLS,
+                 failure_ratio: float = BREAKER_FAILURE_RATIO):
+        """Creates a new closed CircuitBreaker."""
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.calls = 0
+        self.failures = 0
+        self.lock = Lock()
+
+    def record(self, success: bool) -> None:
+        """Records the outcome of a single call."""
+        with self.lock:
+            self.calls += 1
+            if not success:
+                self.failures += 1
+
+    @property
+    def is_open(self) -> bool:
+        """True when enough calls have failed that the API should be left alone."""
+        with self.lock:
+            return (self.calls >= self.min_calls
+                    and self.failures / self.calls >= self.failure_ratio)
+
+
+def get_deadline(context=None) -> float:
+    """Returns the monotonic time by which extraction must finish.
+
+    Uses the Lambda context's remaining time, keeping DEADLINE_MARGIN seconds
+    back for transform and load."""
+    if context is None:
+        return time.monotonic() + DEFAULT_DEADLINE
+    remaining = context.get_remaining_time_in_millis() / 1000
+    return time.monotonic() + remaining - DEADLINE_MARGIN
+
+
+def get_backoff(attempt: int) -> float:
+    """Returns a full-jitter exponential backoff delay for the given attempt."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def fetch_plant_with_retry(session: requests.Session, plant_id: int, timeout: float,
+                           deadline: float, breaker: CircuitBreaker) -> requests.Response | None:
+    """Fetches a plant, retrying server errors and failed requests until the deadline.
+
+    Returns None if no response was received."""
+    response = None
+    for attempt in range(RETRY_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or breaker.is_open:
+            break
+        try:
+            response = fetch_plant(session, plant_id, min(timeout, remaining))
+        except requests.exceptions.RequestException as err:
+            print(f"Request for plant_id {plant_id} failed - {err}")
+            response = None
+        success = response is not None and response.status_code < 500
+        breaker.record(success)
+        if success:
+            return response
+        delay = get_backoff(attempt)
+        if attempt + 1 < RETRY_ATTEMPTS and time.monotonic() + delay < deadline:
+            time.sleep(delay)
+    return response
+
+
+def discover_end_id(session: requests.Session, end_id: int = END_ID,
+                    window: int = DISCOVERY_WINDOW, timeout: float = REQUEST_TIMEOUT,
+                    deadline: float = None, breaker: CircuitBreaker = None,
+                    max_windows: int = DISCOVERY_MAX_WINDOWS) -> int:
+    """Grows the plant ID range until a whole window of IDs past the end has no plant.
+
+    Only a 200 counts as a plant. The search keeps the range found so far and stops
+    after max_windows windows, at the deadline, or once the circuit breaker opens."""
+    if deadline is None:
+        deadline = get_deadline()
+    if breaker is None:
+        breaker = CircuitBreaker()
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        for _ in range(max_windows):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or breaker.is_open:
+                print(f"Plant ID discovery stopped early at {end_id}")
+                return end_id
+            probe_ids = range(end_id, end_id + window)
+            statuses = list(executor.map(
+                lambda plant_id: probe_plant(session, plant_id, min(timeout, remaining)),
+                probe_ids))
+            for status in statuses:
+                breaker.record(status is not None and status < 500)
+            found = [plant_id for plant_id, status in zip(probe_ids, statuses)
+                     if status == 200]
+            if not found:
+                return end_id
+            end_id = max(found) + 1
+    print(f"Plant ID discovery reached the limit of {max_windows} windows at {end_id}")
+    return end_id
+
+
+def probe_plant(session: requests.Session, plant_id: int, timeout: float) -> int | None:
+    """Returns the status code for a plant ID, or None if the request failed."""
     try:
-        for plant_id in range(START_ID, END_ID):
-            response = requests.get(
-                f"{URL}{plant_id}")
-            if response.status_code == 200:
-                json = response.json()
-                plants[plant_id] = json
-            elif response.status_code == 404:
-                logs(plant_id, missing_plants, response.status_code)
-            elif response.status_code == 500:
-                print(f"500 for {plant_id}")
-                logs(plant_id, missing_plants, response.status_code)
-
-        return plants
-    except requests.exceptions.RequestException as err:
-        raise APIError(f"An exception occurred - {str(err)}")
+        return fetch_plant(session, plant_id, timeout).status_code
+    except requests.exceptions.RequestException:
+        return None
+
+
+def load_id_range_cache(cache_path: str = DISCOVERY_CACHE) -> dict:
+    """Returns the cached end of the plant ID range, or an empty dict if there is none."""
+    try:
+        with open(cache_path, 'r', encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_id_range_cache(end_id: int, cache_path: str = DISCOVERY_CACHE) -> None:
+    """Caches the discovered end of the plant ID range for later runs."""
+    try:
+        with open(cache_path, 'w', encoding="utf-8") as file:
+            json.dump({"end_id": end_id, "discovered_at": time.time()}, file)
+    except OSError as err:
+        print(f"An error occurred while writing to the file: {err}")
+
+
+def get_plant_ids(shard_index: int = 0, shard_count: int = 1,
+                  cache_path: str = DISCOVERY_CACHE, deadline: float = None) -> list[int]:
+    """Returns the plant IDs belonging to this shard.
+
+    The end of the ID range is rediscovered, within the run's deadline, once the
+    cached value is older than DISCOVERY_TTL. IDs are split by modulo so shards
+    never overlap."""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("Shard index must be between 0 and the shard count")
+
+    cached = load_id_range_cache(cache_path)
+    end_id = cached.get("end_id")
+    if end_id is None or time.time() - cached["discovered_at"] > DISCOVERY_TTL:
+        with create_session(DISCOVERY_WINDOW) as session:
+            end_id = discover_end_id(session, max(end_id or END_ID, END_ID),
+                                     deadline=deadline)
+        save_id_range_cache(end_id, cache_path)
+
+    return [plant_id for plant_id in range(START_ID, end_id)
+            if plant_id % shard_count == shard_index]
+
+
+def iter_plants(plant_ids: list[int] = None, max_workers: int = MAX_WORKERS,
+                timeout: float = REQUEST_TIMEOUT, deadline: float = None,
+                failure_log: FailureLog = None):
+    """Hits each endpoint concurrently, yielding each plant ID and its data as soon as it arrives.
+
+    Plants that still fail after retrying are recorded in the failure log and skipped."""
+    if plant_ids is None:
+        plant_ids = range(START_ID, END_ID)
+    if deadline is None:
+        deadline = get_deadline()
+    if failure_log is None:
+        failure_log = FailureLog()
+    plant_ids = [plant_id for plant_id in plant_ids if failure_log.should_poll(plant_id)]
+    fetched = 0
+    breaker = CircuitBreaker()
+
+    with create_session(max_workers) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def timed_fetch(plant_id: int) -> tuple[requests.Response | None, float]:
+            started = time.monotonic()
+            response = fetch_plant_with_retry(session, plant_id, timeout, deadline, breaker)
+            return response, time.monotonic() - started
+
+        futures = {executor.submit(timed_fetch, plant_id): plant_id for plant_id in plant_ids}
+        for future in as_completed(futures):
+            plant_id = futures[future]
+            response, latency = future.result()
+            if response is not None and response.status_code == 200:
+                try:
+                    json_file = response.json()
+                except ValueError:
+                    print(f"Invalid JSON for plant_id {plant_id}")
+                else:
+                    failure_log.record_success(plant_id)
+                    fetched += 1
+                    yield plant_id, json_file
+                    continue
+            failure_log.record(
+                plant_id, None if response is None else response.status_code, latency)
+
+    if not fetched and breaker.is_open:
+        raise APIError("Circuit breaker open - the plants API is failing.")
+
+
+def get_plants(plant_ids: list[int] = None, max_workers: int = MAX_WORKERS,
+               timeout: float = REQUEST_TIMEOUT, deadline: float = None,
+               failure_log: FailureLog = None) -> dict:
+    """ Hit's each endpoint concurrently and fetches all the available plant data.
+
+    Plants that still fail after retrying are recorded in the failure log and left
+    out, so a partial result is returned rather than losing the whole run."""
+    plants = iter_plants(plant_ids, max_workers, timeout, deadline, failure_log)
+    return dict(sorted(plants, key=itemgetter(0)))
+
+
+def get_reading_hash(raw_data: dict) -> str:
+    """Returns a stable hash of a plant's API payload."""
+    return hashlib.sha1(json.dumps(raw_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_last_seen_index(index_path: str = LAST_SEEN_INDEX) -> dict:
+    """Returns the last reading seen for each plant ID, or an empty dict if there is none."""
+    try:
+        with open(index_path, 'r', encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_last_seen_index(last_seen: dict, index_path: str = LAST_SEEN_INDEX) -> None:
+    """Persists the last reading seen for each plant ID."""
+    try:
+        with open(index_path, 'w', encoding="utf-8") as file:
+            json.dump(last_seen, file)
+    except OSError as err:
+        print(f"An error occurred while writing to the file: {err}")
+
+
+def update_last_seen(plant_id: int, raw_data: dict, last_seen: dict) -> bool:
+    """Returns True if a reading differs from the last one seen for its plant,
+    recording it in last_seen in place.
+
+    The index is keyed by plant ID and holds the recording time and payload hash."""
+    entry = [raw_data.get("recording_taken"), get_reading_hash(raw_data)]
+    if last_seen.get(str(plant_id)) == entry:
+        return False
+    last_seen[str(plant_id)] = entry
+    return True
+
+
+def filter_unchanged_readings(plants: dict, last_seen: dict) -> tuple[dict, dict]:
+    """Drops readings whose recording time and payload match the last one seen.
+
+    Returns the changed readings and an updated copy of the index."""
+    updated = dict(last_seen)
+    changed = {plant_id: raw_data for plant_id, raw_data in plants.items()
+               if update_last_seen(plant_id, raw_data, updated)}
+    return changed, updated
 
 
 if __name__ == "__main__":
     start = time.time()
 
-    data = get_plants()
+    failures = load_failure_log()
+    data = get_plants(get_plant_ids(), failure_log=failures)
+    failures.flush()
+    data, last_seen_index = filter_unchanged_readings(data, load_last_seen_index())
+    save_last_seen_index(last_seen_index)
     with open("plants.json", 'w') as plant_file:
         json.dump(data, plant_file, indent=4)
 
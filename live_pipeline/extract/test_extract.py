@@ -1,7 +1,17 @@
 """ Tests the functionality of the extract code."""
+import io
+import os
+import json
+import time
+from unittest.mock import patch, MagicMock
 import pytest
+import requests
 import requests_mock
-from extract import get_plants
+from extract import (get_plants, create_session, get_deadline, CircuitBreaker, APIError,
+                     discover_end_id, get_plant_ids, filter_unchanged_readings, update_last_seen,
+                     load_last_seen_index, save_last_seen_index, FailureLog, load_failure_log,
+                     CHRONIC_MISSING,
+                     BREAKER_MIN_CALLS, DEADLINE_MARGIN)
 
 
 def test_get_plants_successful():
@@ -30,3 +40,264 @@ def test_get_plants_successful():
         assert isinstance(plants, dict)
         assert len(plants) == 50
         assert all(plants[id] == expected_data for id in range(1, 51))
+
+
+def test_get_plants_uses_timeout_and_worker_limit():
+    """Checks every request is sent with the per-request timeout."""
+    with requests_mock.Mocker() as mocker:
+        for plant_id in range(1, 51):
+            mocker.get(
+                f"https://data-eng-plants-api.herokuapp.com/plants/{plant_id}",
+                json={"plant_id": plant_id}, status_code=200)
+
+        plants = get_plants(max_workers=3, timeout=2.5)
+
+        assert list(plants.keys()) == list(range(1, 51))
+        assert all(plants[id] == {"plant_id": id} for id in range(1, 51))
+        assert all(request.timeout == 2.5 for request in mocker.request_history)
+
+
+def test_create_session_pool_size():
+    """Checks the session connection pool matches the number of workers."""
+    session = create_session(max_workers=7)
+
+    assert session.get_adapter("https://example.com")._pool_maxsize == 7
+
+
+@patch("extract.get_backoff", return_value=0)
+def test_server_error_is_retried(fake_backoff):
+    """Checks a plant returning a 500 is retried until it succeeds."""
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, json={"plant_id": 0}, status_code=200)
+        mocker.get("https://data-eng-plants-api.herokuapp.com/plants/7",
+                   [{"status_code": 500}, {"json": {"plant_id": 7}, "status_code": 200}])
+
+        plants = get_plants()
+
+        assert plants[7] == {"plant_id": 7}
+        assert len(plants) == 50
+        assert fake_backoff.call_count == 1
+
+
+@patch("extract.get_backoff", return_value=0)
+def test_failed_request_keeps_other_plants(fake_backoff):
+    """Checks a plant whose requests keep failing doesn't lose the rest of the run."""
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, json={"plant_id": 0}, status_code=200)
+        mocker.get("https://data-eng-plants-api.herokuapp.com/plants/3",
+                   exc=requests.exceptions.ConnectTimeout)
+
+        plants = get_plants()
+
+        assert 3 not in plants
+        assert len(plants) == 49
+
+
+@patch("extract.get_backoff", return_value=0)
+def test_circuit_breaker_stops_requests(fake_backoff):
+    """Checks the API stops being called once most calls fail."""
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, status_code=500)
+
+        with pytest.raises(APIError):
+            get_plants(max_workers=1)
+
+        assert mocker.call_count == BREAKER_MIN_CALLS
+
+
+def test_no_requests_after_deadline():
+    """Checks no requests are made once the deadline has passed."""
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, json={}, status_code=200)
+
+        plants = get_plants(deadline=time.monotonic() - 1)
+
+        assert plants == {}
+        assert mocker.call_count == 0
+
+
+def test_deadline_taken_from_lambda_context():
+    """Checks the deadline leaves the margin free for transform and load."""
+    fake_context = MagicMock()
+    fake_context.get_remaining_time_in_millis.return_value = 100_000
+
+    deadline = get_deadline(fake_context)
+
+    assert deadline - time.monotonic() == pytest.approx(100 - DEADLINE_MARGIN, abs=1)
+
+
+def test_circuit_breaker_opens_on_failures():
+    """Checks the breaker only opens once the failure ratio is reached."""
+    breaker = CircuitBreaker(min_calls=4, failure_ratio=0.5)
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(False)
+    assert not breaker.is_open
+
+    breaker.record(True)
+    assert breaker.is_open
+
+
+def test_discover_end_id_grows_until_run_of_404s():
+    """Checks discovery extends the ID range past the last plant found."""
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, status_code=404)
+        for plant_id in (51, 52, 56, 60):
+            mocker.get(
+                f"https://data-eng-plants-api.herokuapp.com/plants/{plant_id}",
+                json={}, status_code=200)
+
+        end_id = discover_end_id(create_session(), 51, window=5)
+
+        assert end_id == 61
+
+
+def test_discover_end_id_stops_when_api_failing():
+    """Checks server errors don't count as plants and end the search once the breaker opens."""
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, status_code=500)
+
+        end_id = discover_end_id(create_session(), 51, window=5)
+
+        assert end_id == 51
+        assert mocker.call_count == 5
+
+
+def test_discover_end_id_is_bounded():
+    """Checks discovery stops at the window limit and makes no requests past the deadline."""
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, json={}, status_code=200)
+
+        assert discover_end_id(create_session(), 51, window=5, max_windows=3) == 66
+        assert discover_end_id(create_session(), 51, deadline=time.monotonic() - 1) == 51
+        assert mocker.call_count == 15
+
+
+@patch("extract.discover_end_id", return_value=61)
+def test_get_plant_ids_uses_cache(fake_discover, tmp_path):
+    """Checks discovery only runs when there is no fresh cached range."""
+    cache_path = str(tmp_path / "plant_id_range.json")
+
+    first = get_plant_ids(cache_path=cache_path)
+    second = get_plant_ids(cache_path=cache_path)
+
+    assert first == second == list(range(1, 61))
+    assert fake_discover.call_count == 1
+
+
+@patch("extract.discover_end_id", return_value=101)
+def test_shards_split_ids_without_overlap(fake_discover, tmp_path):
+    """Checks every plant ID belongs to exactly one shard."""
+    cache_path = str(tmp_path / "plant_id_range.json")
+
+    shards = [get_plant_ids(index, 3, cache_path) for index in range(3)]
+
+    assert sorted(sum(shards, [])) == list(range(1, 101))
+    assert not set(shards[0]) & set(shards[1])
+
+
+def test_invalid_shard_index():
+    """Checks a shard index outside the shard count is rejected."""
+    with pytest.raises(ValueError):
+        get_plant_ids(3, 3)
+
+
+def test_unchanged_readings_are_dropped():
+    """Checks only readings that differ from the last seen one are kept."""
+    first = {1: {"recording_taken": "2023-08-30 14:56:09", "temperature": 12.0},
+             2: {"recording_taken": "2023-08-30 14:56:10", "temperature": 13.0}}
+    changed, last_seen = filter_unchanged_readings(first, {})
+    assert changed == first
+
+    second = {1: {"recording_taken": "2023-08-30 14:56:09", "temperature": 12.0},
+              2: {"recording_taken": "2023-08-30 14:56:10", "temperature": 14.0}}
+    changed, last_seen = filter_unchanged_readings(second, last_seen)
+
+    assert list(changed.keys()) == [2]
+    assert last_seen["2"][0] == "2023-08-30 14:56:10"
+
+
+def test_last_seen_updated_in_place():
+    """Checks a single reading is checked against and recorded in the index itself."""
+    last_seen = {}
+    reading = {"recording_taken": "2023-08-30 14:56:09", "temperature": 12.0}
+
+    assert update_last_seen(1, reading, last_seen) is True
+    assert update_last_seen(1, reading, last_seen) is False
+    assert update_last_seen(1, {**reading, "temperature": 13.0}, last_seen) is True
+    assert list(last_seen.keys()) == ["1"]
+
+
+def test_last_seen_index_round_trip(tmp_path):
+    """Checks the last seen index survives between runs."""
+    index_path = str(tmp_path / "last_seen.json")
+    _, last_seen = filter_unchanged_readings(
+        {5: {"recording_taken": "2023-08-30 14:56:09"}}, {})
+
+    save_last_seen_index(last_seen, index_path)
+    changed, _ = filter_unchanged_readings(
+        {5: {"recording_taken": "2023-08-30 14:56:09"}}, load_last_seen_index(index_path))
+
+    assert changed == {}
+    assert load_last_seen_index(str(tmp_path / "missing.json")) == {}
+
+
+def test_failures_recorded_in_memory():
+    """Checks failed plants are recorded with their status code and latency."""
+    failure_log = FailureLog()
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, json={}, status_code=200)
+        mocker.get("https://data-eng-plants-api.herokuapp.com/plants/4", status_code=404)
+
+        plants = get_plants(failure_log=failure_log)
+
+    assert len(plants) == 49
+    assert len(failure_log.events) == 1
+    assert failure_log.events[0]["plant_id"] == 4
+    assert failure_log.events[0]["code"] == 404
+    assert failure_log.events[0]["latency"] >= 0
+
+
+def test_failure_log_flushes_once_as_jsonl(tmp_path, capsys):
+    """Checks buffered events are printed as JSON lines and counters saved."""
+    counters_path = str(tmp_path / "plant_failures.json")
+    failure_log = FailureLog()
+    failure_log.record(4, 404, 0.1)
+    failure_log.record(5, 500, 0.2)
+    failure_log.flush(counters_path)
+    failure_log.record(4, 404, 0.1)
+    failure_log.flush(counters_path)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["plant_id"] for line in lines] == [4, 5, 4]
+    assert load_failure_log(counters_path).counters["4"]["missing"] == 2
+    assert os.listdir(tmp_path) == ["plant_failures.json"]
+
+
+@patch("extract.client")
+def test_failure_counters_kept_in_bucket(fake_client):
+    """Checks the counters are read from and saved to the shard's object when a bucket is set."""
+    fake_client().get_object.return_value = {"Body": io.BytesIO(b'{"4": {"missing": 1}}')}
+
+    failure_log = load_failure_log(bucket="fake-bucket", shard_index=2, shard_count=3)
+    failure_log.flush()
+
+    assert failure_log.counters == {"4": {"missing": 1}}
+    assert fake_client().get_object.call_args[1]["Key"] == "plant_failures_2_of_3.json"
+    assert fake_client().put_object.call_args[1]["Bucket"] == "fake-bucket"
+    assert fake_client().put_object.call_args[1]["Key"] == "plant_failures_2_of_3.json"
+
+
+def test_chronically_missing_plants_are_skipped():
+    """Checks plants missing for several runs aren't polled every run."""
+    failure_log = FailureLog()
+    for _ in range(CHRONIC_MISSING):
+        failure_log.record(4, 404, 0.1)
+
+    with requests_mock.Mocker() as mocker:
+        mocker.get(requests_mock.ANY, json={}, status_code=200)
+
+        plants = get_plants(failure_log=failure_log)
+
+        assert 4 not in plants
+        assert mocker.call_count == 49
@@ -1,9 +1,46 @@
 """libraries required for testing"""
 import pytest
+import pandas as pd
+from database_functions import DimensionCache
 
 
 @pytest.fixture
 def fake_row():
     return ['', 21, 'Carl Linnaeus', 'carl.linnaeus@lnhm.co.uk', '146)994-1635x35992', '2023-08-31 14:44:00+01:00',
             'Ficus', 'Ficus carica', '2023-08-31 16:20:15+01:00', 'Perennial', 13.055716804469082, 94.25274582786069,
-            "full sun, part sun/part shade"]
+            "full sun, part sun/part shade", 8]
+
+
+@pytest.fixture
+def fake_clean_dataframe():
+    return pd.DataFrame({
+        'Botanist_Name': ['Carl Linnaeus', 'Carl Linnaeus', 'Gertrude Jekyll'],
+        'Botanist_Email': ['carl.linnaeus@lnhm.co.uk', 'carl.linnaeus@lnhm.co.uk',
+                           'gertrude.jekyll@lnhm.co.uk'],
+        'Botanist_Phone': ['(146)994-1635x35992', '(146)994-1635x35992', '001-481-273-3691x127'],
+        'Last_Watered': ['2023-08-31 14:44:00', '2023-08-31 14:45:00', '2023-08-31 14:46:00'],
+        'Plant_Name': ['Ficus', 'Venus flytrap', 'Corpse flower'],
+        'Scientific_Name': ['Ficus carica', '-', '-'],
+        'Recording_Time': ['2023-08-31 16:20:15', '2023-08-31 16:20:16', '2023-08-31 16:20:17'],
+        'Cycle': ['Perennial', 'Perennial', '-'],
+        'Temperature': [13.05, 12.5, 20.1],
+        'Soil_Moisture': [94.25, 50.0, 80.0],
+        'Sunlight': ['full sun, part sun/part shade', 'full sun', '-'],
+        'Plant_Id': [8, 9, 10]})
+
+
+@pytest.fixture
+def fake_warm_cache():
+    cache = DimensionCache()
+    cache.ids = {'sunlight': {'-': 1, 'full sun': 2, 'full sun, part sun/part shade': 7},
+                 'cycle': {'Perennial': 1, '-': 2},
+                 'botanist': {'carl.linnaeus@lnhm.co.uk': 1, 'gertrude.jekyll@lnhm.co.uk': 2},
+                 'species': {'Ficus': 1, 'Venus flytrap': 2, 'Corpse flower': 3}}
+    cache.warmed = True
+    return cache
+
+
+@pytest.fixture
+def fake_config():
+    return {'DATABASE_USERNAME': 'fake_user', 'DATABASE_PASSWORD': 'fake_password',
+            'DATABASE_IP': 'fake_host', 'DATABASE_PORT': '5432', 'DATABASE_NAME': 'fake_db'}
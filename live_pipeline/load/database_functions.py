@@ -1,19 +1,96 @@
 """libraries required to connect to database"""
-from psycopg2 import connect
-from psycopg2.extras import RealDictCursor
+from io import BytesIO
+from os import listdir, makedirs, path, remove, replace
+import time
+import pandas as pd
+from boto3 import client
+from psycopg2 import connect, sql, Error, OperationalError, InterfaceError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
+
+LOAD_PAGE_SIZE = 1000
+SPOOL_DIR = "spool"
+SPOOL_SUFFIX = ".jsonl.gz"
+SPOOL_QUARANTINE = "quarantine"
+SPOOL_REPLAY_ROWS = 50000
+CONNECT_TIMEOUT = 5
+STATEMENT_TIMEOUT_MS = 30000
+KEEPALIVE_OPTIONS = {"keepalives": 1, "keepalives_idle": 30,
+                     "keepalives_interval": 10, "keepalives_count": 3}
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+DIMENSIONS = {
+    'sunlight': ('sunlight_id', 's_description', ['s_description']),
+    'cycle': ('cycle_id', 'cycle_name', ['cycle_name']),
+    'botanist': ('botanist_id', 'b_email', ['b_name', 'b_email', 'b_phone']),
+    'species': ('species_id', 's_name', ['s_name'])}
+
+
+class ConnectionManager:
+    """Keeps one database connection open between warm Lambda invocations
+
+    The same class is copied into each deployable, and live_pipeline/test_pipeline.py
+    checks the copies match, so change them together"""
+
+    def __init__(self):
+        """Creates a manager with no open connection"""
+        self.connection = None
+
+    def is_healthy(self) -> bool:
+        """Checks the open connection still works with a single cheap query.
+
+        Called at the start of each invocation, so any transaction still open was
+        left behind by an earlier invocation that was aborted. It is rolled back
+        rather than carried into this one"""
+        if self.connection is None or self.connection.closed:
+            return False
+        try:
+            if self.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                self.connection.rollback()
+            autocommit = self.connection.autocommit
+            self.connection.autocommit = True
+            with self.connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+            self.connection.autocommit = autocommit
+            return True
+        except Error:
+            return False
+
+    def get(self, config: dict):
+        """Returns the open connection, reconnecting if it is missing or broken"""
+        if not self.is_healthy():
+            self.close()
+            self.connection = connect(
+                user=config['DATABASE_USERNAME'],
+                password=config['DATABASE_PASSWORD'],
+                host=config['DATABASE_IP'],
+                port=config['DATABASE_PORT'],
+                database=config['DATABASE_NAME'],
+                connect_timeout=CONNECT_TIMEOUT,
+                options=f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",
+                **KEEPALIVE_OPTIONS)
+        return self.connection
+
+    def close(self) -> None:
+        """Closes the connection if one is open"""
+        if self.connection is not None and not self.connection.closed:
+            try:
+                self.connection.close()
+            except Error:
+                pass
+        self.connection = None
+
+CONNECTION_MANAGER = ConnectionManager()
 
 
 def get_db_connection(config):
-    """Connect to the database with plant data"""
+    """Connect to the database with plant data, reusing a healthy connection if there is one.
+
+    Returns None if the database can't be reached."""
     try:
-        return connect(
-            user=config['DATABASE_USERNAME'],
-            password=config['DATABASE_PASSWORD'],
-            host=config['DATABASE_IP'],
-            port=config['DATABASE_PORT'],
-            database=config['DATABASE_NAME'])
-    except ValueError:
-        return "Error connecting to database."
+        return CONNECTION_MANAGER.get(config)
+    except (ValueError, Error) as err:
+        print(f"Error connecting to database - {err}")
+        return None
 
 
 def add_cycle_information(conn, cycle_name: str):
@@ -85,10 +162,268 @@ def add_plant_information(conn, plant_record: list):
             [plant_record[6]])
         species_id = cur.fetchone()['species_id']
         cur.execute(
-            """INSERT INTO plant(species_id, temperature, soil_moisture, 
+            """INSERT INTO plant(plant_id, species_id, temperature, soil_moisture, 
             last_watered, recording_taken, sunlight_id, botanist_id, cycle_id)
-              VALUES (%s, %s, %s, %s, %s, %s, %s, %s);""",
-            [species_id, plant_record[10], plant_record[11], plant_record[5],
-             plant_record[8], sunlight_id, botanist_id, cycle_id])
+              VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+              ON CONFLICT (plant_id, recording_taken) DO NOTHING;""",
+            [plant_record[13], species_id, plant_record[10], plant_record[11],
+             plant_record[5], plant_record[8], sunlight_id, botanist_id, cycle_id])
         conn.commit()
         cur.close()
+
+
+class DimensionCache:
+    """Maps dimension values to their IDs so plant rows can be inserted without lookups.
+
+    Kept at module level so it survives between warm Lambda invocations."""
+
+    def __init__(self):
+        """Creates an empty cache"""
+        self.ids = {table: {} for table in DIMENSIONS}
+        self.warmed = False
+
+    def warm_up(self, conn) -> None:
+        """Loads every existing dimension ID with one query per table"""
+        with conn.cursor() as cur:
+            for table, (id_column, key_column, _) in DIMENSIONS.items():
+                cur.execute(sql.SQL("SELECT {}, {} FROM {};").format(
+                    sql.Identifier(key_column), sql.Identifier(id_column),
+                    sql.Identifier(table)))
+                self.ids[table] = dict(cur.fetchall())
+        self.warmed = True
+
+    def resolve(self, conn, table: str, values) -> list[int]:
+        """Returns the ID for each row of values, inserting any keys not yet cached.
+
+        The columns of values must be in the order given in DIMENSIONS."""
+        id_column, key_column, columns = DIMENSIONS[table]
+        key_index = columns.index(key_column)
+        ids = self.ids[table]
+        missing = {row[key_index]: row for row in values.itertuples(index=False, name=None)
+                   if row[key_index] not in ids}
+        if missing:
+            query = sql.SQL(
+                """INSERT INTO {table}({columns}) VALUES %s
+                ON CONFLICT ({key}) DO UPDATE SET {key} = EXCLUDED.{key}
+                RETURNING {key}, {id};""").format(
+                    table=sql.Identifier(table),
+                    columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+                    key=sql.Identifier(key_column), id=sql.Identifier(id_column))
+            with conn.cursor() as cur:
+                ids.update(execute_values(
+                    cur, query, list(missing.values()), fetch=True))
+        return [ids[key] for key in values.iloc[:, key_index]]
+
+    def clear(self) -> None:
+        """Forgets every cached ID"""
+        self.ids = {table: {} for table in DIMENSIONS}
+        self.warmed = False
+
+
+DIMENSION_CACHE = DimensionCache()
+
+
+def load_plant_data(conn, dataframe, cache: DimensionCache = DIMENSION_CACHE) -> int:
+    """Loads every plant reading in a single transaction.
+
+    Dimension IDs come from the cache, with new values upserted in one statement
+    per table, then every plant row is inserted with multi-row VALUES. Readings
+    already stored for the same plant and recording time are skipped, so a run
+    can safely be repeated. Returns the rows inserted."""
+    try:
+        if not cache.warmed:
+            cache.warm_up(conn)
+        sunlight_ids = cache.resolve(conn, 'sunlight', dataframe[['Sunlight']])
+        cycle_ids = cache.resolve(conn, 'cycle', dataframe[['Cycle']])
+        botanist_ids = cache.resolve(
+            conn, 'botanist', dataframe[['Botanist_Name', 'Botanist_Email', 'Botanist_Phone']])
+        species_ids = cache.resolve(conn, 'species', dataframe[['Plant_Name']])
+        plant_rows = list(zip(dataframe['Plant_Id'].astype(int).tolist(), species_ids,
+                              dataframe['Temperature'].tolist(),
+                              dataframe['Soil_Moisture'].tolist(),
+                              dataframe['Last_Watered'].tolist(),
+                              dataframe['Recording_Time'].tolist(),
+                              sunlight_ids, botanist_ids, cycle_ids))
+        with conn.cursor() as cur:
+            inserted = execute_values(
+                cur,
+                """INSERT INTO plant(plant_id, species_id, temperature, soil_moisture,
+                last_watered, recording_taken, sunlight_id, botanist_id, cycle_id)
+                VALUES %s
+                ON CONFLICT (plant_id, recording_taken) DO NOTHING
+                RETURNING plant_entry_id;""",
+                plant_rows, page_size=LOAD_PAGE_SIZE, fetch=True)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        cache.clear()
+        raise
+    return len(inserted)
+
+
+class LocalSpoolBackend:
+    """Stores spooled batches as files in a local directory"""
+
+    def __init__(self, directory: str):
+        """Creates the backend, making the directory if needed"""
+        self.directory = directory
+        makedirs(directory, exist_ok=True)
+
+    def write(self, name: str, body: bytes) -> None:
+        """Writes a batch, renaming it into place so a half-written file is never replayed"""
+        temp_path = path.join(self.directory, f".{name}.tmp")
+        with open(temp_path, 'wb') as file:
+            file.write(body)
+        replace(temp_path, path.join(self.directory, name))
+
+    def list(self) -> list[str]:
+        """Returns the names of the spooled batches, oldest first"""
+        return sorted(name for name in listdir(self.directory)
+                      if name.endswith(SPOOL_SUFFIX))
+
+    def read(self, name: str) -> bytes:
+        """Returns the contents of a batch"""
+        with open(path.join(self.directory, name), 'rb') as file:
+            return file.read()
+
+    def delete(self, name: str) -> None:
+        """Removes a batch once it has been loaded"""
+        remove(path.join(self.directory, name))
+
+    def quarantine(self, name: str) -> None:
+        """Moves a batch that can't be loaded into the quarantine directory"""
+        quarantine_dir = path.join(self.directory, SPOOL_QUARANTINE)
+        makedirs(quarantine_dir, exist_ok=True)
+        replace(path.join(self.directory, name), path.join(quarantine_dir, name))
+
+
+class S3SpoolBackend:
+    """Stores spooled batches as objects under a prefix in an S3 bucket"""
+
+    def __init__(self, bucket: str, prefix: str = "spool/", s3_client=None):
+        """Creates the backend, with an S3 client unless one is given"""
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3_client = s3_client or client("s3")
+
+    def write(self, name: str, body: bytes) -> None:
+        """Uploads a batch"""
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=body)
+
+    def list(self) -> list[str]:
+        """Returns the names of the spooled batches, oldest first"""
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        names = [obj["Key"][len(self.prefix):]
+                 for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix)
+                 for obj in page.get("Contents", [])]
+        return sorted(name for name in names
+                      if name.endswith(SPOOL_SUFFIX) and "/" not in name)
+
+    def read(self, name: str) -> bytes:
+        """Downloads a batch"""
+        return self.s3_client.get_object(
+            Bucket=self.bucket, Key=self.prefix + name)["Body"].read()
+
+    def delete(self, name: str) -> None:
+        """Removes a batch once it has been loaded"""
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+    def quarantine(self, name: str) -> None:
+        """Moves a batch that can't be loaded under the quarantine prefix"""
+        self.s3_client.copy_object(
+            Bucket=self.bucket, Key=f"{self.prefix}{SPOOL_QUARANTINE}/{name}",
+            CopySource={"Bucket": self.bucket, "Key": self.prefix + name})
+        self.delete(name)
+
+
+class Spool:
+    """A write-ahead spool of transformed batches that couldn't be loaded.
+
+    Each batch is stored as gzipped JSON lines, named by the time it was spooled
+    so batches replay in order."""
+
+    def __init__(self, backend):
+        """Creates a spool over a local or S3 backend"""
+        self.backend = backend
+
+    def append(self, dataframe: pd.DataFrame) -> str:
+        """Spools a batch ready for load_plant_data and returns its name"""
+        buffer = BytesIO()
+        dataframe.to_json(buffer, orient='records', lines=True,
+                          date_format='iso', compression='gzip')
+        name = f"{time.time_ns():020d}{SPOOL_SUFFIX}"
+        self.backend.write(name, buffer.getvalue())
+        print(f"Spooled {len(dataframe)} rows as {name}")
+        return name
+
+    def get_metrics(self) -> dict:
+        """Returns the size of the backlog and the age of its oldest batch"""
+        names = self.backend.list()
+        oldest = int(names[0].removesuffix(SPOOL_SUFFIX)) / 1e9 if names else None
+        return {"batches": len(names),
+                "oldest_age_seconds": round(time.time() - oldest) if names else 0}
+
+    def replay(self, conn, max_rows: int = SPOOL_REPLAY_ROWS) -> dict:
+        """Bulk loads every spooled batch, oldest first, then removes them.
+
+        Batches are combined into loads of up to max_rows rows, each in its own
+        transaction. Loads skip readings that are already stored, so a batch
+        replayed twice after a failed delete adds nothing. A batch that can't be
+        read or that the database rejects is quarantined and the replay carries
+        on, while a lost connection stops it."""
+        metrics = self.get_metrics()
+        metrics.update({"rows": 0, "inserted": 0, "quarantined": 0})
+        if metrics["batches"]:
+            print(f"Replaying spool backlog: {metrics}")
+        pending_names, pending_frames = [], []
+        for name in self.backend.list():
+            try:
+                frame = pd.read_json(
+                    BytesIO(self.backend.read(name)), lines=True, compression='gzip',
+                    dtype=False, convert_dates=False)
+            except (ValueError, OSError, EOFError) as err:
+                self.quarantine(name, err, metrics)
+                continue
+            pending_names.append(name)
+            pending_frames.append(frame)
+            if sum(map(len, pending_frames)) >= max_rows:
+                self.replay_batches(conn, pending_names, pending_frames, metrics)
+                pending_names, pending_frames = [], []
+        if pending_names:
+            self.replay_batches(conn, pending_names, pending_frames, metrics)
+        return metrics
+
+    def replay_batches(self, conn, names: list[str], frames: list[pd.DataFrame],
+                       metrics: dict) -> None:
+        """Loads some spooled batches in one transaction and removes them.
+
+        If the load is rejected, each batch is retried on its own so only the
+        batches still rejected are quarantined"""
+        try:
+            inserted = load_plant_data(conn, pd.concat(frames, ignore_index=True))
+        except CONNECTION_ERRORS:
+            raise
+        except Exception as err:
+            if len(names) == 1:
+                self.quarantine(names[0], err, metrics)
+            else:
+                for name, frame in zip(names, frames):
+                    self.replay_batches(conn, [name], [frame], metrics)
+            return
+        metrics["inserted"] += inserted
+        metrics["rows"] += sum(map(len, frames))
+        for name in names:
+            self.backend.delete(name)
+
+    def quarantine(self, name: str, err: Exception, metrics: dict) -> None:
+        """Moves a batch that can't be loaded out of the spool, keeping it to inspect"""
+        print(f"Quarantining spooled batch {name} - {err}")
+        self.backend.quarantine(name)
+        metrics["quarantined"] += 1
+
+
+def get_spool(config) -> Spool:
+    """Returns a spool in SPOOL_BUCKET if it is set, otherwise in a local directory"""
+    if config.get("SPOOL_BUCKET"):
+        return Spool(S3SpoolBackend(config["SPOOL_BUCKET"]))
+    return Spool(LocalSpoolBackend(config.get("SPOOL_DIR", SPOOL_DIR)))
@@ -0,0 +1,29 @@
+-- Adds the unique keys the loader upserts dimension values against.
+-- Any duplicate dimension rows are merged into the lowest ID first.
+BEGIN;
+
+UPDATE plant p SET sunlight_id = d.keep_id
+FROM (SELECT sunlight_id, MIN(sunlight_id) OVER (PARTITION BY s_description) AS keep_id
+      FROM sunlight) d
+WHERE p.sunlight_id = d.sunlight_id AND d.sunlight_id <> d.keep_id;
+DELETE FROM sunlight s USING sunlight k
+WHERE s.s_description = k.s_description AND s.sunlight_id > k.sunlight_id;
+ALTER TABLE sunlight ADD CONSTRAINT sunlight_s_description_key UNIQUE (s_description);
+
+UPDATE plant p SET cycle_id = d.keep_id
+FROM (SELECT cycle_id, MIN(cycle_id) OVER (PARTITION BY cycle_name) AS keep_id
+      FROM cycle) d
+WHERE p.cycle_id = d.cycle_id AND d.cycle_id <> d.keep_id;
+DELETE FROM cycle c USING cycle k
+WHERE c.cycle_name = k.cycle_name AND c.cycle_id > k.cycle_id;
+ALTER TABLE cycle ADD CONSTRAINT cycle_cycle_name_key UNIQUE (cycle_name);
+
+UPDATE plant p SET botanist_id = d.keep_id
+FROM (SELECT botanist_id, MIN(botanist_id) OVER (PARTITION BY b_email) AS keep_id
+      FROM botanist) d
+WHERE p.botanist_id = d.botanist_id AND d.botanist_id <> d.keep_id;
+DELETE FROM botanist b USING botanist k
+WHERE b.b_email = k.b_email AND b.botanist_id > k.botanist_id;
+ALTER TABLE botanist ADD CONSTRAINT botanist_b_email_key UNIQUE (b_email);
+
+COMMIT;
@@ -0,0 +1,60 @@
+-- Rebuilds plant as a table range-partitioned by day on recording_taken.
+-- The live table only holds the last day of readings, so rows are copied across.
+BEGIN;
+
+ALTER TABLE plant RENAME TO plant_legacy;
+ALTER INDEX plant_pkey RENAME TO plant_legacy_pkey;
+
+CREATE TABLE plant (
+    plant_entry_id INTEGER NOT NULL DEFAULT nextval('plant_plant_entry_id_seq'),
+    species_id SMALLINT NOT NULL,
+    temperature FLOAT,
+    soil_moisture FLOAT,
+    last_watered TIMESTAMP,
+    recording_taken TIMESTAMP NOT NULL,
+    sunlight_id SMALLINT,
+    botanist_id SMALLINT,
+    cycle_id SMALLINT,
+    PRIMARY KEY (plant_entry_id, recording_taken),
+    CONSTRAINT fk_sunlight_id
+        FOREIGN KEY(sunlight_id)
+            REFERENCES sunlight(sunlight_id),
+    CONSTRAINT fk_botanist_id
+        FOREIGN KEY(botanist_id)
+            REFERENCES botanist(botanist_id),
+    CONSTRAINT fk_cycle_id
+        FOREIGN KEY(cycle_id)
+            REFERENCES cycle(cycle_id),
+    CONSTRAINT fk_species_id
+        FOREIGN KEY(species_id)
+            REFERENCES species(species_id)
+) PARTITION BY RANGE (recording_taken);
+
+ALTER SEQUENCE plant_plant_entry_id_seq OWNED BY plant.plant_entry_id;
+
+CREATE INDEX plant_recording_taken_idx ON plant (recording_taken);
+
+CREATE TABLE plant_default PARTITION OF plant DEFAULT;
+
+CREATE OR REPLACE FUNCTION create_plant_partition(day DATE) RETURNS VOID AS $$
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF plant FOR VALUES FROM (%L) TO (%L)',
+        'plant_' || to_char(day, 'YYYYMMDD'), day, day + 1);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_plant_partition(day::DATE)
+FROM generate_series(
+    LEAST((SELECT MIN(recording_taken)::DATE FROM plant_legacy), CURRENT_DATE - 1),
+    CURRENT_DATE + 2, INTERVAL '1 day') AS day;
+
+INSERT INTO plant(plant_entry_id, species_id, temperature, soil_moisture, last_watered,
+                  recording_taken, sunlight_id, botanist_id, cycle_id)
+SELECT plant_entry_id, species_id, temperature, soil_moisture, last_watered,
+       recording_taken, sunlight_id, botanist_id, cycle_id
+FROM plant_legacy;
+
+DROP TABLE plant_legacy;
+
+COMMIT;
@@ -0,0 +1,9 @@
+-- Stores the API plant ID and makes each plant's reading at a given time unique,
+-- so repeated loads insert nothing new. Readings loaded before this migration
+-- have no plant ID and are left NULL, which the unique key does not compare.
+BEGIN;
+
+ALTER TABLE plant ADD COLUMN plant_id SMALLINT;
+ALTER TABLE plant ADD CONSTRAINT plant_reading_key UNIQUE (plant_id, recording_taken);
+
+COMMIT;
@@ -0,0 +1,5 @@
+-- Adds the table the incremental archive job keeps its watermark in.
+CREATE TABLE IF NOT EXISTS archive_watermark (
+    name text PRIMARY KEY,
+    archived_until TIMESTAMP NOT NULL
+);
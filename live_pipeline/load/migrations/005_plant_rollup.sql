@@ -0,0 +1,18 @@
+-- Adds the table the archive job writes hourly and daily rollups to.
+CREATE TABLE IF NOT EXISTS plant_rollup (
+    granularity text NOT NULL,
+    period_start TIMESTAMP NOT NULL,
+    plant_id SMALLINT NOT NULL,
+    species text NOT NULL,
+    readings INT NOT NULL,
+    dropped_readings INT NOT NULL,
+    temperature_min FLOAT,
+    temperature_max FLOAT,
+    temperature_mean FLOAT,
+    temperature_p95 FLOAT,
+    soil_moisture_min FLOAT,
+    soil_moisture_max FLOAT,
+    soil_moisture_mean FLOAT,
+    soil_moisture_p95 FLOAT,
+    PRIMARY KEY (granularity, period_start, plant_id, species)
+);
@@ -0,0 +1,29 @@
+-- Lets create_plant_partition create a day's partition after readings for that day
+-- have already landed in plant_default, by moving those readings into it.
+CREATE OR REPLACE FUNCTION create_plant_partition(day DATE) RETURNS VOID AS $$
+DECLARE
+    partition_name text := 'plant_' || to_char(day, 'YYYYMMDD');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM plant_default
+                   WHERE recording_taken >= day AND recording_taken < day + 1) THEN
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF plant FOR VALUES FROM (%L) TO (%L)',
+            partition_name, day, day + 1);
+        RETURN;
+    END IF;
+    -- The partition cannot be created while the default holds rows in its range.
+    ALTER TABLE plant DETACH PARTITION plant_default;
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF plant FOR VALUES FROM (%L) TO (%L)',
+        partition_name, day, day + 1);
+    WITH moved AS (
+        DELETE FROM plant_default
+        WHERE recording_taken >= day AND recording_taken < day + 1
+        RETURNING *)
+    INSERT INTO plant SELECT * FROM moved;
+    ALTER TABLE plant ATTACH PARTITION plant_default DEFAULT;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,17 @@
+-- Keeps archived readings until the hour and day they fall in are fully archived,
+-- so each rollup is computed once from all of its readings. Readings are kept for
+-- a day after their day is rolled up, to count gaps that span a day boundary and to
+-- recompute a day if late readings arrive.
+CREATE TABLE IF NOT EXISTS plant_rollup_reading (
+    entry_id INTEGER PRIMARY KEY,
+    plant_id SMALLINT NOT NULL,
+    species text NOT NULL,
+    temperature FLOAT,
+    soil_moisture FLOAT,
+    recording_taken TIMESTAMP NOT NULL,
+    hour_rolled_up BOOLEAN NOT NULL DEFAULT FALSE,
+    day_rolled_up BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE INDEX IF NOT EXISTS plant_rollup_reading_plant_idx
+    ON plant_rollup_reading (plant_id, species, recording_taken);
@@ -4,7 +4,7 @@ CREATE DATABASE plant_database;
 
 CREATE TABLE IF NOT EXISTS sunlight (
     sunlight_id SERIAL PRIMARY KEY,
-    s_description text NOT NULL
+    s_description text NOT NULL UNIQUE
 );
 
 
@@ -27,14 +27,14 @@ VALUES ('-'),
 
 CREATE TABLE IF NOT EXISTS cycle (
     cycle_id SERIAL PRIMARY KEY,
-    cycle_name text
+    cycle_name text UNIQUE
 );
 
 
 CREATE TABLE IF NOT EXISTS botanist (
     botanist_id SERIAL PRIMARY KEY,
     b_name text NOT NULL,
-    b_email text NOT NULL,
+    b_email text NOT NULL UNIQUE,
     b_phone text NOT NULL
 );
 
@@ -47,7 +47,8 @@ CREATE TABLE IF NOT EXISTS species (
 
 
 CREATE TABLE plant (
-    plant_entry_id SERIAL PRIMARY KEY,
+    plant_entry_id SERIAL,
+    plant_id SMALLINT NOT NULL,
     species_id SMALLINT NOT NULL,
     temperature FLOAT,
     soil_moisture FLOAT,
@@ -56,6 +57,9 @@ CREATE TABLE plant (
     sunlight_id SMALLINT,
     botanist_id SMALLINT, 
     cycle_id SMALLINT,
+    PRIMARY KEY (plant_entry_id, recording_taken),
+    CONSTRAINT plant_reading_key
+        UNIQUE (plant_id, recording_taken),
     CONSTRAINT fk_sunlight_id
         FOREIGN KEY(sunlight_id)
             REFERENCES sunlight(sunlight_id),
@@ -68,4 +72,94 @@ CREATE TABLE plant (
     CONSTRAINT fk_species_id
         FOREIGN KEY(species_id)
             REFERENCES species(species_id)
-);
\ No newline at end of file
+) PARTITION BY RANGE (recording_taken);
+
+
+CREATE INDEX plant_recording_taken_idx ON plant (recording_taken);
+
+
+-- Readings are partitioned by day so archived days can be dropped whole.
+-- The archive job creates partitions ahead of time, the default partition
+-- only catches readings for days that have no partition yet. Those readings
+-- are moved into their day's partition when it is created.
+CREATE TABLE plant_default PARTITION OF plant DEFAULT;
+
+
+CREATE OR REPLACE FUNCTION create_plant_partition(day DATE) RETURNS VOID AS $$
+DECLARE
+    partition_name text := 'plant_' || to_char(day, 'YYYYMMDD');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM plant_default
+                   WHERE recording_taken >= day AND recording_taken < day + 1) THEN
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF plant FOR VALUES FROM (%L) TO (%L)',
+            partition_name, day, day + 1);
+        RETURN;
+    END IF;
+    -- The partition cannot be created while the default holds rows in its range.
+    ALTER TABLE plant DETACH PARTITION plant_default;
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF plant FOR VALUES FROM (%L) TO (%L)',
+        partition_name, day, day + 1);
+    WITH moved AS (
+        DELETE FROM plant_default
+        WHERE recording_taken >= day AND recording_taken < day + 1
+        RETURNING *)
+    INSERT INTO plant SELECT * FROM moved;
+    ALTER TABLE plant ATTACH PARTITION plant_default DEFAULT;
+END;
+$$ LANGUAGE plpgsql;
+
+
+SELECT create_plant_partition(CURRENT_DATE + offset_days)
+FROM generate_series(-1, 2) AS offset_days;
+
+
+-- How far the incremental archive job has archived and deleted readings.
+CREATE TABLE IF NOT EXISTS archive_watermark (
+    name text PRIMARY KEY,
+    archived_until TIMESTAMP NOT NULL
+);
+
+
+-- Hourly and daily summaries of archived readings, per plant and species.
+-- Readings stored before plant IDs were kept are rolled up under plant_id 0.
+CREATE TABLE IF NOT EXISTS plant_rollup (
+    granularity text NOT NULL,
+    period_start TIMESTAMP NOT NULL,
+    plant_id SMALLINT NOT NULL,
+    species text NOT NULL,
+    readings INT NOT NULL,
+    dropped_readings INT NOT NULL,
+    temperature_min FLOAT,
+    temperature_max FLOAT,
+    temperature_mean FLOAT,
+    temperature_p95 FLOAT,
+    soil_moisture_min FLOAT,
+    soil_moisture_max FLOAT,
+    soil_moisture_mean FLOAT,
+    soil_moisture_p95 FLOAT,
+    PRIMARY KEY (granularity, period_start, plant_id, species)
+);
+
+
+-- Keeps archived readings until the hour and day they fall in are fully archived,
+-- so each rollup is computed once from all of its readings. Readings are kept for
+-- a day after their day is rolled up, to count gaps that span a day boundary and to
+-- recompute a day if late readings arrive.
+CREATE TABLE IF NOT EXISTS plant_rollup_reading (
+    entry_id INTEGER PRIMARY KEY,
+    plant_id SMALLINT NOT NULL,
+    species text NOT NULL,
+    temperature FLOAT,
+    soil_moisture FLOAT,
+    recording_taken TIMESTAMP NOT NULL,
+    hour_rolled_up BOOLEAN NOT NULL DEFAULT FALSE,
+    day_rolled_up BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE INDEX IF NOT EXISTS plant_rollup_reading_plant_idx
+    ON plant_rollup_reading (plant_id, species, recording_taken);
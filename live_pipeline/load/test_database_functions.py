@@ -1,6 +1,11 @@
 """libraries required to test database functions"""
-from unittest.mock import MagicMock
-from database_functions import add_cycle_information, add_botanist_information, add_species_information, add_plant_information
+from os import listdir
+import time
+from unittest.mock import MagicMock, patch
+import pytest
+from psycopg2 import DatabaseError, DataError, OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+from database_functions import add_cycle_information, add_botanist_information, add_species_information, add_plant_information, load_plant_data, DimensionCache, ConnectionManager, get_db_connection, Spool, LocalSpoolBackend, S3SpoolBackend
 
 
 def test_add_cycle_info_if_false():
@@ -78,3 +83,208 @@ def test_add_plant_information(fake_row):
 
     assert fake_fetch.call_count == 4
     assert fake_execute.call_count == 5
+
+
+@patch("database_functions.execute_values")
+def test_load_plant_data_single_transaction(fake_execute_values, fake_clean_dataframe,
+                                            fake_warm_cache):
+    """Tests a warm cache means only the plant rows are inserted, with one commit"""
+    fake_connection = MagicMock()
+    fake_execute = fake_connection.cursor().__enter__().execute
+    fake_execute_values.return_value = [(1,), (2,), (3,)]
+
+    loaded = load_plant_data(fake_connection, fake_clean_dataframe, fake_warm_cache)
+
+    assert loaded == 3
+    assert fake_execute.call_count == 0
+    assert fake_execute_values.call_count == 1
+    assert fake_connection.commit.call_count == 1
+    plant_rows = fake_execute_values.call_args[0][2]
+    assert [row[0] for row in plant_rows] == [8, 9, 10]
+    assert [row[1] for row in plant_rows] == [1, 2, 3]
+    assert [row[6:] for row in plant_rows] == [(7, 1, 1), (2, 1, 1), (1, 2, 2)]
+
+
+@patch("database_functions.execute_values")
+def test_load_plant_data_skips_stored_readings(fake_execute_values, fake_clean_dataframe,
+                                               fake_warm_cache):
+    """Tests readings already stored are skipped and only new rows are counted"""
+    fake_connection = MagicMock()
+    fake_execute_values.return_value = [(4,)]
+
+    loaded = load_plant_data(fake_connection, fake_clean_dataframe, fake_warm_cache)
+
+    assert loaded == 1
+    assert "ON CONFLICT (plant_id, recording_taken) DO NOTHING" in \
+        fake_execute_values.call_args[0][1]
+    assert fake_execute_values.call_args[1]['fetch'] is True
+
+
+@patch("database_functions.execute_values")
+def test_load_plant_data_rolls_back_on_error(fake_execute_values, fake_clean_dataframe,
+                                             fake_warm_cache):
+    """Tests nothing is committed and the cache is cleared if any statement fails"""
+    fake_connection = MagicMock()
+    fake_execute_values.side_effect = DatabaseError("fake failure")
+
+    with pytest.raises(DatabaseError):
+        load_plant_data(fake_connection, fake_clean_dataframe, fake_warm_cache)
+
+    assert fake_connection.commit.call_count == 0
+    assert fake_connection.rollback.call_count == 1
+    assert fake_warm_cache.warmed is False
+
+
+def test_dimension_cache_warm_up():
+    """Tests each dimension table is read once to warm the cache"""
+    fake_connection = MagicMock()
+    fake_fetch = fake_connection.cursor().__enter__().fetchall
+    fake_fetch.side_effect = [[('full sun', 2)], [('Perennial', 1)],
+                              [('carl.linnaeus@lnhm.co.uk', 1)], [('Ficus', 1)]]
+    cache = DimensionCache()
+
+    cache.warm_up(fake_connection)
+
+    assert fake_fetch.call_count == 4
+    assert cache.warmed is True
+    assert cache.ids['cycle'] == {'Perennial': 1}
+
+
+@patch("database_functions.execute_values")
+def test_dimension_cache_only_upserts_new_keys(fake_execute_values, fake_clean_dataframe):
+    """Tests only keys missing from the cache are upserted, once each"""
+    fake_connection = MagicMock()
+    cache = DimensionCache()
+    cache.ids['botanist'] = {'carl.linnaeus@lnhm.co.uk': 1}
+    fake_execute_values.return_value = [('gertrude.jekyll@lnhm.co.uk', 5)]
+
+    ids = cache.resolve(fake_connection, 'botanist', fake_clean_dataframe[
+        ['Botanist_Name', 'Botanist_Email', 'Botanist_Phone']])
+
+    assert ids == [1, 1, 5]
+    assert fake_execute_values.call_args[0][2] == [
+        ('Gertrude Jekyll', 'gertrude.jekyll@lnhm.co.uk', '001-481-273-3691x127')]
+    assert fake_execute_values.call_args[1]['fetch'] is True
+
+
+@patch("database_functions.connect")
+def test_connection_reused_while_healthy(fake_connect, fake_config):
+    """Tests a healthy connection is reused rather than reconnecting"""
+    fake_connect.return_value.closed = 0
+    fake_connect.return_value.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+    manager = ConnectionManager()
+
+    first = manager.get(fake_config)
+    second = manager.get(fake_config)
+
+    assert first is second
+    assert fake_connect.call_count == 1
+    assert fake_connect.call_args[1]['keepalives'] == 1
+    assert 'statement_timeout' in fake_connect.call_args[1]['options']
+
+
+@patch("database_functions.connect")
+def test_reconnect_when_health_check_fails(fake_connect, fake_config):
+    """Tests a broken connection is closed and replaced"""
+    broken = MagicMock(closed=0)
+    broken.cursor().__enter__().execute.side_effect = OperationalError("server closed")
+    fake_connect.side_effect = [broken, MagicMock(closed=0)]
+    manager = ConnectionManager()
+
+    manager.get(fake_config)
+    connection = manager.get(fake_config)
+
+    assert connection is not broken
+    assert fake_connect.call_count == 2
+    assert broken.close.call_count == 1
+
+
+@patch("database_functions.connect")
+def test_leftover_transaction_rolled_back(fake_connect, fake_config):
+    """Tests a transaction left open by an aborted invocation is rolled back, not reused"""
+    fake_connect.return_value.closed = 0
+    fake_connect.return_value.get_transaction_status.return_value = TRANSACTION_STATUS_INTRANS
+    manager = ConnectionManager()
+
+    manager.get(fake_config)
+    manager.get(fake_config)
+
+    assert fake_connect.call_count == 1
+    assert fake_connect.return_value.rollback.call_count == 1
+
+
+@patch("database_functions.CONNECTION_MANAGER")
+def test_get_db_connection_returns_none_when_unreachable(fake_manager, fake_config):
+    """Tests a failed connection gives None rather than an error string"""
+    fake_manager.get.side_effect = OperationalError("could not connect")
+
+    assert get_db_connection(fake_config) is None
+
+
+@patch("database_functions.load_plant_data")
+def test_spool_replays_batches_in_one_load(fake_load, fake_clean_dataframe, tmp_path):
+    """Tests spooled batches are combined into a single load then removed"""
+    fake_load.return_value = 6
+    spool = Spool(LocalSpoolBackend(str(tmp_path)))
+    spool.append(fake_clean_dataframe)
+    spool.append(fake_clean_dataframe)
+
+    metrics = spool.replay(MagicMock())
+
+    assert fake_load.call_count == 1
+    replayed = fake_load.call_args[0][1]
+    assert len(replayed) == 6
+    assert replayed['Plant_Id'].tolist() == [8, 9, 10, 8, 9, 10]
+    assert replayed['Botanist_Phone'].iloc[2] == '001-481-273-3691x127'
+    assert metrics['batches'] == 2 and metrics['rows'] == 6
+    assert spool.backend.list() == []
+
+
+@patch("database_functions.load_plant_data")
+def test_spool_kept_if_replay_fails(fake_load, fake_clean_dataframe, tmp_path):
+    """Tests batches stay in the spool if loading them fails"""
+    fake_load.side_effect = OperationalError("server closed")
+    spool = Spool(LocalSpoolBackend(str(tmp_path)))
+    spool.append(fake_clean_dataframe)
+
+    with pytest.raises(OperationalError):
+        spool.replay(MagicMock())
+
+    assert len(spool.backend.list()) == 1
+
+
+@patch("database_functions.load_plant_data")
+def test_rejected_spool_batch_quarantined(fake_load, fake_clean_dataframe, tmp_path):
+    """Tests a batch the database rejects, or that can't be read, is quarantined
+    and the other batches are still loaded"""
+    spool = Spool(LocalSpoolBackend(str(tmp_path)))
+    bad_name = spool.append(fake_clean_dataframe)
+    good_name = spool.append(fake_clean_dataframe.head(2))
+    spool.backend.write(f"{time.time_ns():020d}.jsonl.gz", b"not gzip")
+
+    def fake_load_rows(conn, dataframe):
+        if len(dataframe) != 2:
+            raise DataError("bad value")
+        return 2
+    fake_load.side_effect = fake_load_rows
+
+    metrics = spool.replay(MagicMock())
+
+    assert metrics['quarantined'] == 2
+    assert metrics['inserted'] == 2
+    assert spool.backend.list() == []
+    quarantined = sorted(listdir(tmp_path / "quarantine"))
+    assert bad_name in quarantined and good_name not in quarantined
+    assert len(quarantined) == 2
+
+
+def test_s3_spool_backend_lists_batches_under_prefix():
+    """Tests only spooled batches under the prefix are listed, oldest first"""
+    fake_s3 = MagicMock()
+    fake_s3.get_paginator().paginate.return_value = [
+        {"Contents": [{"Key": "spool/2.jsonl.gz"}, {"Key": "spool/1.jsonl.gz"}]},
+        {"Contents": [{"Key": "spool/notes.txt"},
+                      {"Key": "spool/quarantine/0.jsonl.gz"}]}]
+    backend = S3SpoolBackend("fake-bucket", s3_client=fake_s3)
+
+    assert backend.list() == ["1.jsonl.gz", "2.jsonl.gz"]
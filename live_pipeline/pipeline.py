@@ -1,65 +1,253 @@
 """libraries needed for the overall pipeline script"""
 import json
 import time
-from os import environ
+from os import environ, path, makedirs
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor, Future
 from dotenv import load_dotenv
 import pandas as pd
 
-from pipeline_functions import get_plants, create_list_for_data, validate_time_for_last_watered, validate_time_for_time_recorded, check_temperature_within_correct_ranges, check_soil_moisture_within_correct_ranges, delete_rows_containing_invalid_data, send_alerts_for_abnormal_results, get_db_connection, add_cycle_information, add_botanist_information, add_species_information, add_plant_information
+from pipeline_functions import get_plants, iter_plants, get_plant_ids, get_deadline, filter_unchanged_readings, update_last_seen, load_failure_log, load_last_seen_index, save_last_seen_index, create_columns_for_data, clean_plant_data, load_alert_state, send_alerts_for_abnormal_results, get_db_connection, load_plant_data, get_spool, CONNECTION_ERRORS, ALERT_STATE
+
+DATETIME_COLUMNS = ['Last_Watered', 'Recording_Time']
+PIPELINE_QUEUE_SIZE = 20
+MICRO_BATCH_SIZE = 10
+MICRO_BATCH_WAIT = 0.5
+END_OF_STREAM = object()
+
+
+def write_debug_snapshot(filename: str, data: dict | pd.DataFrame) -> None:
+    """Writes a stage's output to SNAPSHOT_DIR, if set, for debugging."""
+    snapshot_dir = environ.get("SNAPSHOT_DIR")
+    if not snapshot_dir:
+        return
+    makedirs(snapshot_dir, exist_ok=True)
+    if isinstance(data, pd.DataFrame):
+        data.to_csv(path.join(snapshot_dir, filename))
+    else:
+        with open(path.join(snapshot_dir, filename), 'w', encoding="utf-8") as file:
+            json.dump(data, file, indent=4)
+
+
+def extract(plant_ids: list[int], deadline: float, last_seen_index: dict,
+            shard_index: int = 0, shard_count: int = 1) -> tuple[dict, dict]:
+    """Fetches the plants and drops readings that haven't changed since the last run"""
+    failure_log = load_failure_log(bucket=environ.get("FAILURE_BUCKET"),
+                                   shard_index=shard_index, shard_count=shard_count)
+    data = get_plants(plant_ids, deadline=deadline, failure_log=failure_log)
+    failure_log.flush()
+    data, last_seen_index = filter_unchanged_readings(data, last_seen_index)
+    write_debug_snapshot("plants.json", data)
+    return data, last_seen_index
+
+
+def clean(data: dict) -> pd.DataFrame:
+    """Cleans the raw plant data into a typed DataFrame"""
+    data_frame = pd.DataFrame(create_columns_for_data(data))
+    return clean_plant_data(data_frame)
+
+
+def alert(clean_df: pd.DataFrame, config=None, shard_index: int = 0,
+          shard_count: int = 1) -> None:
+    """Sends the alerts for a run's clean data and saves the alert state.
+
+    Called once per run, so each botanist gets a single digest. The state is kept
+    in ALERT_BUCKET, one object per shard, if it is set, otherwise in a local file"""
+    alert_state_path = environ.get("ALERT_STATE", ALERT_STATE)
+    alert_state = load_alert_state(alert_state_path, bucket=environ.get("ALERT_BUCKET"),
+                                   shard_index=shard_index, shard_count=shard_count)
+    send_alerts_for_abnormal_results(clean_df, config, state=alert_state)
+    alert_state.save(alert_state_path)
+    write_debug_snapshot("clean_data.csv", clean_df)
+
+
+def transform(data: dict, config=None) -> pd.DataFrame:
+    """Cleans the raw plant data into a typed DataFrame and sends any alerts"""
+    clean_df = clean(data)
+    alert(clean_df, config)
+    return clean_df
+
+
+def replay_spool(connection, spool) -> None:
+    """Replays the spooled backlog, reporting rather than raising any failure that
+    isn't a lost connection, so the current batch is still loaded"""
+    try:
+        spool.replay(connection)
+    except CONNECTION_ERRORS:
+        raise
+    except Exception as err:
+        print(f"Spool replay failed - {err}")
+
+
+def replay_spool_if_connected(connection, spool) -> None:
+    """Replays the spool when there is a connection, leaving it for a later run if
+    the database can't be reached"""
+    if connection is None or spool is None:
+        return
+    try:
+        replay_spool(connection, spool)
+    except CONNECTION_ERRORS as err:
+        print(f"Database unavailable, spool not replayed - {err}")
+
+
+def load(connection, clean_df: pd.DataFrame, spool=None, replay: bool = True) -> str:
+    """Loads the clean data into the database in a single transaction.
+
+    Timestamps are stored as London wall-clock time. Unless replay is False, any
+    spooled batches are replayed first. If the database can't be reached or rejects the batch, it is
+    spooled instead, and the returned status says which happened."""
+    load_df = clean_df.copy()
+    for column in DATETIME_COLUMNS:
+        load_df[column] = pd.to_datetime(load_df[column]).dt.tz_localize(None)
+
+    try:
+        if connection is None:
+            raise ConnectionError("No database connection")
+        if spool is not None and replay:
+            replay_spool(connection, spool)
+        load_plant_data(connection, load_df)
+    except (ConnectionError, *CONNECTION_ERRORS) as err:
+        if spool is None:
+            raise
+        print(f"Database unavailable, spooling batch - {err}")
+        spool.append(load_df)
+        return "spooled"
+    except Exception as err:
+        if spool is None:
+            raise
+        print(f"Database rejected the batch, spooling it - {err}")
+        spool.append(load_df)
+        return "spooled"
+    return "success"
+
+
+def put_with_backpressure(plant_queue: Queue, item, consumer: Future) -> bool:
+    """Blocks until the queue has room. Returns False if the consumer has stopped."""
+    while not consumer.done():
+        try:
+            plant_queue.put(item, timeout=MICRO_BATCH_WAIT)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def consume_micro_batches(plant_queue: Queue, connection, spool, config=None,
+                          batch_size: int = MICRO_BATCH_SIZE,
+                          batch_wait: float = MICRO_BATCH_WAIT, shard_index: int = 0,
+                          shard_count: int = 1) -> list[str]:
+    """Cleans and loads plants from the queue in micro-batches until the end of the stream.
+
+    A micro-batch is loaded once it holds batch_size plants, or when no plant has
+    arrived for batch_wait seconds. The spool is left to the caller to replay, and
+    alerts for the whole run are sent once the stream ends. Returns the load status
+    of each micro-batch."""
+    statuses = []
+    clean_frames = []
+    batch = {}
+    while True:
+        try:
+            item = plant_queue.get(timeout=batch_wait)
+        except Empty:
+            item = None
+        finished = item is END_OF_STREAM
+        if item is not None and not finished:
+            plant_id, raw_data = item
+            batch[plant_id] = raw_data
+        if batch and (item is None or finished or len(batch) >= batch_size):
+            clean_df = clean(batch)
+            if not clean_df.empty:
+                statuses.append(load(connection, clean_df, spool, replay=False))
+                clean_frames.append(clean_df)
+            batch = {}
+        if finished:
+            if clean_frames:
+                alert(pd.concat(clean_frames, ignore_index=True), config,
+                      shard_index, shard_count)
+            return statuses
+
+
+def run_pipelined(plant_ids: list[int], deadline: float, last_seen_index: dict,
+                  connection, spool, config=None, shard_index: int = 0,
+                  shard_count: int = 1) -> tuple[list[str], dict]:
+    """Extracts, transforms and loads at the same time.
+
+    Plants are queued as soon as their responses arrive and a consumer thread loads
+    them in micro-batches, so the database is written to while the API is still
+    being polled. The bounded queue holds back the fetches if loading falls behind.
+    The spool is replayed once before loading starts.
+    Returns the status of each micro-batch and the updated last-seen index."""
+    failure_log = load_failure_log(bucket=environ.get("FAILURE_BUCKET"),
+                                   shard_index=shard_index, shard_count=shard_count)
+    replay_spool_if_connected(connection, spool)
+    last_seen_index = dict(last_seen_index)
+    plant_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        consumer = executor.submit(
+            consume_micro_batches, plant_queue, connection, spool, config,
+            shard_index=shard_index, shard_count=shard_count)
+        try:
+            for plant_id, raw_data in iter_plants(
+                    plant_ids, deadline=deadline, failure_log=failure_log):
+                if not update_last_seen(plant_id, raw_data, last_seen_index):
+                    continue
+                if not put_with_backpressure(plant_queue, (plant_id, raw_data), consumer):
+                    break
+        finally:
+            put_with_backpressure(plant_queue, END_OF_STREAM, consumer)
+        statuses = consumer.result()
+    failure_log.flush()
+    return statuses, last_seen_index
 
 
 def handler(event=None, context=None):
-    """Contains all the functions required to complete extract, transform and load"""
+    """Contains all the functions required to complete extract, transform and load.
+
+    The event may contain shard_index and shard_count to split the plant IDs
+    between several concurrent invocations, and pipelined to load plants in
+    micro-batches while the rest are still being fetched."""
     start = time.time()
+    event = event or {}
+    load_dotenv()
+    configuration = environ
 
-    data = get_plants()
-    with open("/tmp/plants.json", 'w', encoding="utf-8") as plant_file:
-        json.dump(data, plant_file, indent=4)
+    deadline = get_deadline(context)
+    shard_index, shard_count = event.get("shard_index", 0), event.get("shard_count", 1)
+    plant_ids = get_plant_ids(shard_index, shard_count, deadline=deadline)
+
+    if event.get("pipelined"):
+        statuses, last_seen_index = run_pipelined(
+            plant_ids, deadline, load_last_seen_index(),
+            get_db_connection(configuration), get_spool(configuration), configuration,
+            shard_index, shard_count)
+        save_last_seen_index(last_seen_index)
+        print(time.time() - start)
+        if not statuses:
+            return {'status': "no new readings"}
+        return {'status': "spooled" if "spooled" in statuses else "success"}
+
+    data, last_seen_index = extract(
+        plant_ids, deadline, load_last_seen_index(), shard_index, shard_count)
+    if not data:
+        spool = get_spool(configuration)
+        if spool.get_metrics()["batches"]:
+            replay_spool_if_connected(get_db_connection(configuration), spool)
+        return {'status': "no new readings"}
 
     print(time.time() - start)
 
-    with open('/tmp/plants.json', 'r', encoding="utf-8") as f_obj:
-        data = json.load(f_obj)
-
-    all_plants = create_list_for_data(data)
-
-    data_frame = pd.DataFrame.from_dict(all_plants)
-
-    data_frame['Botanist_Name'] = data_frame['Botanist_Name'].apply(
-        lambda x: x.title())
-
-    data_frame['Last_Watered'] = data_frame['Last_Watered'].map(
-        validate_time_for_last_watered)
-
-    data_frame['Recording_Time'] = data_frame['Recording_Time'].map(
-        validate_time_for_time_recorded)
+    clean_df = clean(data)
 
-    data_frame['Temperature'] = data_frame['Temperature'].map(
-        check_temperature_within_correct_ranges)
-
-    data_frame['Soil_Moisture'] = data_frame['Soil_Moisture'].map(
-        check_soil_moisture_within_correct_ranges)
-
-    clean_df = delete_rows_containing_invalid_data(data_frame)
-
-    send_alerts_for_abnormal_results(clean_df)
+    connection = get_db_connection(configuration)
 
-    clean_df.to_csv('/tmp/clean_data.csv')
+    status = load(connection, clean_df, get_spool(configuration))
 
-    load_dotenv()
-    configuration = environ
-    connection = get_db_connection(configuration)
+    save_last_seen_index(last_seen_index)
 
-    data_frame = pd.read_csv("/tmp/clean_data.csv")
-    for row in data_frame.itertuples():
-        cycle = row[9]
-        add_cycle_information(connection, cycle)
-        add_botanist_information(connection, row)
-        add_species_information(connection, row)
-        add_plant_information(connection, row)
+    alert(clean_df, configuration, shard_index, shard_count)
 
     print(time.time() - start)
-    return {'status': "success"}
+    return {'status': status}
 
 
 if __name__ == "__main__":
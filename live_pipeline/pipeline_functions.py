@@ -1,41 +1,149 @@
 """Pipeline script containing all of extract, transform and load, created for AWS Lambda.
     Libraries required for pipeline function"""
 from datetime import datetime as dt
-from os import environ
+from dataclasses import dataclass
+from operator import attrgetter, itemgetter
+from io import BytesIO
+from os import environ, listdir, makedirs, path, remove, replace
 import json
+import time
+import random
+import hashlib
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
 import pytz
+import pandas as pd
 from boto3 import client
+from botocore.exceptions import BotoCoreError, ClientError
 from dotenv import load_dotenv
-from psycopg2 import connect
-from psycopg2.extras import RealDictCursor
+from psycopg2 import connect, sql, Error, OperationalError, InterfaceError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
 
 
 START_ID = 1
 END_ID = 51
 URL = f"https://data-eng-plants-api.herokuapp.com/plants/"
+MAX_WORKERS = 10
+REQUEST_TIMEOUT = 10
+RETRY_ATTEMPTS = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 4
+DEFAULT_DEADLINE = 90
+DEADLINE_MARGIN = 30
+BREAKER_MIN_CALLS = 10
+BREAKER_FAILURE_RATIO = 0.8
+DISCOVERY_WINDOW = 10
+DISCOVERY_TTL = 3600
+DISCOVERY_MAX_WINDOWS = 20
+FAILURE_COUNTERS = "/tmp/plant_failures.json"
+FAILURE_COUNTERS_KEY = "plant_failures_{shard_index}_of_{shard_count}.json"
+CHRONIC_MISSING = 5
+CHRONIC_POLL_INTERVAL = 900
+LAST_SEEN_INDEX = "/tmp/last_seen_readings.json"
+DISCOVERY_CACHE = "/tmp/plant_id_range.json"
 LOWER_TEMP_LIMIT = 8
 UPPER_TEMP_LIMIT = 40
 LOWER_SOIL_LIMIT = 21
+ALERT_WORKERS = 5
+ALERT_STATE = "/tmp/alert_state.json"
+ALERT_STATE_KEY = "alert_state_{shard_index}_of_{shard_count}.json"
+ALERT_COOLDOWN = 3600
+ALERT_HYSTERESIS = 1
+SPOOL_DIR = "/tmp/spool"
+SPOOL_SUFFIX = ".jsonl.gz"
+SPOOL_QUARANTINE = "quarantine"
+SPOOL_REPLAY_ROWS = 50000
+LOAD_PAGE_SIZE = 1000
+CONNECT_TIMEOUT = 5
+STATEMENT_TIMEOUT_MS = 30000
+KEEPALIVE_OPTIONS = {"keepalives": 1, "keepalives_idle": 30,
+                     "keepalives_interval": 10, "keepalives_count": 3}
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+DIMENSIONS = {
+    'sunlight': ('sunlight_id', 's_description', ['s_description']),
+    'cycle': ('cycle_id', 'cycle_name', ['cycle_name']),
+    'botanist': ('botanist_id', 'b_email', ['b_name', 'b_email', 'b_phone']),
+    'species': ('species_id', 's_name', ['s_name'])}
+# Naive API times are read as UTC, the Lambda's local time, as astimezone() did.
+SOURCE_TIMEZONE = "UTC"
 
 
-def logs(plant_id: int, missing_plants: dict, code: int) -> None:
-    """Logs the missing plant id and the current datetime to a json file."""
+class FailureLog:
+    """Buffers failed plant requests in memory so they can be logged once per run.
 
-    current_datetime = dt.now()
+    Also keeps per-plant failure counters so chronically missing plants are
+    polled less often."""
 
-    if code == 404:
-        missing_plants[str(current_datetime)
-                       ] = f"Data not found for plant_id {plant_id}, 404"
-    elif code == 500:
-        missing_plants[str(current_datetime)
-                       ] = f"Server error for plant_id {plant_id}, 500"
+    def __init__(self, counters: dict = None, bucket: str = None, key: str = None):
+        """Creates a new FailureLog with the counters from previous runs.
 
+        The counters are saved to key in the bucket if one is given."""
+        self.events = []
+        self.counters = counters or {}
+        self.bucket = bucket
+        self.key = key
+
+    def record(self, plant_id: int, code: int | None, latency: float) -> None:
+        """Records a failed request for a plant."""
+        self.events.append({"plant_id": plant_id, "code": code,
+                            "latency": round(latency, 3),
+                            "timestamp": str(dt.now())})
+        counter = self.counters.setdefault(
+            str(plant_id), {"missing": 0, "failures": 0, "last_attempt": 0})
+        counter["failures"] += 1
+        counter["last_attempt"] = time.time()
+        if code == 404:
+            counter["missing"] += 1
+
+    def record_success(self, plant_id: int) -> None:
+        """Resets the consecutive missing count for a plant that responded."""
+        if str(plant_id) in self.counters:
+            self.counters[str(plant_id)]["missing"] = 0
+
+    def should_poll(self, plant_id: int) -> bool:
+        """Returns False for chronically missing plants polled within CHRONIC_POLL_INTERVAL."""
+        counter = self.counters.get(str(plant_id))
+        if counter is None or counter["missing"] < CHRONIC_MISSING:
+            return True
+        return time.time() - counter["last_attempt"] >= CHRONIC_POLL_INTERVAL
+
+    def flush(self, counters_path: str = FAILURE_COUNTERS) -> None:
+        """Prints the buffered events as JSON lines and saves the counters.
+
+        Lambda sends stdout to CloudWatch Logs, so the events outlive /tmp. The
+        counters go to the bucket if one is set, otherwise to counters_path."""
+        for event in self.events:
+            print(json.dumps({"event": "plant_request_failed", **event}))
+        self.events = []
+        try:
+            if self.bucket:
+                client("s3").put_object(Bucket=self.bucket, Key=self.key,
+                                        Body=json.dumps(self.counters).encode("utf-8"))
+            else:
+                with open(counters_path, 'w', encoding="utf-8") as file:
+                    json.dump(self.counters, file)
+        except (OSError, BotoCoreError, ClientError) as err:
+            print(f"An error occurred while saving the failure counters: {err}")
+
+
+def load_failure_log(counters_path: str = FAILURE_COUNTERS, bucket: str = None,
+                     shard_index: int = 0, shard_count: int = 1) -> FailureLog:
+    """Returns a FailureLog holding the failure counters saved by earlier runs.
+
+    The counters are read from the bucket if one is given, otherwise from counters_path.
+    Each shard keeps its own object, so concurrent shards don't overwrite each other."""
+    key = FAILURE_COUNTERS_KEY.format(shard_index=shard_index, shard_count=shard_count)
     try:
-        with open("/tmp/missing_plants.json", 'w') as file:
-            json.dump(missing_plants, file, indent=4)
-    except Exception as e:
-        print(f"An error occurred while writing to the file: {e}")
+        if bucket:
+            body = client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+            return FailureLog(json.loads(body.read()), bucket, key)
+        with open(counters_path, 'r', encoding="utf-8") as file:
+            return FailureLog(json.load(file))
+    except (OSError, ValueError, BotoCoreError, ClientError):
+        return FailureLog(bucket=bucket, key=key)
 
 
 class APIError(Exception):
@@ -47,30 +155,274 @@ class APIError(Exception):
         self.code = code
 
 
-def get_plants() -> dict:
-    """ Hit's each endpoint and fetches all the available plant data"""
-    plants = {}
-    missing_plants = {}
+def create_session(max_workers: int = MAX_WORKERS) -> requests.Session:
+    """Returns a keep-alive session with a connection pool sized to the worker count."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_plant(session: requests.Session, plant_id: int,
+                timeout: float = REQUEST_TIMEOUT) -> requests.Response:
+    """Fetches the data for a single plant over the shared session."""
+    return session.get(f"{URL}{plant_id}", timeout=timeout)
+
+
+class CircuitBreaker:
+    """Stops calls to the API once most of the calls made have failed."""
+
+    def __init__(self, min_calls: int = BREAKER_MIN_CALLS,
+                 failure_ratio: float = BREAKER_FAILURE_RATIO):
+        """Creates a new closed CircuitBreaker."""
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.calls = 0
+        self.failures = 0
+        self.lock = Lock()
+
+    def record(self, success: bool) -> None:
+        """Records the outcome of a single call."""
+        with self.lock:
+            self.calls += 1
+            if not success:
+                self.failures += 1
+
+    @property
+    def is_open(self) -> bool:
+        """True when enough calls have failed that the API should be left alone."""
+        with self.lock:
+            return (self.calls >= self.min_calls
+                    and self.failures / self.calls >= self.failure_ratio)
+
+
+def get_deadline(context=None) -> float:
+    """Returns the monotonic time by which extraction must finish.
+
+    Uses the Lambda context's remaining time, keeping DEADLINE_MARGIN seconds
+    back for transform and load."""
+    if context is None:
+        return time.monotonic() + DEFAULT_DEADLINE
+    remaining = context.get_remaining_time_in_millis() / 1000
+    return time.monotonic() + remaining - DEADLINE_MARGIN
+
+
+def get_backoff(attempt: int) -> float:
+    """Returns a full-jitter exponential backoff delay for the given attempt."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def fetch_plant_with_retry(session: requests.Session, plant_id: int, timeout: float,
+                           deadline: float, breaker: CircuitBreaker) -> requests.Response | None:
+    """Fetches a plant, retrying server errors and failed requests until the deadline.
+
+    Returns None if no response was received."""
+    response = None
+    for attempt in range(RETRY_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or breaker.is_open:
+            break
+        try:
+            response = fetch_plant(session, plant_id, min(timeout, remaining))
+        except requests.exceptions.RequestException as err:
+            print(f"Request for plant_id {plant_id} failed - {err}")
+            response = None
+        success = response is not None and response.status_code < 500
+        breaker.record(success)
+        if success:
+            return response
+        delay = get_backoff(attempt)
+        if attempt + 1 < RETRY_ATTEMPTS and time.monotonic() + delay < deadline:
+            time.sleep(delay)
+    return response
+
+
+def discover_end_id(session: requests.Session, end_id: int = END_ID,
+                    window: int = DISCOVERY_WINDOW, timeout: float = REQUEST_TIMEOUT,
+                    deadline: float = None, breaker: CircuitBreaker = None,
+                    max_windows: int = DISCOVERY_MAX_WINDOWS) -> int:
+    """Grows the plant ID range until a whole window of IDs past the end has no plant.
+
+    Only a 200 counts as a plant. The search keeps the range found so far and stops
+    after max_windows windows, at the deadline, or once the circuit breaker opens."""
+    if deadline is None:
+        deadline = get_deadline()
+    if breaker is None:
+        breaker = CircuitBreaker()
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        for _ in range(max_windows):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or breaker.is_open:
+                print(f"Plant ID discovery stopped early at {end_id}")
+                return end_id
+            probe_ids = range(end_id, end_id + window)
+            statuses = list(executor.map(
+                lambda plant_id: probe_plant(session, plant_id, min(timeout, remaining)),
+                probe_ids))
+            for status in statuses:
+                breaker.record(status is not None and status < 500)
+            found = [plant_id for plant_id, status in zip(probe_ids, statuses)
+                     if status == 200]
+            if not found:
+                return end_id
+            end_id = max(found) + 1
+    print(f"Plant ID discovery reached the limit of {max_windows} windows at {end_id}")
+    return end_id
+
+
+def probe_plant(session: requests.Session, plant_id: int, timeout: float) -> int | None:
+    """Returns the status code for a plant ID, or None if the request failed."""
+    try:
+        return fetch_plant(session, plant_id, timeout).status_code
+    except requests.exceptions.RequestException:
+        return None
+
+
+def load_id_range_cache(cache_path: str = DISCOVERY_CACHE) -> dict:
+    """Returns the cached end of the plant ID range, or an empty dict if there is none."""
+    try:
+        with open(cache_path, 'r', encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_id_range_cache(end_id: int, cache_path: str = DISCOVERY_CACHE) -> None:
+    """Caches the discovered end of the plant ID range for later runs."""
     try:
-        for plant_id in range(START_ID, END_ID):
-            response = requests.get(
-                f"{URL}{plant_id}")
-            if response.status_code == 200:
-                json_file = response.json()
-                plants[plant_id] = json_file
-            elif response.status_code == 404:
-                logs(plant_id, missing_plants, response.status_code)
-            elif response.status_code == 500:
-                print(f"500 for {plant_id}")
-                logs(plant_id, missing_plants, response.status_code)
-
-        return plants
-    except requests.exceptions.RequestException as err:
-        raise APIError(f"An exception occurred - {str(err)}")
-
-
-def create_dictionary_for_plant(raw_data: dict) -> dict:
-    """Dictionary created from extracted file"""
+        with open(cache_path, 'w', encoding="utf-8") as file:
+            json.dump({"end_id": end_id, "discovered_at": time.time()}, file)
+    except OSError as err:
+        print(f"An error occurred while writing to the file: {err}")
+
+
+def get_plant_ids(shard_index: int = 0, shard_count: int = 1,
+                  cache_path: str = DISCOVERY_CACHE, deadline: float = None) -> list[int]:
+    """Returns the plant IDs belonging to this shard.
+
+    The end of the ID range is rediscovered, within the run's deadline, once the
+    cached value is older than DISCOVERY_TTL. IDs are split by modulo so shards
+    never overlap."""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("Shard index must be between 0 and the shard count")
+
+    cached = load_id_range_cache(cache_path)
+    end_id = cached.get("end_id")
+    if end_id is None or time.time() - cached["discovered_at"] > DISCOVERY_TTL:
+        with create_session(DISCOVERY_WINDOW) as session:
+            end_id = discover_end_id(session, max(end_id or END_ID, END_ID),
+                                     deadline=deadline)
+        save_id_range_cache(end_id, cache_path)
+
+    return [plant_id for plant_id in range(START_ID, end_id)
+            if plant_id % shard_count == shard_index]
+
+
+def iter_plants(plant_ids: list[int] = None, max_workers: int = MAX_WORKERS,
+                timeout: float = REQUEST_TIMEOUT, deadline: float = None,
+                failure_log: FailureLog = None):
+    """Hits each endpoint concurrently, yielding each plant ID and its data as soon as it arrives.
+
+    Plants that still fail after retrying are recorded in the failure log and skipped."""
+    if plant_ids is None:
+        plant_ids = range(START_ID, END_ID)
+    if deadline is None:
+        deadline = get_deadline()
+    if failure_log is None:
+        failure_log = FailureLog()
+    plant_ids = [plant_id for plant_id in plant_ids if failure_log.should_poll(plant_id)]
+    fetched = 0
+    breaker = CircuitBreaker()
+
+    with create_session(max_workers) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def timed_fetch(plant_id: int) -> tuple[requests.Response | None, float]:
+            started = time.monotonic()
+            response = fetch_plant_with_retry(session, plant_id, timeout, deadline, breaker)
+            return response, time.monotonic() - started
+
+        futures = {executor.submit(timed_fetch, plant_id): plant_id for plant_id in plant_ids}
+        for future in as_completed(futures):
+            plant_id = futures[future]
+            response, latency = future.result()
+            if response is not None and response.status_code == 200:
+                try:
+                    json_file = response.json()
+                except ValueError:
+                    print(f"Invalid JSON for plant_id {plant_id}")
+                else:
+                    failure_log.record_success(plant_id)
+                    fetched += 1
+                    yield plant_id, json_file
+                    continue
+            failure_log.record(
+                plant_id, None if response is None else response.status_code, latency)
+
+    if not fetched and breaker.is_open:
+        raise APIError("Circuit breaker open - the plants API is failing.")
+
+
+def get_plants(plant_ids: list[int] = None, max_workers: int = MAX_WORKERS,
+               timeout: float = REQUEST_TIMEOUT, deadline: float = None,
+               failure_log: FailureLog = None) -> dict:
+    """ Hit's each endpoint concurrently and fetches all the available plant data.
+
+    Plants that still fail after retrying are recorded in the failure log and left
+    out, so a partial result is returned rather than losing the whole run."""
+    plants = iter_plants(plant_ids, max_workers, timeout, deadline, failure_log)
+    return dict(sorted(plants, key=itemgetter(0)))
+
+
+def get_reading_hash(raw_data: dict) -> str:
+    """Returns a stable hash of a plant's API payload."""
+    return hashlib.sha1(json.dumps(raw_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_last_seen_index(index_path: str = LAST_SEEN_INDEX) -> dict:
+    """Returns the last reading seen for each plant ID, or an empty dict if there is none."""
+    try:
+        with open(index_path, 'r', encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_last_seen_index(last_seen: dict, index_path: str = LAST_SEEN_INDEX) -> None:
+    """Persists the last reading seen for each plant ID."""
+    try:
+        with open(index_path, 'w', encoding="utf-8") as file:
+            json.dump(last_seen, file)
+    except OSError as err:
+        print(f"An error occurred while writing to the file: {err}")
+
+
+def update_last_seen(plant_id: int, raw_data: dict, last_seen: dict) -> bool:
+    """Returns True if a reading differs from the last one seen for its plant,
+    recording it in last_seen in place.
+
+    The index is keyed by plant ID and holds the recording time and payload hash."""
+    entry = [raw_data.get("recording_taken"), get_reading_hash(raw_data)]
+    if last_seen.get(str(plant_id)) == entry:
+        return False
+    last_seen[str(plant_id)] = entry
+    return True
+
+
+def filter_unchanged_readings(plants: dict, last_seen: dict) -> tuple[dict, dict]:
+    """Drops readings whose recording time and payload match the last one seen.
+
+    Returns the changed readings and an updated copy of the index."""
+    updated = dict(last_seen)
+    changed = {plant_id: raw_data for plant_id, raw_data in plants.items()
+               if update_last_seen(plant_id, raw_data, updated)}
+    return changed, updated
+
+
+def create_dictionary_for_plant(raw_data: dict, plant_id: int = None) -> dict:
+    """Dictionary created from extracted file, using the plant ID it was fetched
+    with when the payload has none"""
     plant_dict = {}
     plant_dict['Botanist_Name'] = raw_data['botanist']['name']
     plant_dict['Botanist_Email'] = raw_data['botanist']['email']
@@ -108,6 +460,8 @@ def create_dictionary_for_plant(raw_data: dict) -> dict:
         sun_choices = format_sun_choices(raw_data['sunlight'])
         plant_dict['Sunlight'] = sun_choices
 
+    plant_dict['Plant_Id'] = raw_data.get('plant_id', plant_id)
+
     return plant_dict
 
 
@@ -141,11 +495,67 @@ def create_list_for_data(plant_data: json) -> list:
     """Create list for all plant data ready for a dataframe"""
     all_plant_data = []
     for number in plant_data.keys():
-        transformed_plant = create_dictionary_for_plant(plant_data[number])
+        transformed_plant = create_dictionary_for_plant(plant_data[number], number)
         all_plant_data.append(transformed_plant)
     return all_plant_data
 
 
+@dataclass(slots=True)
+class PlantReading:
+    """A single plant reading decoded from the API, with missing numbers as None"""
+    botanist_name: str
+    botanist_email: str
+    botanist_phone: str
+    last_watered: str
+    plant_name: str
+    scientific_name: str
+    recording_time: str
+    cycle: str
+    temperature: float | None
+    soil_moisture: float | None
+    sunlight: str
+    plant_id: int | None
+
+
+READING_COLUMNS = ('Botanist_Name', 'Botanist_Email', 'Botanist_Phone', 'Last_Watered',
+                   'Plant_Name', 'Scientific_Name', 'Recording_Time', 'Cycle',
+                   'Temperature', 'Soil_Moisture', 'Sunlight', 'Plant_Id')
+get_reading_values = attrgetter(*PlantReading.__slots__)
+
+
+def parse_optional_float(value) -> float | None:
+    """Returns the value as a float, or None if it is missing or invalid"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_plant_reading(raw_data: dict, plant_id: int = None) -> PlantReading:
+    """Decodes the API JSON for a single plant into a PlantReading, using the plant
+    ID it was fetched with when the payload has none"""
+    botanist = raw_data['botanist']
+    scientific_name = raw_data.get('scientific_name')
+    sunlight = raw_data.get('sunlight')
+    return PlantReading(
+        botanist['name'], botanist['email'], str(botanist['phone']),
+        raw_data['last_watered'], raw_data['name'],
+        scientific_name[0] if scientific_name else '-',
+        raw_data['recording_taken'], raw_data.get('cycle', '-'),
+        parse_optional_float(raw_data.get('temperature')),
+        parse_optional_float(raw_data.get('soil_moisture')),
+        format_sun_choices(sunlight) if sunlight else '-',
+        raw_data.get('plant_id', plant_id))
+
+
+def create_columns_for_data(plant_data: dict) -> dict[str, list]:
+    """Create column arrays for all plant data ready for a dataframe"""
+    rows = [get_reading_values(decode_plant_reading(raw_data, plant_id))
+            for plant_id, raw_data in plant_data.items()]
+    columns = zip(*rows) if rows else ([] for _ in READING_COLUMNS)
+    return {name: list(column) for name, column in zip(READING_COLUMNS, columns)}
+
+
 def validate_time_for_time_recorded(date: dt) -> dt | str:
     """Checks whether datetime is appropriate"""
     try:
@@ -182,11 +592,138 @@ def check_soil_moisture_within_correct_ranges(soil_moisture: float) -> float | s
     return soil_moisture
 
 
+def convert_time_recorded_column(dates: pd.Series) -> pd.Series:
+    """Vectorised validate_time_for_time_recorded, invalid dates become NaT"""
+    dates = pd.to_datetime(dates, format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    return dates.dt.tz_localize(SOURCE_TIMEZONE).dt.tz_convert("Europe/London")
+
+
+def convert_last_watered_column(dates: pd.Series) -> pd.Series:
+    """Vectorised validate_time_for_last_watered, invalid dates become NaT"""
+    dates = pd.to_datetime(dates, format='%a, %d %b %Y %H:%M:%S %Z', errors='coerce')
+    return dates.dt.tz_localize(None).dt.tz_localize(SOURCE_TIMEZONE).dt.tz_convert(
+        "Europe/London")
+
+
+def mask_temperature_outside_ranges(temperatures: pd.Series) -> pd.Series:
+    """Vectorised check_temperature_within_correct_ranges, invalid temperatures become NaN"""
+    temperatures = pd.to_numeric(temperatures, errors='coerce')
+    return temperatures.where(
+        temperatures.between(LOWER_TEMP_LIMIT - 5, UPPER_TEMP_LIMIT + 5))
+
+
+def mask_soil_moisture_outside_ranges(soil_moistures: pd.Series) -> pd.Series:
+    """Vectorised check_soil_moisture_within_correct_ranges, invalid moistures become NaN"""
+    soil_moistures = pd.to_numeric(soil_moistures, errors='coerce')
+    return soil_moistures.where(soil_moistures >= LOWER_SOIL_LIMIT - 5)
+
+
+def clean_plant_data(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """Validates every column of the plant dataframe at once and drops invalid rows"""
+    dataframe = dataframe.assign(
+        Botanist_Name=dataframe['Botanist_Name'].str.title(),
+        Last_Watered=convert_last_watered_column(dataframe['Last_Watered']),
+        Recording_Time=convert_time_recorded_column(dataframe['Recording_Time']),
+        Temperature=mask_temperature_outside_ranges(dataframe['Temperature']),
+        Soil_Moisture=mask_soil_moisture_outside_ranges(dataframe['Soil_Moisture']))
+    return delete_rows_containing_invalid_data(dataframe)
+
+
 def delete_rows_containing_invalid_data(dataframe: object) -> object:
     """Removal of invalid rows of data"""
     return dataframe.dropna(how='any', axis=0)
 
 
+@dataclass(slots=True)
+class Alert:
+    """An alert about a single plant, waiting to be sent"""
+    recipient: str
+    task: str
+    message: str
+
+
+class SESTransport:
+    """Sends emails through a single SES client"""
+
+    def __init__(self, config):
+        """Creates the SES client once so it is shared by every email"""
+        self.source = config["EMAIL"]
+        self.email = client('ses', aws_access_key_id=config["ACCESS_KEY_ID"],
+                            aws_secret_access_key=config["SECRET_ACCESS_KEY"],
+                            region_name='eu-west-2')
+
+    def send(self, recipient: str, task: str, message: str) -> None:
+        """Sends a single email"""
+        self.email.send_email(
+            Source=self.source,
+            Destination={
+                'ToAddresses': [
+                    recipient,
+                ]
+            },
+            Message={
+                'Subject': {
+                    'Data': f'{task}',
+                },
+                'Body': {
+                    'Html': {
+                        'Data': f'{message}',
+                    }
+                }
+            }
+        )
+
+
+class StubTransport:
+    """Records emails instead of sending them, so alerting can be tested offline"""
+
+    def __init__(self, delay: float = 0):
+        """Creates a stub that takes delay seconds to 'send' each email"""
+        self.delay = delay
+        self.sent = []
+        self.lock = Lock()
+
+    def send(self, recipient: str, task: str, message: str) -> None:
+        """Records a single email"""
+        time.sleep(self.delay)
+        with self.lock:
+            self.sent.append((recipient, task, message))
+
+
+class AlertDispatcher:
+    """Groups alerts into one digest per recipient and sends the digests concurrently"""
+
+    def __init__(self, transport, max_workers: int = ALERT_WORKERS):
+        """Creates a dispatcher sending through the given transport"""
+        self.transport = transport
+        self.max_workers = max_workers
+
+    def dispatch(self, alerts: list[Alert]) -> int:
+        """Sends the alerts and returns the number of digests that failed to send.
+
+        A failed digest is logged and doesn't stop the others being sent"""
+        digests = {}
+        for alert in alerts:
+            digests.setdefault(alert.recipient, []).append(alert)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            sent = list(executor.map(lambda digest: self.send_digest(*digest), digests.items()))
+        return sent.count(False)
+
+    def send_digest(self, recipient: str, alerts: list[Alert]) -> bool:
+        """Sends every alert for a recipient as one email, returning False if it failed"""
+        if len(alerts) == 1:
+            task = alerts[0].task
+        else:
+            task = f'ALERT: {len(alerts)} plant readings need attention!'
+        try:
+            self.transport.send(recipient, task, '<br>'.join(
+                alert.message for alert in alerts))
+        except (BotoCoreError, ClientError) as err:
+            print(f"Failed to send alerts to {recipient} - {err}")
+            return False
+        return True
+
+
 def send_alert(config, task: str, message: str):
     """Sends alert email to the relevant botanist"""
 
@@ -194,58 +731,216 @@ def send_alert(config, task: str, message: str):
         raise ValueError("Task should be a string")
     if not isinstance(message, str):
         raise ValueError("Message should be a string")
-    email = client('ses', aws_access_key_id=config["ACCESS_KEY_ID"],
-                   aws_secret_access_key=config["SECRET_ACCESS_KEY"], region_name='eu-west-2')
-    email.send_email(
-        Source=config["EMAIL"],
-        Destination={
-            'ToAddresses': [
-                config["EMAIL"],
-            ]
-        },
-        Message={
-            'Subject': {
-                'Data': f'{task}',
-            },
-            'Body': {
-                'Html': {
-                    'Data': f'{message}',
-                }
-            }
-        }
-    )
+    SESTransport(config).send(config["EMAIL"], task, message)
+
+
+@dataclass(slots=True, frozen=True)
+class AlertCondition:
+    """A reading being too low or too high, with a hysteresis band for clearing"""
+    name: str
+    column: str
+    label: str
+    direction: str
+    limit: float
+    hysteresis: float = ALERT_HYSTERESIS
+
+    def is_abnormal(self, value: float) -> bool | None:
+        """True past the limit, False once back inside it by the hysteresis, else None"""
+        if self.direction == 'low':
+            if value < self.limit:
+                return True
+            return False if value >= self.limit + self.hysteresis else None
+        if value > self.limit:
+            return True
+        return False if value <= self.limit - self.hysteresis else None
+
+
+ALERT_CONDITIONS = (
+    AlertCondition('temperature_low', 'Temperature', 'Temperature', 'low', LOWER_TEMP_LIMIT),
+    AlertCondition('temperature_high', 'Temperature', 'Temperature', 'high', UPPER_TEMP_LIMIT),
+    AlertCondition('soil_moisture_low', 'Soil_Moisture', 'Soil moisture', 'low',
+                   LOWER_SOIL_LIMIT - 5))
+
+
+class AlertStateStore:
+    """Remembers which plants are in an abnormal state so alerts aren't repeated every run"""
+
+    def __init__(self, state: dict = None, cooldown: float = ALERT_COOLDOWN,
+                 bucket: str = None, key: str = None):
+        """Creates a store from the state saved by earlier runs.
+
+        The state is saved to key in the bucket if one is given"""
+        self.state = state or {}
+        self.cooldown = cooldown
+        self.bucket = bucket
+        self.key = key
+
+    def update(self, plant_id: int, condition: str, abnormal: bool | None,
+               now: float = None) -> str | None:
+        """Returns 'alert' on entering an abnormal state or after the cooldown,
+        'resolved' on leaving it, and None otherwise"""
+        now = time.time() if now is None else now
+        key = f"{plant_id}|{condition}"
+        entry = self.state.get(key)
+        if abnormal:
+            if entry is None or now - entry["last_sent"] >= self.cooldown:
+                self.state[key] = {"last_sent": now}
+                return 'alert'
+        elif abnormal is False and entry is not None:
+            del self.state[key]
+            return 'resolved'
+        return None
+
+    def save(self, state_path: str = ALERT_STATE) -> None:
+        """Persists the alert state for the next run, to the bucket if one is set,
+        otherwise to state_path"""
+        try:
+            if self.bucket:
+                client("s3").put_object(Bucket=self.bucket, Key=self.key,
+                                        Body=json.dumps(self.state).encode("utf-8"))
+            else:
+                with open(state_path, 'w', encoding="utf-8") as file:
+                    json.dump(self.state, file)
+        except (OSError, BotoCoreError, ClientError) as err:
+            print(f"An error occurred while saving the alert state: {err}")
+
+
+def load_alert_state(state_path: str = ALERT_STATE, cooldown: float = ALERT_COOLDOWN,
+                     bucket: str = None, shard_index: int = 0,
+                     shard_count: int = 1) -> AlertStateStore:
+    """Returns the alert state saved by earlier runs.
+
+    The state is read from the bucket if one is given, otherwise from state_path.
+    Each shard keeps its own object, so concurrent shards don't overwrite each other"""
+    key = ALERT_STATE_KEY.format(shard_index=shard_index, shard_count=shard_count)
+    try:
+        if bucket:
+            body = client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+            return AlertStateStore(json.loads(body.read()), cooldown, bucket, key)
+        with open(state_path, 'r', encoding="utf-8") as file:
+            return AlertStateStore(json.load(file), cooldown)
+    except (OSError, ValueError, BotoCoreError, ClientError):
+        return AlertStateStore(cooldown=cooldown, bucket=bucket, key=key)
+
+
+def find_abnormal_results(dataframe: pd.DataFrame, recipient: str,
+                          state: AlertStateStore = None,
+                          route_to_botanist: bool = False) -> list[Alert]:
+    """Compares temperature and soil moisture to hard-coded ranges.
+
+    Alerts go to recipient, or with route_to_botanist to the plant's botanist, falling
+    back to recipient if the row has no botanist email. With an alert state only
+    changes of state, or alerts past their cooldown, are returned, tracked per Plant_Id"""
+    alerts = []
+    rows = dataframe.reindex(
+        columns=['Plant_Id', 'Plant_Name', 'Botanist_Email', 'Temperature', 'Soil_Moisture'])
+    for row in rows.itertuples(index=False):
+        row_recipient = row.Botanist_Email if route_to_botanist and isinstance(
+            row.Botanist_Email, str) and row.Botanist_Email else recipient
+        plant_key = row.Plant_Name if pd.isna(row.Plant_Id) else int(row.Plant_Id)
+        for condition in ALERT_CONDITIONS:
+            value = getattr(row, condition.column)
+            abnormal = condition.is_abnormal(value)
+            outcome = ('alert' if abnormal else None) if state is None else state.update(
+                plant_key, condition.name, abnormal)
+            if outcome == 'alert':
+                alerts.append(Alert(row_recipient, f'ALERT: {condition.label} too {condition.direction}!',
+                                    f'{condition.label} for {row.Plant_Name} was noted to be '
+                                    f'{condition.direction} at {value}.'))
+            elif outcome == 'resolved':
+                alerts.append(Alert(row_recipient, f'RESOLVED: {condition.label} back to normal',
+                                    f'{condition.label} for {row.Plant_Name} is back to '
+                                    f'normal at {value}.'))
+    return alerts
+
+
+def send_alerts_for_abnormal_results(dataframe: pd.DataFrame, config=None,
+                                     dispatcher: AlertDispatcher = None,
+                                     state: AlertStateStore = None) -> int:
+    """Sends a digest of the abnormal results, returning the number of digests that
+    failed to send. config["EMAIL"] is the sender and the recipient, unless
+    ALERT_ROUTING is "botanist", which sends each botanist a digest of their own plants.
+
+    With an alert state, plants that stay abnormal are only alerted again after the cooldown"""
+    if config is None:
+        load_dotenv()
+        config = environ
+
+    alerts = find_abnormal_results(dataframe, config["EMAIL"], state,
+                                   config.get("ALERT_ROUTING") == "botanist")
+    if not alerts:
+        return 0
+    if dispatcher is None:
+        dispatcher = AlertDispatcher(SESTransport(config))
+    return dispatcher.dispatch(alerts)
+
+
+class ConnectionManager:
+    """Keeps one database connection open between warm Lambda invocations
+
+    The same class is copied into each deployable, and live_pipeline/test_pipeline.py
+    checks the copies match, so change them together"""
+
+    def __init__(self):
+        """Creates a manager with no open connection"""
+        self.connection = None
+
+    def is_healthy(self) -> bool:
+        """Checks the open connection still works with a single cheap query.
+
+        Called at the start of each invocation, so any transaction still open was
+        left behind by an earlier invocation that was aborted. It is rolled back
+        rather than carried into this one"""
+        if self.connection is None or self.connection.closed:
+            return False
+        try:
+            if self.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                self.connection.rollback()
+            autocommit = self.connection.autocommit
+            self.connection.autocommit = True
+            with self.connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+            self.connection.autocommit = autocommit
+            return True
+        except Error:
+            return False
 
+    def get(self, config: dict):
+        """Returns the open connection, reconnecting if it is missing or broken"""
+        if not self.is_healthy():
+            self.close()
+            self.connection = connect(
+                user=config['DATABASE_USERNAME'],
+                password=config['DATABASE_PASSWORD'],
+                host=config['DATABASE_IP'],
+                port=config['DATABASE_PORT'],
+                database=config['DATABASE_NAME'],
+                connect_timeout=CONNECT_TIMEOUT,
+                options=f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",
+                **KEEPALIVE_OPTIONS)
+        return self.connection
 
-def send_alerts_for_abnormal_results(dataframe: object) -> object:
-    """Compares temperature to hard-coded ranges"""
-    load_dotenv()
-    config = environ
+    def close(self) -> None:
+        """Closes the connection if one is open"""
+        if self.connection is not None and not self.connection.closed:
+            try:
+                self.connection.close()
+            except Error:
+                pass
+        self.connection = None
 
-    for row in dataframe.itertuples():
-        temperature = row[9]
-        soil_moisture = row[10]
-        if temperature < LOWER_TEMP_LIMIT:
-            send_alert(config, 'ALERT: Temperature too low!',
-                       f'Temperature for {row[5]} was noted to be low at {temperature}.')
-        if temperature > UPPER_TEMP_LIMIT:
-            send_alert(config, 'ALERT: Temperature too high!',
-                       f'Temperature for {row[5]} was noted to be high at {temperature}.')
-        if soil_moisture < LOWER_SOIL_LIMIT - 5:
-            send_alert(config, 'ALERT: Soil moisture too low!',
-                       f'Soil moisture for {row[5]} was noted to be high at {soil_moisture}.')
+CONNECTION_MANAGER = ConnectionManager()
 
 
 def get_db_connection(config):
-    """Connect to the database with plant data"""
+    """Connect to the database with plant data, reusing a healthy connection if there is one.
+
+    Returns None if the database can't be reached."""
     try:
-        return connect(
-            user=config['DATABASE_USERNAME'],
-            password=config['DATABASE_PASSWORD'],
-            host=config['DATABASE_IP'],
-            port=config['DATABASE_PORT'],
-            database=config['DATABASE_NAME'])
-    except ValueError:
-        return "Error connecting to database."
+        return CONNECTION_MANAGER.get(config)
+    except (ValueError, Error) as err:
+        print(f"Error connecting to database - {err}")
+        return None
 
 
 def add_cycle_information(conn, cycle_name: str):
@@ -317,10 +1012,268 @@ def add_plant_information(conn, plant_record: list):
             [plant_record[6]])
         species_id = cur.fetchone()['species_id']
         cur.execute(
-            """INSERT INTO plant(species_id, temperature, soil_moisture, 
+            """INSERT INTO plant(plant_id, species_id, temperature, soil_moisture, 
             last_watered, recording_taken, sunlight_id, botanist_id, cycle_id)
-              VALUES (%s, %s, %s, %s, %s, %s, %s, %s);""",
-            [species_id, plant_record[10], plant_record[11], plant_record[5],
-             plant_record[8], sunlight_id, botanist_id, cycle_id])
+              VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+              ON CONFLICT (plant_id, recording_taken) DO NOTHING;""",
+            [plant_record[13], species_id, plant_record[10], plant_record[11],
+             plant_record[5], plant_record[8], sunlight_id, botanist_id, cycle_id])
         conn.commit()
         cur.close()
+
+
+class DimensionCache:
+    """Maps dimension values to their IDs so plant rows can be inserted without lookups.
+
+    Kept at module level so it survives between warm Lambda invocations."""
+
+    def __init__(self):
+        """Creates an empty cache"""
+        self.ids = {table: {} for table in DIMENSIONS}
+        self.warmed = False
+
+    def warm_up(self, conn) -> None:
+        """Loads every existing dimension ID with one query per table"""
+        with conn.cursor() as cur:
+            for table, (id_column, key_column, _) in DIMENSIONS.items():
+                cur.execute(sql.SQL("SELECT {}, {} FROM {};").format(
+                    sql.Identifier(key_column), sql.Identifier(id_column),
+                    sql.Identifier(table)))
+                self.ids[table] = dict(cur.fetchall())
+        self.warmed = True
+
+    def resolve(self, conn, table: str, values) -> list[int]:
+        """Returns the ID for each row of values, inserting any keys not yet cached.
+
+        The columns of values must be in the order given in DIMENSIONS."""
+        id_column, key_column, columns = DIMENSIONS[table]
+        key_index = columns.index(key_column)
+        ids = self.ids[table]
+        missing = {row[key_index]: row for row in values.itertuples(index=False, name=None)
+                   if row[key_index] not in ids}
+        if missing:
+            query = sql.SQL(
+                """INSERT INTO {table}({columns}) VALUES %s
+                ON CONFLICT ({key}) DO UPDATE SET {key} = EXCLUDED.{key}
+                RETURNING {key}, {id};""").format(
+                    table=sql.Identifier(table),
+                    columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+                    key=sql.Identifier(key_column), id=sql.Identifier(id_column))
+            with conn.cursor() as cur:
+                ids.update(execute_values(
+                    cur, query, list(missing.values()), fetch=True))
+        return [ids[key] for key in values.iloc[:, key_index]]
+
+    def clear(self) -> None:
+        """Forgets every cached ID"""
+        self.ids = {table: {} for table in DIMENSIONS}
+        self.warmed = False
+
+
+DIMENSION_CACHE = DimensionCache()
+
+
+def load_plant_data(conn, dataframe, cache: DimensionCache = DIMENSION_CACHE) -> int:
+    """Loads every plant reading in a single transaction.
+
+    Dimension IDs come from the cache, with new values upserted in one statement
+    per table, then every plant row is inserted with multi-row VALUES. Readings
+    already stored for the same plant and recording time are skipped, so a run
+    can safely be repeated. Returns the rows inserted."""
+    try:
+        if not cache.warmed:
+            cache.warm_up(conn)
+        sunlight_ids = cache.resolve(conn, 'sunlight', dataframe[['Sunlight']])
+        cycle_ids = cache.resolve(conn, 'cycle', dataframe[['Cycle']])
+        botanist_ids = cache.resolve(
+            conn, 'botanist', dataframe[['Botanist_Name', 'Botanist_Email', 'Botanist_Phone']])
+        species_ids = cache.resolve(conn, 'species', dataframe[['Plant_Name']])
+        plant_rows = list(zip(dataframe['Plant_Id'].astype(int).tolist(), species_ids,
+                              dataframe['Temperature'].tolist(),
+                              dataframe['Soil_Moisture'].tolist(),
+                              dataframe['Last_Watered'].tolist(),
+                              dataframe['Recording_Time'].tolist(),
+                              sunlight_ids, botanist_ids, cycle_ids))
+        with conn.cursor() as cur:
+            inserted = execute_values(
+                cur,
+                """INSERT INTO plant(plant_id, species_id, temperature, soil_moisture,
+                last_watered, recording_taken, sunlight_id, botanist_id, cycle_id)
+                VALUES %s
+                ON CONFLICT (plant_id, recording_taken) DO NOTHING
+                RETURNING plant_entry_id;""",
+                plant_rows, page_size=LOAD_PAGE_SIZE, fetch=True)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        cache.clear()
+        raise
+    return len(inserted)
+
+
+class LocalSpoolBackend:
+    """Stores spooled batches as files in a local directory"""
+
+    def __init__(self, directory: str):
+        """Creates the backend, making the directory if needed"""
+        self.directory = directory
+        makedirs(directory, exist_ok=True)
+
+    def write(self, name: str, body: bytes) -> None:
+        """Writes a batch, renaming it into place so a half-written file is never replayed"""
+        temp_path = path.join(self.directory, f".{name}.tmp")
+        with open(temp_path, 'wb') as file:
+            file.write(body)
+        replace(temp_path, path.join(self.directory, name))
+
+    def list(self) -> list[str]:
+        """Returns the names of the spooled batches, oldest first"""
+        return sorted(name for name in listdir(self.directory)
+                      if name.endswith(SPOOL_SUFFIX))
+
+    def read(self, name: str) -> bytes:
+        """Returns the contents of a batch"""
+        with open(path.join(self.directory, name), 'rb') as file:
+            return file.read()
+
+    def delete(self, name: str) -> None:
+        """Removes a batch once it has been loaded"""
+        remove(path.join(self.directory, name))
+
+    def quarantine(self, name: str) -> None:
+        """Moves a batch that can't be loaded into the quarantine directory"""
+        quarantine_dir = path.join(self.directory, SPOOL_QUARANTINE)
+        makedirs(quarantine_dir, exist_ok=True)
+        replace(path.join(self.directory, name), path.join(quarantine_dir, name))
+
+
+class S3SpoolBackend:
+    """Stores spooled batches as objects under a prefix in an S3 bucket"""
+
+    def __init__(self, bucket: str, prefix: str = "spool/", s3_client=None):
+        """Creates the backend, with an S3 client unless one is given"""
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3_client = s3_client or client("s3")
+
+    def write(self, name: str, body: bytes) -> None:
+        """Uploads a batch"""
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=body)
+
+    def list(self) -> list[str]:
+        """Returns the names of the spooled batches, oldest first"""
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        names = [obj["Key"][len(self.prefix):]
+                 for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix)
+                 for obj in page.get("Contents", [])]
+        return sorted(name for name in names
+                      if name.endswith(SPOOL_SUFFIX) and "/" not in name)
+
+    def read(self, name: str) -> bytes:
+        """Downloads a batch"""
+        return self.s3_client.get_object(
+            Bucket=self.bucket, Key=self.prefix + name)["Body"].read()
+
+    def delete(self, name: str) -> None:
+        """Removes a batch once it has been loaded"""
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+    def quarantine(self, name: str) -> None:
+        """Moves a batch that can't be loaded under the quarantine prefix"""
+        self.s3_client.copy_object(
+            Bucket=self.bucket, Key=f"{self.prefix}{SPOOL_QUARANTINE}/{name}",
+            CopySource={"Bucket": self.bucket, "Key": self.prefix + name})
+        self.delete(name)
+
+
+class Spool:
+    """A write-ahead spool of transformed batches that couldn't be loaded.
+
+    Each batch is stored as gzipped JSON lines, named by the time it was spooled
+    so batches replay in order."""
+
+    def __init__(self, backend):
+        """Creates a spool over a local or S3 backend"""
+        self.backend = backend
+
+    def append(self, dataframe: pd.DataFrame) -> str:
+        """Spools a batch ready for load_plant_data and returns its name"""
+        buffer = BytesIO()
+        dataframe.to_json(buffer, orient='records', lines=True,
+                          date_format='iso', compression='gzip')
+        name = f"{time.time_ns():020d}{SPOOL_SUFFIX}"
+        self.backend.write(name, buffer.getvalue())
+        print(f"Spooled {len(dataframe)} rows as {name}")
+        return name
+
+    def get_metrics(self) -> dict:
+        """Returns the size of the backlog and the age of its oldest batch"""
+        names = self.backend.list()
+        oldest = int(names[0].removesuffix(SPOOL_SUFFIX)) / 1e9 if names else None
+        return {"batches": len(names),
+                "oldest_age_seconds": round(time.time() - oldest) if names else 0}
+
+    def replay(self, conn, max_rows: int = SPOOL_REPLAY_ROWS) -> dict:
+        """Bulk loads every spooled batch, oldest first, then removes them.
+
+        Batches are combined into loads of up to max_rows rows, each in its own
+        transaction. Loads skip readings that are already stored, so a batch
+        replayed twice after a failed delete adds nothing. A batch that can't be
+        read or that the database rejects is quarantined and the replay carries
+        on, while a lost connection stops it."""
+        metrics = self.get_metrics()
+        metrics.update({"rows": 0, "inserted": 0, "quarantined": 0})
+        if metrics["batches"]:
+            print(f"Replaying spool backlog: {metrics}")
+        pending_names, pending_frames = [], []
+        for name in self.backend.list():
+            try:
+                frame = pd.read_json(
+                    BytesIO(self.backend.read(name)), lines=True, compression='gzip',
+                    dtype=False, convert_dates=False)
+            except (ValueError, OSError, EOFError) as err:
+                self.quarantine(name, err, metrics)
+                continue
+            pending_names.append(name)
+            pending_frames.append(frame)
+            if sum(map(len, pending_frames)) >= max_rows:
+                self.replay_batches(conn, pending_names, pending_frames, metrics)
+                pending_names, pending_frames = [], []
+        if pending_names:
+            self.replay_batches(conn, pending_names, pending_frames, metrics)
+        return metrics
+
+    def replay_batches(self, conn, names: list[str], frames: list[pd.DataFrame],
+                       metrics: dict) -> None:
+        """Loads some spooled batches in one transaction and removes them.
+
+        If the load is rejected, each batch is retried on its own so only the
+        batches still rejected are quarantined"""
+        try:
+            inserted = load_plant_data(conn, pd.concat(frames, ignore_index=True))
+        except CONNECTION_ERRORS:
+            raise
+        except Exception as err:
+            if len(names) == 1:
+                self.quarantine(names[0], err, metrics)
+            else:
+                for name, frame in zip(names, frames):
+                    self.replay_batches(conn, [name], [frame], metrics)
+            return
+        metrics["inserted"] += inserted
+        metrics["rows"] += sum(map(len, frames))
+        for name in names:
+            self.backend.delete(name)
+
+    def quarantine(self, name: str, err: Exception, metrics: dict) -> None:
+        """Moves a batch that can't be loaded out of the spool, keeping it to inspect"""
+        print(f"Quarantining spooled batch {name} - {err}")
+        self.backend.quarantine(name)
+        metrics["quarantined"] += 1
+
+
+def get_spool(config) -> Spool:
+    """Returns a spool in SPOOL_BUCKET if it is set, otherwise in a local directory"""
+    if config.get("SPOOL_BUCKET"):
+        return Spool(S3SpoolBackend(config["SPOOL_BUCKET"]))
+    return Spool(LocalSpoolBackend(config.get("SPOOL_DIR", SPOOL_DIR)))
@@ -0,0 +1,239 @@
+"""Tests the stages of the Lambda pipeline"""
+from unittest.mock import patch, MagicMock
+import os
+import ast
+from queue import Queue
+import pytest
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype
+
+from psycopg2 import DataError, OperationalError
+
+from pipeline import (transform, load, write_debug_snapshot, consume_micro_batches,
+                      run_pipelined, handler, END_OF_STREAM)
+from pipeline_functions import (create_columns_for_data, validate_time_for_time_recorded,
+                                validate_time_for_last_watered, Spool, LocalSpoolBackend)
+
+
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_transform_keeps_datetime_dtypes(fake_alerts, fake_api_data):
+    """Checks the clean batch is passed on with typed datetime columns"""
+    clean_df = transform(fake_api_data)
+
+    assert clean_df.shape[0] == 1
+    assert clean_df['Botanist_Name'].iloc[0] == 'Carl Linnaeus'
+    assert is_datetime64_any_dtype(clean_df['Recording_Time'])
+    assert is_datetime64_any_dtype(clean_df['Last_Watered'])
+    assert fake_alerts.call_count == 1
+
+
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_no_snapshot_written_by_default(fake_alerts, fake_api_data, tmp_path, monkeypatch):
+    """Checks disk snapshots are only written when SNAPSHOT_DIR is set"""
+    monkeypatch.delenv("SNAPSHOT_DIR", raising=False)
+    transform(fake_api_data)
+    assert not os.listdir(tmp_path)
+
+    monkeypatch.setenv("SNAPSHOT_DIR", str(tmp_path))
+    transform(fake_api_data)
+    write_debug_snapshot("plants.json", fake_api_data)
+    assert sorted(os.listdir(tmp_path)) == ["clean_data.csv", "plants.json"]
+
+
+@patch("pipeline.load_plant_data")
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_load_passes_naive_london_times(fake_alerts, fake_load, fake_api_data):
+    """Checks load hands the bulk loader wall-clock times without a timezone"""
+    connection = MagicMock()
+
+    load(connection, transform(fake_api_data))
+
+    load_df = fake_load.call_args[0][1]
+    assert fake_load.call_args[0][0] is connection
+    assert load_df['Recording_Time'].dt.tz is None
+    assert load_df['Recording_Time'].iloc[0].strftime('%M:%S') == '20:15'
+    assert load_df['Sunlight'].iloc[0] == 'full sun, part sun/part shade'
+
+
+@patch("pipeline_functions.load_plant_data")
+@patch("pipeline.load_plant_data")
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_load_spools_when_database_unreachable(fake_alerts, fake_load, fake_replay_load,
+                                               fake_api_data, tmp_path):
+    """Checks a batch is spooled when there is no connection or the load loses it,
+    and the backlog is replayed in one load once the database is back"""
+    spool = Spool(LocalSpoolBackend(str(tmp_path)))
+    clean_df = transform(fake_api_data)
+
+    assert load(None, clean_df, spool) == "spooled"
+    fake_replay_load.side_effect = OperationalError("server closed")
+    assert load(MagicMock(), clean_df, spool) == "spooled"
+    assert len(spool.backend.list()) == 2
+    assert fake_load.call_count == 0
+
+    fake_replay_load.side_effect = None
+    assert load(MagicMock(), clean_df, spool) == "success"
+    assert spool.backend.list() == []
+    assert len(fake_replay_load.call_args[0][1]) == 2
+    assert fake_load.call_count == 1
+
+
+@patch("pipeline_functions.load_plant_data")
+@patch("pipeline.load_plant_data")
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_current_batch_loaded_past_a_bad_spooled_batch(fake_alerts, fake_load, fake_replay_load,
+                                                       fake_api_data, tmp_path):
+    """Checks a spooled batch the database rejects is quarantined without stopping the
+    current batch, and a rejected current batch is spooled rather than lost"""
+    spool = Spool(LocalSpoolBackend(str(tmp_path)))
+    clean_df = transform(fake_api_data)
+    spool.append(clean_df)
+    fake_replay_load.side_effect = DataError("bad value")
+
+    assert load(MagicMock(), clean_df, spool) == "success"
+    assert fake_load.call_count == 1
+    assert spool.backend.list() == []
+    assert len(os.listdir(tmp_path / "quarantine")) == 1
+
+    fake_load.side_effect = DataError("bad value")
+    assert load(MagicMock(), clean_df, spool) == "spooled"
+    assert len(spool.backend.list()) == 1
+
+
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_vectorised_transform_matches_row_by_row(fake_alerts, fake_api_data, utc_timezone):
+    """Checks the vectorised transform gives the same values as the per-row validators"""
+    fake_api_data[9]["soil_moisture"] = 50.0
+    clean_df = transform(fake_api_data)
+
+    expected = pd.DataFrame(create_columns_for_data(fake_api_data))
+    expected['Recording_Time'] = expected['Recording_Time'].map(
+        validate_time_for_time_recorded)
+    expected['Last_Watered'] = expected['Last_Watered'].map(
+        validate_time_for_last_watered)
+
+    assert list(clean_df['Recording_Time']) == list(expected['Recording_Time'])
+    assert list(clean_df['Last_Watered']) == list(expected['Last_Watered'])
+
+
+@patch("pipeline.load", return_value="success")
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_micro_batches_loaded_as_plants_arrive(fake_alerts, fake_load, fake_api_data):
+    """Checks the consumer loads a micro-batch once it is full and the rest at the end,
+    without replaying the spool, then sends one set of alerts for the whole run"""
+    plant_queue = Queue()
+    for plant_id in (8, 9, 8):
+        plant_queue.put((plant_id, fake_api_data[plant_id]))
+    plant_queue.put(END_OF_STREAM)
+
+    statuses = consume_micro_batches(plant_queue, MagicMock(), None, batch_size=2)
+
+    assert statuses == ["success", "success"]
+    assert [len(call[0][1]) for call in fake_load.call_args_list] == [1, 1]
+    assert all(call[1] == {"replay": False} for call in fake_load.call_args_list)
+    assert fake_alerts.call_count == 1
+    assert len(fake_alerts.call_args[0][0]) == 2
+
+
+@patch("pipeline.load", return_value="success")
+@patch("pipeline.load_failure_log")
+@patch("pipeline.iter_plants")
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_run_pipelined_skips_unchanged_plants(fake_alerts, fake_iter_plants, fake_failure_log,
+                                              fake_load, fake_api_data):
+    """Checks only changed plants are loaded and the last-seen index is updated"""
+    fake_iter_plants.return_value = iter(fake_api_data.items())
+    _, seen = run_pipelined([8, 9], 0, {}, MagicMock(), None)
+    fake_iter_plants.return_value = iter(fake_api_data.items())
+
+    statuses, last_seen = run_pipelined([8, 9], 0, seen, MagicMock(), None)
+
+    assert statuses == []
+    assert last_seen == seen
+    assert sorted(seen) == ["8", "9"]
+    assert fake_load.call_count == 1
+    assert fake_failure_log().flush.call_count == 2
+
+
+@patch("pipeline.replay_spool")
+@patch("pipeline.load", return_value="success")
+@patch("pipeline.load_failure_log")
+@patch("pipeline.iter_plants")
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_run_pipelined_replays_spool_once(fake_alerts, fake_iter_plants, fake_failure_log,
+                                          fake_load, fake_replay, fake_api_data, tmp_path):
+    """Checks the spool is replayed once for the run rather than per micro-batch"""
+    fake_iter_plants.return_value = iter(
+        [(plant_id, {**fake_api_data[8], "plant_id": plant_id}) for plant_id in range(25)])
+    connection = MagicMock()
+
+    run_pipelined([8], 0, {}, connection, Spool(LocalSpoolBackend(str(tmp_path))))
+
+    assert fake_replay.call_count == 1
+    assert fake_replay.call_args[0][0] is connection
+    assert fake_load.call_count > 1
+
+
+@patch("pipeline.load", side_effect=ValueError("fake failure"))
+@patch("pipeline.load_failure_log")
+@patch("pipeline.iter_plants")
+@patch("pipeline.send_alerts_for_abnormal_results")
+def test_run_pipelined_raises_consumer_errors(fake_alerts, fake_iter_plants, fake_failure_log,
+                                             fake_load, fake_api_data):
+    """Checks a failed load stops the producer rather than leaving it blocked"""
+    fake_iter_plants.return_value = iter(
+        [(plant_id, {**fake_api_data[8], "plant_id": plant_id}) for plant_id in range(50)])
+
+    with pytest.raises(ValueError):
+        run_pipelined([8], 0, {}, MagicMock(), None)
+
+
+@patch("pipeline.get_db_connection")
+@patch("pipeline.get_spool")
+@patch("pipeline.extract", return_value=({}, {}))
+@patch("pipeline.get_plant_ids", return_value=[8])
+def test_spool_replayed_on_a_run_with_no_new_readings(fake_plant_ids, fake_extract, fake_spool,
+                                                      fake_connection):
+    """Checks the spooled backlog is still replayed when every reading is unchanged"""
+    fake_spool().get_metrics.return_value = {"batches": 1}
+
+    result = handler({})
+
+    assert result == {'status': "no new readings"}
+    fake_spool().replay.assert_called_once_with(fake_connection())
+
+
+@patch("pipeline.get_db_connection")
+@patch("pipeline.get_spool")
+@patch("pipeline.extract", return_value=({}, {}))
+@patch("pipeline.get_plant_ids", return_value=[8])
+def test_no_connection_made_without_new_readings_or_spool(fake_plant_ids, fake_extract,
+                                                          fake_spool, fake_connection):
+    """Checks a run with nothing to load or replay doesn't connect to the database"""
+    fake_spool().get_metrics.return_value = {"batches": 0}
+
+    handler({})
+
+    assert fake_connection.call_count == 0
+
+
+def get_connection_manager_code(file_path: str) -> str:
+    """Returns the code of the ConnectionManager class in a file, without its docstrings"""
+    with open(file_path, encoding="utf-8") as file:
+        tree = ast.parse(file.read())
+    manager = next(node for node in tree.body
+                   if isinstance(node, ast.ClassDef) and node.name == "ConnectionManager")
+    for node in ast.walk(manager):
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef)) and ast.get_docstring(node):
+            node.body = node.body[1:]
+    return ast.dump(manager)
+
+
+def test_connection_manager_copies_match():
+    """Checks the ConnectionManager copied into each deployable hasn't drifted"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    copies = [get_connection_manager_code(os.path.join(root, file_path)) for file_path in (
+        "live_pipeline/pipeline_functions.py", "live_pipeline/load/database_functions.py",
+        "archive_pipeline/archive.py", "dashboard/streamlit_app.py")]
+
+    assert all(copy == copies[0] for copy in copies)
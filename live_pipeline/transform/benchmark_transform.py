@@ -0,0 +1,57 @@
+"""Benchmarks the row-by-row transform against the vectorised transform.
+To run: `python3 benchmark_transform.py [number of rows]`
+"""
+import sys
+import time
+import pandas as pd
+
+from transform_functions import validate_time_for_last_watered, validate_time_for_time_recorded, check_temperature_within_correct_ranges, check_soil_moisture_within_correct_ranges, delete_rows_containing_invalid_data, clean_plant_data
+
+DEFAULT_ROWS = 20_000
+
+
+def create_fake_dataframe(rows: int) -> pd.DataFrame:
+    """Creates a dataframe of plant readings with some invalid values mixed in"""
+    return pd.DataFrame({
+        'Botanist_Name': ['carl linnaeus'] * rows,
+        'Last_Watered': [f"Wed, 30 Aug 2023 13:{i % 60:02d}:32 GMT" for i in range(rows)],
+        'Recording_Time': [f"2023-08-30 14:{i % 60:02d}:09" if i % 97 else "2023-13-30 14:56:09"
+                           for i in range(rows)],
+        'Temperature': [(i % 60) - 5.5 for i in range(rows)],
+        'Soil_Moisture': [float(i % 100) for i in range(rows)]})
+
+
+def transform_row_by_row(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """The transform as it was done before, mapping each function over every row"""
+    dataframe = dataframe.copy()
+    dataframe['Botanist_Name'] = dataframe['Botanist_Name'].apply(lambda x: x.title())
+    dataframe['Last_Watered'] = dataframe['Last_Watered'].map(validate_time_for_last_watered)
+    dataframe['Recording_Time'] = dataframe['Recording_Time'].map(
+        validate_time_for_time_recorded)
+    dataframe['Temperature'] = dataframe['Temperature'].map(
+        check_temperature_within_correct_ranges)
+    dataframe['Soil_Moisture'] = dataframe['Soil_Moisture'].map(
+        check_soil_moisture_within_correct_ranges)
+    return delete_rows_containing_invalid_data(dataframe)
+
+
+def time_transform(transform, dataframe: pd.DataFrame) -> tuple[float, pd.DataFrame]:
+    """Returns how long the transform took and its result"""
+    start = time.perf_counter()
+    result = transform(dataframe)
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    number_of_rows = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROWS
+    fake_df = create_fake_dataframe(number_of_rows)
+
+    row_time, row_result = time_transform(transform_row_by_row, fake_df)
+    vector_time, vector_result = time_transform(clean_plant_data, fake_df)
+
+    for column in row_result.columns:
+        assert list(row_result[column]) == list(vector_result[column]), column
+
+    print(f"Rows: {number_of_rows}, kept: {len(vector_result)}")
+    print(f"Row by row: {row_time:.3f}s")
+    print(f"Vectorised: {vector_time:.3f}s ({row_time / vector_time:.1f}x faster)")
@@ -124,3 +124,10 @@ def fake_dataframe():
                                    {'Botanist_Name': 'Eliza Andrews', 'Botanist_Email': 'eliza.andrews@lnhm.co.uk', 'Botanist_Phone': '(846)669-6651x75948', 'Last_Watered': 'Wed, 30 Aug 2023 14:50:16 GMT', 'Plant_Name': 'Rafflesia arnoldii',
                                     'Scientific_Name': '-', 'Recording_Time': '2023-08-30 14:56:11', 'Cycle': '-', 'Temperature': None, 'Soil_Moisture': 99.65892740826129, 'Sunlight': '-', 'Humidity': '-'},
                                    {'Botanist_Name': 'Carl Linnaeus', 'Botanist_Email': 'carl.linnaeus@lnhm.co.uk', 'Botanist_Phone': '(146)994-1635x35992', 'Last_Watered': 'Wed, 30 Aug 2023 13:16:25 GMT', 'Plant_Name': 'Black bat flower', 'Scientific_Name': '-', 'Recording_Time': '2023-08-30 14:56:12', 'Cycle': '-', 'Temperature': 11.376320865206864, 'Soil_Moisture': 94.04791885586481, 'Sunlight': '-', 'Humidity': '-'}])
+
+
+@pytest.fixture
+def fake_alert_dataframe():
+    return pd.DataFrame({'Plant_Name': ['Venus flytrap', 'Corpse flower', 'Black bat flower'],
+                         'Temperature': [5.2, 42.7, 20.1],
+                         'Soil_Moisture': [80.0, 90.0, 12.3]})
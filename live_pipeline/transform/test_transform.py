@@ -1,7 +1,11 @@
 """Test code for transform.py"""
-from unittest.mock import MagicMock
+import io
+import time
+from unittest.mock import MagicMock, patch
 import pytest
-from transform_functions import create_dictionary_for_plant, format_sun_choices, validate_float, create_list_for_data, validate_time_for_time_recorded, validate_time_for_last_watered, check_temperature_within_correct_ranges, check_soil_moisture_within_correct_ranges, delete_rows_containing_invalid_data, send_alert
+import pandas as pd
+from botocore.exceptions import ClientError
+from transform_functions import create_dictionary_for_plant, format_sun_choices, validate_float, create_list_for_data, validate_time_for_time_recorded, validate_time_for_last_watered, check_temperature_within_correct_ranges, check_soil_moisture_within_correct_ranges, delete_rows_containing_invalid_data, send_alert, PlantReading, READING_COLUMNS, decode_plant_reading, parse_optional_float, create_columns_for_data, clean_plant_data, mask_temperature_outside_ranges, mask_soil_moisture_outside_ranges, Alert, AlertDispatcher, StubTransport, find_abnormal_results, send_alerts_for_abnormal_results, AlertCondition, AlertStateStore, load_alert_state
 
 
 def test_dictionary_created_for_plant(fake_raw_plant_data):
@@ -110,3 +114,251 @@ def test_ensure_email_message_is_string():
     with pytest.raises(ValueError) as not_string:
         send_alert(fake_config, "task", 0)
     assert "Message should be a string" in str(not_string)
+
+
+def test_decode_plant_reading(fake_raw_plant_data):
+    """Test missing numbers are decoded as None rather than a string sentinel"""
+    result = decode_plant_reading(fake_raw_plant_data)
+
+    assert isinstance(result, PlantReading) is True
+    assert result.botanist_name == 'Fake Person'
+    assert result.sunlight == '-'
+    assert result.soil_moisture is None
+    assert result.temperature == 12.070482937725064
+    assert result.plant_id == 532
+    assert not hasattr(result, '__dict__')
+
+
+def test_parse_optional_float_invalid(fake_float_invalid):
+    """Check None is returned for an invalid float"""
+    assert parse_optional_float(fake_float_invalid) is None
+    assert parse_optional_float(None) is None
+
+
+def test_create_columns_for_data(fake_data):
+    """Test column arrays are built that give numeric dataframe columns"""
+    result = create_columns_for_data(fake_data)
+
+    assert list(result.keys()) == list(READING_COLUMNS)
+    assert result['Temperature'] == [12.070482937725064, 12.070482937725064]
+    assert pd.DataFrame(result)['Soil_Moisture'].dtype == 'float64'
+
+
+def test_plant_id_falls_back_to_the_id_fetched(fake_data):
+    """Test a payload without a plant_id takes the ID it was fetched with"""
+    del fake_data["2"]["plant_id"]
+
+    columns = create_columns_for_data(fake_data)
+    rows = create_list_for_data(fake_data)
+
+    assert columns['Plant_Id'] == [532, "2"]
+    assert [row['Plant_Id'] for row in rows] == [532, "2"]
+
+
+def test_create_columns_matches_list_for_data(fake_data):
+    """Test the column arrays hold the same values as the dictionary per plant"""
+    columns = create_columns_for_data(fake_data)
+    rows = create_list_for_data(fake_data)
+
+    for column in READING_COLUMNS:
+        assert columns[column] == [row[column] for row in rows]
+
+
+def test_clean_plant_data_matches_row_by_row(fake_dataframe):
+    """Test the vectorised transform gives the same rows as mapping each function"""
+    raw = fake_dataframe.copy()
+    raw.loc[1, 'Recording_Time'] = "2023-13-30 14:56:09"
+    raw.loc[3, 'Temperature'] = 100.32536
+
+    expected = raw.copy()
+    expected['Botanist_Name'] = expected['Botanist_Name'].apply(lambda x: x.title())
+    expected['Last_Watered'] = expected['Last_Watered'].map(validate_time_for_last_watered)
+    expected['Recording_Time'] = expected['Recording_Time'].map(
+        validate_time_for_time_recorded)
+    expected['Temperature'] = expected['Temperature'].map(
+        check_temperature_within_correct_ranges)
+    expected['Soil_Moisture'] = expected['Soil_Moisture'].map(
+        check_soil_moisture_within_correct_ranges)
+    expected = delete_rows_containing_invalid_data(expected)
+
+    result = clean_plant_data(raw)
+
+    assert list(result.index) == list(expected.index)
+    for column in ('Last_Watered', 'Recording_Time', 'Temperature', 'Soil_Moisture'):
+        assert list(result[column]) == list(expected[column])
+
+
+def test_range_masks_keep_boundaries():
+    """Test the fluctuation limits themselves are still treated as valid"""
+    temperatures = mask_temperature_outside_ranges(pd.Series([2.9, 3, 45, 45.1]))
+    soil_moistures = mask_soil_moisture_outside_ranges(pd.Series([15.9, 16]))
+
+    assert temperatures.isna().tolist() == [True, False, False, True]
+    assert soil_moistures.isna().tolist() == [True, False]
+
+
+def test_find_abnormal_results(fake_alert_dataframe):
+    """Test an alert is made for every reading outside the normal ranges"""
+    alerts = find_abnormal_results(fake_alert_dataframe, 'fake@lnhm.co.uk')
+
+    assert [alert.task for alert in alerts] == ['ALERT: Temperature too low!',
+                                               'ALERT: Temperature too high!',
+                                               'ALERT: Soil moisture too low!']
+    assert all(alert.recipient == 'fake@lnhm.co.uk' for alert in alerts)
+
+
+def test_alerts_sent_as_one_digest_per_recipient(fake_alert_dataframe):
+    """Test all the alerts for a recipient are sent in a single email"""
+    transport = StubTransport()
+    dispatcher = AlertDispatcher(transport)
+
+    failed = send_alerts_for_abnormal_results(
+        fake_alert_dataframe, {"EMAIL": 'fake@lnhm.co.uk'}, dispatcher)
+
+    assert failed == 0
+    assert len(transport.sent) == 1
+    assert transport.sent[0][0] == 'fake@lnhm.co.uk'
+    assert transport.sent[0][2].count('<br>') == 2
+
+
+def test_alerts_routed_to_each_botanist(fake_alert_dataframe):
+    """Test alerts go to the configured email unless routing to botanists is turned on"""
+    dataframe = fake_alert_dataframe.assign(
+        Botanist_Email=['carl.linnaeus@lnhm.co.uk', 'gertrude.jekyll@lnhm.co.uk', None])
+    default_transport = StubTransport()
+    routed_transport = StubTransport()
+
+    send_alerts_for_abnormal_results(
+        dataframe, {"EMAIL": 'fake@lnhm.co.uk'}, AlertDispatcher(default_transport))
+    send_alerts_for_abnormal_results(
+        dataframe, {"EMAIL": 'fake@lnhm.co.uk', "ALERT_ROUTING": "botanist"},
+        AlertDispatcher(routed_transport))
+
+    assert [email[0] for email in default_transport.sent] == ['fake@lnhm.co.uk']
+    assert sorted(email[0] for email in routed_transport.sent) == [
+        'carl.linnaeus@lnhm.co.uk', 'fake@lnhm.co.uk', 'gertrude.jekyll@lnhm.co.uk']
+
+
+def test_failed_digest_counted_without_stopping_the_others():
+    """Test an SES error for one recipient is counted and the other digests still send"""
+    transport = StubTransport()
+    send = transport.send
+
+    def send_or_reject(recipient, task, message):
+        if recipient == 'unverified@lnhm.co.uk':
+            raise ClientError({"Error": {"Code": "MessageRejected"}}, "SendEmail")
+        send(recipient, task, message)
+
+    transport.send = send_or_reject
+    alerts = [Alert(recipient, 'task', 'message') for recipient in
+              ['unverified@lnhm.co.uk', 'fake@lnhm.co.uk']]
+
+    failed = AlertDispatcher(transport).dispatch(alerts)
+
+    assert failed == 1
+    assert [email[0] for email in transport.sent] == ['fake@lnhm.co.uk']
+
+
+def test_digests_sent_concurrently():
+    """Test digests for different recipients are sent at the same time"""
+    transport = StubTransport(delay=0.2)
+    dispatcher = AlertDispatcher(transport, max_workers=5)
+    alerts = [Alert(f'{number}@lnhm.co.uk', 'task', 'message') for number in range(5)]
+
+    start = time.perf_counter()
+    failed = dispatcher.dispatch(alerts)
+
+    assert failed == 0
+    assert len(transport.sent) == 5
+    assert time.perf_counter() - start < 0.5
+
+
+@patch("transform_functions.SESTransport")
+def test_no_client_created_without_alerts(fake_transport, fake_dataframe):
+    """Test SES isn't contacted when every reading is normal"""
+    normal_df = delete_rows_containing_invalid_data(fake_dataframe)
+
+    failed = send_alerts_for_abnormal_results(normal_df, {"EMAIL": 'fake@lnhm.co.uk'})
+
+    assert failed == 0
+    assert fake_transport.call_count == 0
+
+
+def test_alert_state_only_sends_transitions():
+    """Test a plant that stays abnormal is alerted once and again after the cooldown"""
+    state = AlertStateStore(cooldown=600)
+
+    assert state.update(8, 'temperature_low', True, now=0) == 'alert'
+    assert state.update(8, 'temperature_low', True, now=60) is None
+    assert state.update(8, 'temperature_low', None, now=120) is None
+    assert state.update(8, 'temperature_low', True, now=600) == 'alert'
+    assert state.update(8, 'temperature_low', False, now=660) == 'resolved'
+    assert state.update(8, 'temperature_low', False, now=720) is None
+
+
+def test_alert_state_kept_per_plant_id(fake_alert_dataframe):
+    """Test plants sharing a common name don't share alert state"""
+    state = AlertStateStore()
+    dataframe = fake_alert_dataframe.iloc[[0, 0]].assign(Plant_Id=[1, 2])
+
+    alerts = find_abnormal_results(dataframe, 'fake@lnhm.co.uk', state)
+    recovered = find_abnormal_results(
+        dataframe.assign(Temperature=[20.0, 5.2]), 'fake@lnhm.co.uk', state)
+
+    assert len(alerts) == 2
+    assert sorted(state.state) == ['2|temperature_low']
+    assert [alert.task for alert in recovered] == ['RESOLVED: Temperature back to normal']
+
+
+def test_alert_condition_hysteresis():
+    """Test a reading only clears once it is back past the limit by the hysteresis"""
+    condition = AlertCondition('temperature_low', 'Temperature', 'Temperature', 'low', 8, 1)
+
+    assert condition.is_abnormal(7.9) is True
+    assert condition.is_abnormal(8.5) is None
+    assert condition.is_abnormal(9) is False
+
+
+def test_sustained_incident_sends_one_alert(fake_alert_dataframe, tmp_path):
+    """Test repeated runs with the same abnormal readings don't send more emails"""
+    state_path = str(tmp_path / "alert_state.json")
+    transport = StubTransport()
+    config = {"EMAIL": 'fake@lnhm.co.uk'}
+
+    for _ in range(3):
+        state = load_alert_state(state_path)
+        send_alerts_for_abnormal_results(
+            fake_alert_dataframe, config, AlertDispatcher(transport), state)
+        state.save(state_path)
+
+    assert len(transport.sent) == 1
+    assert transport.sent[0][2].count('<br>') == 2
+
+
+def test_resolved_alert_sent_on_recovery(fake_alert_dataframe):
+    """Test a notice is sent when a plant returns to normal"""
+    state = AlertStateStore()
+    find_abnormal_results(fake_alert_dataframe, 'fake@lnhm.co.uk', state)
+    recovered = fake_alert_dataframe.assign(Temperature=[20.0, 20.0, 20.0])
+
+    alerts = find_abnormal_results(recovered, 'fake@lnhm.co.uk', state)
+
+    assert [alert.task for alert in alerts] == ['RESOLVED: Temperature back to normal',
+                                               'RESOLVED: Temperature back to normal']
+
+
+@patch("transform_functions.client")
+def test_alert_state_kept_in_bucket_per_shard(fake_client, tmp_path):
+    """Test the alert state is read from and saved to the shard's object when a bucket is set"""
+    fake_client().get_object.return_value = {
+        "Body": io.BytesIO(b'{"8|temperature_low": {"last_sent": 0}}')}
+
+    state = load_alert_state(str(tmp_path / "alert_state.json"), bucket="fake-bucket",
+                             shard_index=1, shard_count=4)
+    state.save(str(tmp_path / "alert_state.json"))
+
+    assert fake_client().get_object.call_args[1]["Key"] == "alert_state_1_of_4.json"
+    assert fake_client().put_object.call_args[1]["Bucket"] == "fake-bucket"
+    assert fake_client().put_object.call_args[1]["Key"] == "alert_state_1_of_4.json"
+    assert "8|temperature_low" in state.state
+    assert not list(tmp_path.iterdir())
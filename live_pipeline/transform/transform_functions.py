@@ -1,18 +1,31 @@
 """libraries required for transformation functions"""
 from datetime import datetime as dt
+from dataclasses import dataclass
+from operator import attrgetter
 from os import environ
+import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 import json
+import pandas as pd
 from boto3 import client
+from botocore.exceptions import BotoCoreError, ClientError
 from dotenv import load_dotenv
 
 
 LOWER_TEMP_LIMIT = 8
 UPPER_TEMP_LIMIT = 40
 LOWER_SOIL_LIMIT = 21
+ALERT_WORKERS = 5
+ALERT_STATE = "alert_state.json"
+ALERT_STATE_KEY = "alert_state_{shard_index}_of_{shard_count}.json"
+ALERT_COOLDOWN = 3600
+ALERT_HYSTERESIS = 1
 
 
-def create_dictionary_for_plant(raw_data: dict) -> dict:
-    """Dictionary created from extracted file"""
+def create_dictionary_for_plant(raw_data: dict, plant_id: int = None) -> dict:
+    """Dictionary created from extracted file, using the plant ID it was fetched
+    with when the payload has none"""
     plant_dict = {}
     plant_dict['Botanist_Name'] = raw_data['botanist']['name']
     plant_dict['Botanist_Email'] = raw_data['botanist']['email']
@@ -50,6 +63,8 @@ def create_dictionary_for_plant(raw_data: dict) -> dict:
         sun_choices = format_sun_choices(raw_data['sunlight'])
         plant_dict['Sunlight'] = sun_choices
 
+    plant_dict['Plant_Id'] = raw_data.get('plant_id', plant_id)
+
     return plant_dict
 
 
@@ -83,11 +98,67 @@ def create_list_for_data(plant_data: json) -> list:
     """Create list for all plant data ready for a dataframe"""
     all_plant_data = []
     for number in plant_data.keys():
-        transformed_plant = create_dictionary_for_plant(plant_data[number])
+        transformed_plant = create_dictionary_for_plant(plant_data[number], number)
         all_plant_data.append(transformed_plant)
     return all_plant_data
 
 
+@dataclass(slots=True)
+class PlantReading:
+    """A single plant reading decoded from the API, with missing numbers as None"""
+    botanist_name: str
+    botanist_email: str
+    botanist_phone: str
+    last_watered: str
+    plant_name: str
+    scientific_name: str
+    recording_time: str
+    cycle: str
+    temperature: float | None
+    soil_moisture: float | None
+    sunlight: str
+    plant_id: int | None
+
+
+READING_COLUMNS = ('Botanist_Name', 'Botanist_Email', 'Botanist_Phone', 'Last_Watered',
+                   'Plant_Name', 'Scientific_Name', 'Recording_Time', 'Cycle',
+                   'Temperature', 'Soil_Moisture', 'Sunlight', 'Plant_Id')
+get_reading_values = attrgetter(*PlantReading.__slots__)
+
+
+def parse_optional_float(value) -> float | None:
+    """Returns the value as a float, or None if it is missing or invalid"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_plant_reading(raw_data: dict, plant_id: int = None) -> PlantReading:
+    """Decodes the API JSON for a single plant into a PlantReading, using the plant
+    ID it was fetched with when the payload has none"""
+    botanist = raw_data['botanist']
+    scientific_name = raw_data.get('scientific_name')
+    sunlight = raw_data.get('sunlight')
+    return PlantReading(
+        botanist['name'], botanist['email'], str(botanist['phone']),
+        raw_data['last_watered'], raw_data['name'],
+        scientific_name[0] if scientific_name else '-',
+        raw_data['recording_taken'], raw_data.get('cycle', '-'),
+        parse_optional_float(raw_data.get('temperature')),
+        parse_optional_float(raw_data.get('soil_moisture')),
+        format_sun_choices(sunlight) if sunlight else '-',
+        raw_data.get('plant_id', plant_id))
+
+
+def create_columns_for_data(plant_data: dict) -> dict[str, list]:
+    """Create column arrays for all plant data ready for a dataframe"""
+    rows = [get_reading_values(decode_plant_reading(raw_data, plant_id))
+            for plant_id, raw_data in plant_data.items()]
+    columns = zip(*rows) if rows else ([] for _ in READING_COLUMNS)
+    return {name: list(column) for name, column in zip(READING_COLUMNS, columns)}
+
+
 def validate_time_for_time_recorded(date: dt) -> dt | str:
     """Checks whether datetime is appropriate"""
     try:
@@ -122,11 +193,136 @@ def check_soil_moisture_within_correct_ranges(soil_moisture: float) -> float | s
     return soil_moisture
 
 
+def convert_time_recorded_column(dates: pd.Series) -> pd.Series:
+    """Vectorised validate_time_for_time_recorded, invalid dates become NaT"""
+    return pd.to_datetime(dates, format='%Y-%m-%d %H:%M:%S', errors='coerce')
+
+
+def convert_last_watered_column(dates: pd.Series) -> pd.Series:
+    """Vectorised validate_time_for_last_watered, invalid dates become NaT"""
+    dates = pd.to_datetime(dates, format='%a, %d %b %Y %H:%M:%S %Z', errors='coerce')
+    return dates.dt.tz_localize(None)
+
+
+def mask_temperature_outside_ranges(temperatures: pd.Series) -> pd.Series:
+    """Vectorised check_temperature_within_correct_ranges, invalid temperatures become NaN"""
+    temperatures = pd.to_numeric(temperatures, errors='coerce')
+    return temperatures.where(
+        temperatures.between(LOWER_TEMP_LIMIT - 5, UPPER_TEMP_LIMIT + 5))
+
+
+def mask_soil_moisture_outside_ranges(soil_moistures: pd.Series) -> pd.Series:
+    """Vectorised check_soil_moisture_within_correct_ranges, invalid moistures become NaN"""
+    soil_moistures = pd.to_numeric(soil_moistures, errors='coerce')
+    return soil_moistures.where(soil_moistures >= LOWER_SOIL_LIMIT - 5)
+
+
+def clean_plant_data(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """Validates every column of the plant dataframe at once and drops invalid rows"""
+    dataframe = dataframe.assign(
+        Botanist_Name=dataframe['Botanist_Name'].str.title(),
+        Last_Watered=convert_last_watered_column(dataframe['Last_Watered']),
+        Recording_Time=convert_time_recorded_column(dataframe['Recording_Time']),
+        Temperature=mask_temperature_outside_ranges(dataframe['Temperature']),
+        Soil_Moisture=mask_soil_moisture_outside_ranges(dataframe['Soil_Moisture']))
+    return delete_rows_containing_invalid_data(dataframe)
+
+
 def delete_rows_containing_invalid_data(dataframe: object) -> object:
     """Removal of invalid rows of data"""
     return dataframe.dropna(how='any', axis=0)
 
 
+@dataclass(slots=True)
+class Alert:
+    """An alert about a single plant, waiting to be sent"""
+    recipient: str
+    task: str
+    message: str
+
+
+class SESTransport:
+    """Sends emails through a single SES client"""
+
+    def __init__(self, config):
+        """Creates the SES client once so it is shared by every email"""
+        self.source = config["EMAIL"]
+        self.email = client('ses', aws_access_key_id=config["ACCESS_KEY_ID"],
+                            aws_secret_access_key=config["SECRET_ACCESS_KEY"],
+                            region_name='eu-west-2')
+
+    def send(self, recipient: str, task: str, message: str) -> None:
+        """Sends a single email"""
+        self.email.send_email(
+            Source=self.source,
+            Destination={
+                'ToAddresses': [
+                    recipient,
+                ]
+            },
+            Message={
+                'Subject': {
+                    'Data': f'{task}',
+                },
+                'Body': {
+                    'Html': {
+                        'Data': f'{message}',
+                    }
+                }
+            }
+        )
+
+
+class StubTransport:
+    """Records emails instead of sending them, so alerting can be tested offline"""
+
+    def __init__(self, delay: float = 0):
+        """Creates a stub that takes delay seconds to 'send' each email"""
+        self.delay = delay
+        self.sent = []
+        self.lock = Lock()
+
+    def send(self, recipient: str, task: str, message: str) -> None:
+        """Records a single email"""
+        time.sleep(self.delay)
+        with self.lock:
+            self.sent.append((recipient, task, message))
+
+
+class AlertDispatcher:
+    """Groups alerts into one digest per recipient and sends the digests concurrently"""
+
+    def __init__(self, transport, max_workers: int = ALERT_WORKERS):
+        """Creates a dispatcher sending through the given transport"""
+        self.transport = transport
+        self.max_workers = max_workers
+
+    def dispatch(self, alerts: list[Alert]) -> int:
+        """Sends the alerts and returns the number of digests that failed to send.
+
+        A failed digest is logged and doesn't stop the others being sent"""
+        digests = {}
+        for alert in alerts:
+            digests.setdefault(alert.recipient, []).append(alert)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            sent = list(executor.map(lambda digest: self.send_digest(*digest), digests.items()))
+        return sent.count(False)
+
+    def send_digest(self, recipient: str, alerts: list[Alert]) -> bool:
+        """Sends every alert for a recipient as one email, returning False if it failed"""
+        if len(alerts) == 1:
+            task = alerts[0].task
+        else:
+            task = f'ALERT: {len(alerts)} plant readings need attention!'
+        try:
+            self.transport.send(recipient, task, '<br>'.join(
+                alert.message for alert in alerts))
+        except (BotoCoreError, ClientError) as err:
+            print(f"Failed to send alerts to {recipient} - {err}")
+            return False
+        return True
+
+
 def send_alert(config, task: str, message: str):
     """Sends alert email to the relevant botanist"""
 
@@ -134,42 +330,145 @@ def send_alert(config, task: str, message: str):
         raise ValueError("Task should be a string")
     if not isinstance(message, str):
         raise ValueError("Message should be a string")
-    email = client('ses', aws_access_key_id=config["ACCESS_KEY_ID"],
-                   aws_secret_access_key=config["SECRET_ACCESS_KEY"], region_name='eu-west-2')
-    email.send_email(
-        Source=config["EMAIL"],
-        Destination={
-            'ToAddresses': [
-                config["EMAIL"],
-            ]
-        },
-        Message={
-            'Subject': {
-                'Data': f'{task}',
-            },
-            'Body': {
-                'Html': {
-                    'Data': f'{message}',
-                }
-            }
-        }
-    )
-
-
-def send_alerts_for_abnormal_results(dataframe: object) -> object:
-    """Compares temperature to hard-coded ranges"""
-    load_dotenv()
-    config = environ
-
-    for row in dataframe.itertuples():
-        temperature = row[9]
-        soil_moisture = row[10]
-        if temperature < LOWER_TEMP_LIMIT:
-            send_alert(config, 'ALERT: Temperature too low!',
-                       f'Temperature for {row[5]} was noted to be low at {temperature}.')
-        if temperature > UPPER_TEMP_LIMIT:
-            send_alert(config, 'ALERT: Temperature too high!',
-                       f'Temperature for {row[5]} was noted to be high at {temperature}.')
-        if soil_moisture < LOWER_SOIL_LIMIT - 5:
-            send_alert(config, 'ALERT: Soil moisture too low!',
-                       f'Soil moisture for {row[5]} was noted to be high at {soil_moisture}.')
+    SESTransport(config).send(config["EMAIL"], task, message)
+
+
+@dataclass(slots=True, frozen=True)
+class AlertCondition:
+    """A reading being too low or too high, with a hysteresis band for clearing"""
+    name: str
+    column: str
+    label: str
+    direction: str
+    limit: float
+    hysteresis: float = ALERT_HYSTERESIS
+
+    def is_abnormal(self, value: float) -> bool | None:
+        """True past the limit, False once back inside it by the hysteresis, else None"""
+        if self.direction == 'low':
+            if value < self.limit:
+                return True
+            return False if value >= self.limit + self.hysteresis else None
+        if value > self.limit:
+            return True
+        return False if value <= self.limit - self.hysteresis else None
+
+
+ALERT_CONDITIONS = (
+    AlertCondition('temperature_low', 'Temperature', 'Temperature', 'low', LOWER_TEMP_LIMIT),
+    AlertCondition('temperature_high', 'Temperature', 'Temperature', 'high', UPPER_TEMP_LIMIT),
+    AlertCondition('soil_moisture_low', 'Soil_Moisture', 'Soil moisture', 'low',
+                   LOWER_SOIL_LIMIT - 5))
+
+
+class AlertStateStore:
+    """Remembers which plants are in an abnormal state so alerts aren't repeated every run"""
+
+    def __init__(self, state: dict = None, cooldown: float = ALERT_COOLDOWN,
+                 bucket: str = None, key: str = None):
+        """Creates a store from the state saved by earlier runs.
+
+        The state is saved to key in the bucket if one is given"""
+        self.state = state or {}
+        self.cooldown = cooldown
+        self.bucket = bucket
+        self.key = key
+
+    def update(self, plant_id: int, condition: str, abnormal: bool | None,
+               now: float = None) -> str | None:
+        """Returns 'alert' on entering an abnormal state or after the cooldown,
+        'resolved' on leaving it, and None otherwise"""
+        now = time.time() if now is None else now
+        key = f"{plant_id}|{condition}"
+        entry = self.state.get(key)
+        if abnormal:
+            if entry is None or now - entry["last_sent"] >= self.cooldown:
+                self.state[key] = {"last_sent": now}
+                return 'alert'
+        elif abnormal is False and entry is not None:
+            del self.state[key]
+            return 'resolved'
+        return None
+
+    def save(self, state_path: str = ALERT_STATE) -> None:
+        """Persists the alert state for the next run, to the bucket if one is set,
+        otherwise to state_path"""
+        try:
+            if self.bucket:
+                client("s3").put_object(Bucket=self.bucket, Key=self.key,
+                                        Body=json.dumps(self.state).encode("utf-8"))
+            else:
+                with open(state_path, 'w', encoding="utf-8") as file:
+                    json.dump(self.state, file)
+        except (OSError, BotoCoreError, ClientError) as err:
+            print(f"An error occurred while saving the alert state: {err}")
+
+
+def load_alert_state(state_path: str = ALERT_STATE, cooldown: float = ALERT_COOLDOWN,
+                     bucket: str = None, shard_index: int = 0,
+                     shard_count: int = 1) -> AlertStateStore:
+    """Returns the alert state saved by earlier runs.
+
+    The state is read from the bucket if one is given, otherwise from state_path.
+    Each shard keeps its own object, so concurrent shards don't overwrite each other"""
+    key = ALERT_STATE_KEY.format(shard_index=shard_index, shard_count=shard_count)
+    try:
+        if bucket:
+            body = client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+            return AlertStateStore(json.loads(body.read()), cooldown, bucket, key)
+        with open(state_path, 'r', encoding="utf-8") as file:
+            return AlertStateStore(json.load(file), cooldown)
+    except (OSError, ValueError, BotoCoreError, ClientError):
+        return AlertStateStore(cooldown=cooldown, bucket=bucket, key=key)
+
+
+def find_abnormal_results(dataframe: pd.DataFrame, recipient: str,
+                          state: AlertStateStore = None,
+                          route_to_botanist: bool = False) -> list[Alert]:
+    """Compares temperature and soil moisture to hard-coded ranges.
+
+    Alerts go to recipient, or with route_to_botanist to the plant's botanist, falling
+    back to recipient if the row has no botanist email. With an alert state only
+    changes of state, or alerts past their cooldown, are returned, tracked per Plant_Id"""
+    alerts = []
+    rows = dataframe.reindex(
+        columns=['Plant_Id', 'Plant_Name', 'Botanist_Email', 'Temperature', 'Soil_Moisture'])
+    for row in rows.itertuples(index=False):
+        row_recipient = row.Botanist_Email if route_to_botanist and isinstance(
+            row.Botanist_Email, str) and row.Botanist_Email else recipient
+        plant_key = row.Plant_Name if pd.isna(row.Plant_Id) else int(row.Plant_Id)
+        for condition in ALERT_CONDITIONS:
+            value = getattr(row, condition.column)
+            abnormal = condition.is_abnormal(value)
+            outcome = ('alert' if abnormal else None) if state is None else state.update(
+                plant_key, condition.name, abnormal)
+            if outcome == 'alert':
+                alerts.append(Alert(row_recipient, f'ALERT: {condition.label} too {condition.direction}!',
+                                    f'{condition.label} for {row.Plant_Name} was noted to be '
+                                    f'{condition.direction} at {value}.'))
+            elif outcome == 'resolved':
+                alerts.append(Alert(row_recipient, f'RESOLVED: {condition.label} back to normal',
+                                    f'{condition.label} for {row.Plant_Name} is back to '
+                                    f'normal at {value}.'))
+    return alerts
+
+
+def send_alerts_for_abnormal_results(dataframe: pd.DataFrame, config=None,
+                                     dispatcher: AlertDispatcher = None,
+                                     state: AlertStateStore = None) -> int:
+    """Sends a digest of the abnormal results, returning the number of digests that
+    failed to send. config["EMAIL"] is the sender and the recipient, unless
+    ALERT_ROUTING is "botanist", which sends each botanist a digest of their own plants.
+
+    With an alert state, plants that stay abnormal are only alerted again after the cooldown"""
+    if config is None:
+        load_dotenv()
+        config = environ
+
+    alerts = find_abnormal_results(dataframe, config["EMAIL"], state,
+                                   config.get("ALERT_ROUTING") == "botanist")
+    if not alerts:
+        return 0
+    if dispatcher is None:
+        dispatcher = AlertDispatcher(SESTransport(config))
+    return dispatcher.dispatch(alerts)
@@ -153,12 +153,15 @@ resource "aws_lambda_function" "archive-lambda" {
   timeout = 120
   environment {
     variables = {
-      EXAMPLE  = var.initial_database
-      EXAMPLE     = var.database_name
-      EXAMPLE = var.database_password
-      EXAMPLE    = var.database_port
-      EXAMPLE = var.database_username
-      EXAMPLE    = var.database_ip
+      DATABASE_NAME       = var.database_name
+      DATABASE_PASSWORD   = var.database_password
+      DATABASE_PORT       = var.database_port
+      DATABASE_USERNAME   = var.database_username
+      DATABASE_IP         = var.database_ip
+      ACCESS_KEY_ID       = var.access_key
+      SECRET_ACCESS_KEY   = var.secret_key
+      ARCHIVE_BUCKET_NAME = var.bucket_name
+      ARCHIVE_MODE        = "incremental"
     }
   }
 }
@@ -358,14 +361,14 @@ resource "aws_scheduler_schedule" "live-pipeline-scheduler" {
 resource "aws_scheduler_schedule" "archive-pipeline-schedule" {
   name                         = "ontheb-rink-ofextinction-archive-pipeline-schedule"
   schedule_expression_timezone = "Europe/London"
-  description                  = "Schedule to run ETL pipeline every day"
+  description                  = "Schedule to run the incremental archive every hour"
   state                        = "ENABLED"
 
   flexible_time_window {
     mode = "OFF"
   }
 
-  schedule_expression = "cron(5 0 * * ? *)"
+  schedule_expression = "cron(5 * * * ? *)"
 
   target {
     arn      = "arn:aws:lambda:eu-west-2:129033205317:function:ontheb-rink-ofextinction-archive-lambda-tf"